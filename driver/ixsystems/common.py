@@ -13,17 +13,29 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+from concurrent import futures
 import os
+import re
 import simplejson as json
+import threading
+import time
 import urllib.parse
+import zlib
 
 from cinder import exception
 from cinder.i18n import _
+from cinder.volume.drivers.ixsystems import freenasapi
 from cinder.volume.drivers.ixsystems.freenasapi import FreeNASApiError
 from cinder.volume.drivers.ixsystems.freenasapi import FreeNASServer
+from cinder.volume.drivers.ixsystems.freenasws import FreeNASWebSocketServer
 from cinder.volume.drivers.ixsystems import utils as ix_utils
+from oslo_concurrency import lockutils
 from oslo_config import cfg
 from oslo_log import log as logging
+from oslo_service import loopingcall
+from oslo_utils import excutils
+from keystoneauth1 import exceptions as ks_exceptions
 from keystoneauth1.identity import v3
 from keystoneauth1 import session
 from keystoneclient.v3 import client
@@ -31,11 +43,341 @@ from keystoneclient.v3 import client
 LOG = logging.getLogger(__name__)
 CONF = cfg.CONF
 
+keystone_authtoken_opts = [
+    cfg.StrOpt('auth_url'), cfg.StrOpt('username'), cfg.StrOpt('password'),
+    cfg.StrOpt('project_name'), cfg.StrOpt('user_domain_name'),
+    cfg.StrOpt('project_domain_name')]
+
+
+class ISCSIInventory(object):
+    """In-process index of the iSCSI objects exported by this backend.
+
+       Maps a target name to the ids of its iSCSI target, extent and
+       target-extent mapping. An id of 0 records that the object is known
+       not to exist. Only entries holding all requested ids are served,
+       partial entries count as misses.
+    """
+
+    FIELDS = ('target', 'extent', 'targetextent')
+
+    def __init__(self):
+        self._index = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name, fields=FIELDS):
+        """Returns a copy of the ids indexed for name, None on a miss."""
+        with self._lock:
+            entry = self._index.get(name)
+            if entry is None or not all(f in entry for f in fields):
+                self.misses += 1
+                return None
+            self.hits += 1
+            return dict(entry)
+
+    def update(self, name, **ids):
+        """Records the given ids for name."""
+        with self._lock:
+            self._index.setdefault(name, {}).update(ids)
+
+    def remove(self, name):
+        with self._lock:
+            self._index.pop(name, None)
+
+    def replace(self, index):
+        """Replaces the whole index, used to warm it in bulk."""
+        with self._lock:
+            self._index = index
+
+    def get_stats(self):
+        with self._lock:
+            return {'entries': len(self._index),
+                    'hits': self.hits,
+                    'misses': self.misses}
+
+
+class AttachCounter(object):
+    """Counts export targets attached through this backend in O(1).
+
+       Tracks the initiators each target is attached to. It is seeded
+       from the live iSCSI sessions of the array and updated as volumes
+       are attached and detached in between.
+    """
+
+    # Seconds an admitted attach is kept over a resync not showing its
+    # session yet, the initiator logs in after initialize_connection.
+    LOGIN_GRACE = 120
+
+    def __init__(self):
+        self._attached = {}
+        self._admitted = {}
+        self._lock = threading.Lock()
+
+    def admit(self, target, initiator, limit=None):
+        """Records an attach unless it would exceed limit targets."""
+        with self._lock:
+            if (limit is not None and target not in self._attached and
+                    len(self._attached) >= limit):
+                return False
+            self._attached.setdefault(target, set()).add(initiator)
+            self._admitted[(target, initiator)] = time.monotonic()
+            return True
+
+    def release(self, target, initiator=None):
+        """Records a detach, of all initiators if initiator is None."""
+        with self._lock:
+            initiators = self._attached.get(target, set())
+            if initiator is None:
+                initiators.clear()
+            initiators.discard(initiator)
+            if not initiators:
+                self._attached.pop(target, None)
+            for key in [key for key in self._admitted if key[0] == target
+                        and (initiator is None or key[1] == initiator)]:
+                del self._admitted[key]
+
+    def resync(self, attached):
+        """Replaces the counts with live state, keeping recent admits."""
+        now = time.monotonic()
+        with self._lock:
+            for key, admitted in list(self._admitted.items()):
+                if now - admitted > self.LOGIN_GRACE:
+                    del self._admitted[key]
+                else:
+                    attached.setdefault(key[0], set()).add(key[1])
+            self._attached = attached
+
+    def count(self):
+        with self._lock:
+            return len(self._attached)
+
+    def is_attached(self, target):
+        with self._lock:
+            return bool(self._attached.get(target))
+
+    def targets_of(self, initiator):
+        """Returns the targets initiator is attached to."""
+        with self._lock:
+            return [target for target, initiators in self._attached.items()
+                    if initiator in initiators]
+
+
+class LUNAllocator(object):
+    """Allocates LUN ids on shared iSCSI targets.
+
+       The ids used on a target are loaded from the array the first time
+       the target is needed and tracked in-process afterwards.
+    """
+
+    # TrueNAS accepts LUN ids 0 to 1023 on a target.
+    MAX_LUNS = 1024
+
+    def __init__(self):
+        self._used = {}
+        self._lock = threading.Lock()
+
+    def is_loaded(self, target_id):
+        with self._lock:
+            return target_id in self._used
+
+    def load(self, target_id, lunids):
+        """Records lunids as used on target_id."""
+        with self._lock:
+            self._used.setdefault(target_id, set()).update(lunids)
+
+    def allocate(self, target_id):
+        """Reserves the lowest free LUN id, None if the target is full."""
+        with self._lock:
+            used = self._used.setdefault(target_id, set())
+            for lunid in range(self.MAX_LUNS):
+                if lunid not in used:
+                    used.add(lunid)
+                    return lunid
+            return None
+
+    def release(self, target_id, lunid):
+        with self._lock:
+            self._used.get(target_id, set()).discard(lunid)
+
+    def forget(self, target_id=None):
+        """Drops what is known of target_id, or of all targets."""
+        with self._lock:
+            if target_id is None:
+                self._used.clear()
+            else:
+                self._used.pop(target_id, None)
+
+    def count(self, target_id):
+        with self._lock:
+            return len(self._used.get(target_id, ()))
+
+
+class DeferredDeleteQueue(object):
+    """Volumes waiting for their dependent clones before being destroyed.
+
+       Entries are persisted as JSON to path, when given, so deletes
+       queued before a restart are still carried out.
+    """
+
+    def __init__(self, path=None):
+        self._path = path
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        if not self._path or not os.path.exists(self._path):
+            return
+        try:
+            with open(self._path) as fd:
+                entries = json.load(fd)
+        except Exception as e:
+            LOG.warning('Ignoring deferred delete queue %s: %s',
+                        self._path, e)
+            return
+        with self._lock:
+            self._entries.update(entries)
+
+    def _save(self):
+        if not self._path:
+            return
+        try:
+            with open(self._path + '.tmp', 'w') as fd:
+                json.dump(self._entries, fd)
+            os.replace(self._path + '.tmp', self._path)
+        except Exception as e:
+            LOG.warning('Failed to save deferred delete queue %s: %s',
+                        self._path, e)
+
+    def add(self, name):
+        with self._lock:
+            now = time.time()
+            self._entries.setdefault(name, {'queued_at': now,
+                                            'tried_at': now,
+                                            'attempts': 0})
+            self._save()
+
+    def remove(self, name):
+        with self._lock:
+            if self._entries.pop(name, None) is not None:
+                self._save()
+
+    def tried(self, name):
+        """Records a failed attempt, moving name to the back."""
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None:
+                entry['attempts'] += 1
+                entry['tried_at'] = time.time()
+                self._save()
+
+    def due(self, limit):
+        """Returns up to limit names, least recently tried first."""
+        with self._lock:
+            return sorted(self._entries,
+                          key=lambda n: self._entries[n]['tried_at'])[:limit]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class _Batch(object):
+    """Calls gathered into one core.bulk job."""
+
+    __slots__ = ('params', 'full', 'done', 'results', 'error')
+
+    def __init__(self):
+        self.params = []
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+
+
+class BulkBatcher(object):
+    """Gathers concurrent calls to the same method into batches.
+
+       The first call of a batch waits up to window seconds for others
+       to join, or until max_batch calls joined, then sends them all with
+       send(key, params) and hands each caller its own result.
+    """
+
+    def __init__(self, send, window, max_batch):
+        self._send = send
+        self._window = window
+        self._max_batch = max_batch
+        self._batches = {}
+        self._lock = threading.Lock()
+
+    def call(self, key, params):
+        with self._lock:
+            batch = self._batches.get(key)
+            leader = batch is None
+            if leader:
+                batch = self._batches[key] = _Batch()
+            index = len(batch.params)
+            batch.params.append(params)
+            if len(batch.params) >= self._max_batch:
+                del self._batches[key]
+                batch.full.set()
+        if leader:
+            batch.full.wait(self._window)
+            with self._lock:
+                if self._batches.get(key) is batch:
+                    del self._batches[key]
+            try:
+                batch.results = self._send(key, batch.params)
+            except Exception as e:
+                batch.error = e
+            batch.done.set()
+        else:
+            batch.done.wait()
+        if batch.error is not None:
+            raise batch.error
+        return batch.results[index]
+
 
 class TrueNASCommon(object):
 
     VERSION = "2.0.0"
     IGROUP_PREFIX = 'openstack-'
+    SERVICE_PROJECT_CACHE_SIZE = 1024
+    # Create calls that can share a core.bulk job, by REST collection.
+    BULK_METHODS = {
+        FreeNASServer.REST_API_VOLUME: 'pool.dataset.create',
+        FreeNASServer.REST_API_SNAPSHOT + '/' + FreeNASServer.CLONE:
+            'zfs.snapshot.clone',
+        FreeNASServer.REST_API_TARGET: 'iscsi.target.create',
+        FreeNASServer.REST_API_EXTENT: 'iscsi.extent.create',
+        FreeNASServer.REST_API_TARGET_TO_EXTENT: 'iscsi.targetextent.create',
+    }
+    # Validation errors of a create whose object is already there
+    ALREADY_EXISTS_RE = re.compile(
+        r'already exists|must be unique|already in this target', re.I)
+    SHARED_TARGET_PREFIX = 'openstack-shared-'
+    CLONE_MODES = ('linked', 'full')
+    # Volumes flattened per run of the background flattener.
+    FLATTEN_BATCH = 4
+    # zvol settings accepted in ixsystems: volume type extra specs.
+    VOLBLOCKSIZES = (512, 1024, 2048, 4096, 8192, 16384, 32768, 65536,
+                     131072)
+    SYNC_CHOICES = ('STANDARD', 'ALWAYS', 'DISABLED')
+    DEDUP_CHOICES = ('ON', 'OFF', 'VERIFY')
+    # Used when the array does not list its compression choices.
+    COMPRESSION_CHOICES = ('OFF', 'LZ4', 'GZIP', 'GZIP-1', 'GZIP-9', 'ZLE',
+                           'LZJB')
+    # (extra spec, pool.dataset field) pairs that can be changed on an
+    # existing zvol. volblocksize and sparse are fixed at creation.
+    ZVOL_UPDATABLE_SPECS = (('compression', 'compression'),
+                            ('sync', 'sync'),
+                            ('dedup', 'deduplication'))
+    # iscsi.extent fields accepted in ixsystems: volume type extra specs,
+    # with the values TrueNAS gives an extent that does not set them.
+    EXTENT_DEFAULTS = {'blocksize': 512, 'pblocksize': False, 'rpm': 'SSD',
+                       'insecure_tpc': True, 'xen': False,
+                       'avail_threshold': None}
+    EXTENT_BLOCKSIZES = (512, 1024, 2048, 4096)
+    EXTENT_RPMS = ('UNKNOWN', 'SSD', '5400', '7200', '10000', '15000')
 
     required_flags = ['ixsystems_transport_type', 'ixsystems_server_hostname',
                       'ixsystems_server_port', 'ixsystems_server_iscsi_port',
@@ -50,20 +392,83 @@ class TrueNASCommon(object):
         self.storage_protocol = self.configuration.ixsystems_storage_protocol
         self.apikey = self.configuration.ixsystems_apikey
         self.stats = {}
+        self._stats_collector = None
+        self._clone_flattener = None
+        self._deferred_reaper = None
+        deferred_file = self.configuration.ixsystems_deferred_delete_file
+        if not deferred_file and self.configuration.ixsystems_deferred_delete:
+            deferred_file = os.path.join(
+                CONF.state_path, 'ixsystems-deferred-deletes-%s.json' %
+                self.backend_name)
+        self.deferred_deletes = DeferredDeleteQueue(deferred_file)
+        self.batcher = BulkBatcher(self._send_bulk,
+                                   self.configuration.ixsystems_bulk_window,
+                                   self.configuration.ixsystems_bulk_max_batch)
+        self.inventory = ISCSIInventory()
+        self.attachments = AttachCounter()
+        self.luns = LUNAllocator()
+        self._shared_targets = {}
+        self._shared_targets_lock = threading.Lock()
+        # Initiator group of each host by name, and the targets known to
+        # allow it, which tells when a group may be garbage collected.
+        # The references are loaded from the array once, then tracked.
+        self._igroups = {}
+        self._igroup_refs = {}
+        self._igroup_refs_loaded = False
+        self._igroups_lock = threading.Lock()
+        self._portals = None
+        self._portal_turn = 0
+        self._portal_load = collections.Counter()
+        self._portal_choices = {}
+        self._portals_lock = threading.Lock()
+        self._capabilities = None
+        # Volumes being flattened, and whether each was exported since.
+        self._flattening = {}
+        self._flatten_lock = threading.Lock()
+        self._keystone = None
+        self._keystone_lock = threading.Lock()
+        self._keystone_stats = {'calls': 0, 'errors': 0,
+                                'total_seconds': 0.0, 'max_seconds': 0.0}
+        self._service_projects = ix_utils.TTLCache(
+            self.SERVICE_PROJECT_CACHE_SIZE,
+            self.configuration.ixsystems_keystone_cache_ttl)
+        # Only guards _capabilities and is never held over an API call,
+        # _on_api_error takes it. Callers share a probe through the
+        # probe lock, which error listeners never take.
+        self._capabilities_lock = threading.Lock()
+        self._capabilities_probe_lock = threading.Lock()
+        self.executor = futures.ThreadPoolExecutor(
+            max_workers=self.configuration.ixsystems_api_workers)
 
     def _create_handle(self, **kwargs):
         """Instantiate client for API comms with iXsystems FREENAS server."""
 
         host_system = kwargs['hostname']
         LOG.debug('Using iXsystems FREENAS server: %s', host_system)
-        self.handle = FreeNASServer(
+        if kwargs['transport_type'] in FreeNASWebSocketServer.TRANSPORT_TYPES:
+            server_class = FreeNASWebSocketServer
+        else:
+            server_class = FreeNASServer
+        self.handle = server_class(
             host=host_system,
             port=kwargs['port'],
             username=kwargs['login'],
             password=kwargs['password'],
             apikey=kwargs['apikey'],
             api_version=kwargs['api_version'],
-            transport_type=kwargs['transport_type'])
+            transport_type=kwargs['transport_type'],
+            pool_size=kwargs['pool_size'],
+            pool_idle_timeout=kwargs['pool_idle_timeout'],
+            job_timeouts=kwargs['job_timeouts'],
+            call_timeouts=kwargs['call_timeouts'],
+            retries=kwargs['retries'],
+            retry_backoff=kwargs['retry_backoff'],
+            breaker_threshold=kwargs['breaker_threshold'],
+            breaker_probe_interval=kwargs['breaker_probe_interval'],
+            read_limit=kwargs['read_limit'],
+            write_limit=kwargs['write_limit'],
+            target_latency=kwargs['target_latency'],
+            read_window=kwargs['read_window'])
         if not self.handle:
             raise FreeNASApiError("Failed to create handle for FREENAS server")
 
@@ -82,16 +487,48 @@ class TrueNASCommon(object):
             password=self.configuration.ixsystems_password,
             apikey=self.configuration.ixsystems_apikey,
             api_version=self.configuration.ixsystems_api_version,
-            transport_type=self.configuration.ixsystems_transport_type)
+            transport_type=self.configuration.ixsystems_transport_type,
+            pool_size=self.configuration.ixsystems_connection_pool_size,
+            pool_idle_timeout=(
+                self.configuration.ixsystems_connection_idle_timeout),
+            job_timeouts=self.configuration.ixsystems_job_timeouts,
+            call_timeouts=self.configuration.ixsystems_call_timeouts,
+            retries=self.configuration.ixsystems_api_retries,
+            retry_backoff=self.configuration.ixsystems_api_retry_backoff,
+            breaker_threshold=self.configuration.ixsystems_breaker_threshold,
+            breaker_probe_interval=(
+                self.configuration.ixsystems_breaker_probe_interval),
+            read_limit=self.configuration.ixsystems_api_read_limit,
+            write_limit=self.configuration.ixsystems_api_write_limit,
+            target_latency=self.configuration.ixsystems_api_target_latency,
+            read_window=self.configuration.ixsystems_api_read_window)
 
         if not self.handle:
             raise FreeNASApiError(
                 "Failed to create handle for FREENAS server")
 
-    def _create_volume(self, name, size):
-        """Creates a volume of specified size."""
+        self.handle.add_error_listener(self._on_api_error)
+        self._load_capabilities()
+        self.deferred_deletes.load()
 
-        params = {}
+        try:
+            self._warm_inventory()
+        except Exception as e:
+            # Not fatal, the inventory fills as names are looked up.
+            LOG.warning('Failed to warm iSCSI inventory: %s', e)
+        try:
+            self._sync_attachments()
+        except Exception as e:
+            LOG.warning('Failed to read iSCSI sessions: %s', e)
+
+    def _create_volume(self, name, size, properties=None):
+        """Creates a volume of specified size.
+
+           properties are extra pool.dataset fields, as returned by
+           _get_zvol_properties.
+        """
+
+        params = dict(properties or {})
         params['name'] = self.configuration.ixsystems_dataset_path + '/' + name
         params['type'] = 'VOLUME'
         params['volsize'] = ix_utils.get_bytes_from_gb(size)
@@ -100,14 +537,144 @@ class TrueNASCommon(object):
         request_urn = ('%s') % (FreeNASServer.REST_API_VOLUME)
         LOG.debug('_create_volume params : %s', params)
         LOG.debug('_create_volume urn : %s', request_urn)
-        ret = self.handle.invoke_command(FreeNASServer.CREATE_COMMAND,
-                                         request_urn, jparams)
+        ret = self._invoke_create(request_urn, jparams)
         LOG.debug('_create_volume response : %s', json.dumps(ret))
-        if ret['status'] != FreeNASServer.STATUS_OK:
+        if self._already_exists(ret):
+            # Created by an earlier attempt that got no response.
+            LOG.info('_create_volume: %s already exists', name)
+        elif ret['status'] != FreeNASServer.STATUS_OK:
             msg = ('Error while creating volume: %s' % ret['response'])
             raise FreeNASApiError('Unexpected error', msg)
 
-    def _target_to_extent(self, target_id, extent_id):
+    def _invoke_create(self, request_urn, jparams, op_type='default'):
+        """Invokes a create call, batched with concurrent ones if enabled.
+
+           Creates are retried while the server is unreachable, callers
+           check _already_exists for an attempt that got no response.
+        """
+        if (self.configuration.ixsystems_bulk_window <= 0 or
+                request_urn.rstrip('/') not in self.BULK_METHODS):
+            return self.handle.jobs.invoke(FreeNASServer.CREATE_COMMAND,
+                                           request_urn, jparams, op_type,
+                                           retry=True)
+        return self.batcher.call((request_urn, op_type), jparams)
+
+    def _already_exists(self, ret):
+        """Returns True if a retried create found its object created.
+
+           Only a retry can find the object made by an earlier attempt
+           that got no response. On the first attempt the object belongs
+           to something else, such as another volume whose name shares
+           the same UUID prefix, and must not be adopted.
+        """
+        return (ret['status'] == FreeNASServer.STATUS_ERROR and
+                ret['code'] == 422 and ret['attempts'] > 1 and
+                self.ALREADY_EXISTS_RE.search(str(ret['response'])) is not None)
+
+    def _send_bulk(self, key, bodies):
+        """Sends the create calls of a batch as one core.bulk job.
+
+           Returns a FreeNASResponse per call, as if each was sent alone.
+        """
+        request_urn, op_type = key
+        if len(bodies) == 1:
+            return [self.handle.jobs.invoke(FreeNASServer.CREATE_COMMAND,
+                                            request_urn, bodies[0], op_type,
+                                            retry=True)]
+        method = self.BULK_METHODS[request_urn.rstrip('/')]
+        args = {'method': method,
+                'params': [[json.loads(body)] for body in bodies],
+                'description': 'Cinder %s x%d' % (method, len(bodies))}
+        LOG.debug('_send_bulk %s x%d', method, len(bodies))
+        ret = self.handle.jobs.invoke(FreeNASServer.CREATE_COMMAND,
+                                      FreeNASServer.REST_API_BULK,
+                                      json.dumps(args).encode('utf8'),
+                                      op_type, retry=True)
+        if ret['status'] != FreeNASServer.STATUS_OK:
+            return [ret] * len(bodies)
+        results = []
+        for item in json.loads(ret['response'].decode('utf8')):
+            if item.get('error') is None:
+                results.append(ret._replace(
+                    response=json.dumps(item.get('result')).encode('utf8')))
+            else:
+                results.append(ret._replace(
+                    status=FreeNASServer.STATUS_ERROR,
+                    response='422:%s' % item['error'], code=422))
+        return results
+
+    def _get_compression_choices(self):
+        """Returns the compression algorithms the array accepts."""
+        return (self._get_capabilities().get('compression_choices') or
+                self.COMPRESSION_CHOICES)
+
+    def _get_zvol_properties(self, extra_specs):
+        """Validates ixsystems: zvol extra specs of a volume type.
+
+           Returns the pool.dataset fields they set. sparse defaults to
+           the provisioning:type extra spec, then ixsystems_sparse_volumes.
+           Raises InvalidVolumeType for values the array does not support.
+        """
+        specs = ix_utils.get_ixsystems_specs(extra_specs)
+        provisioning = (extra_specs or {}).get('provisioning:type')
+        properties = {}
+        try:
+            if 'sparse' in specs:
+                properties['sparse'] = ix_utils.parse_spec_bool(
+                    specs['sparse'])
+            elif provisioning in ('thin', 'thick'):
+                properties['sparse'] = provisioning == 'thin'
+            else:
+                properties['sparse'] = (
+                    self.configuration.ixsystems_sparse_volumes)
+            if 'volblocksize' in specs:
+                size = ix_utils.parse_block_size(specs['volblocksize'])
+                if size not in self.VOLBLOCKSIZES:
+                    raise ValueError('volblocksize must be a power of two '
+                                     'from 512 to 128K')
+                properties['volblocksize'] = (
+                    '%dK' % (size // 1024) if size >= 1024 else str(size))
+            for spec, field in self.ZVOL_UPDATABLE_SPECS:
+                if spec not in specs:
+                    continue
+                if spec == 'compression':
+                    choices = self._get_compression_choices()
+                elif spec == 'sync':
+                    choices = self.SYNC_CHOICES
+                else:
+                    choices = self.DEDUP_CHOICES
+                value = specs[spec].upper()
+                if value not in choices:
+                    raise ValueError('%s must be one of %s' %
+                                     (spec, ', '.join(choices)))
+                properties[field] = value
+        except ValueError as e:
+            raise exception.InvalidVolumeType(
+                reason=_('invalid ixsystems: extra spec, %s') % e)
+        LOG.debug('_get_zvol_properties : %s', properties)
+        return properties
+
+    def _update_zvol(self, name, properties):
+        """Sets the updatable properties of an existing zvol."""
+        fields = [field for spec, field in self.ZVOL_UPDATABLE_SPECS]
+        params = dict((key, value) for key, value in properties.items()
+                      if key in fields)
+        if not params:
+            return
+        request_urn = ('%s/id/%s') % (
+            FreeNASServer.REST_API_VOLUME,
+            urllib.parse.quote_plus(
+                self.configuration.ixsystems_dataset_path + '/' + name))
+        LOG.debug('_update_zvol %s params : %s', name, params)
+        ret = self.handle.invoke_command(FreeNASServer.UPDATE_COMMAND,
+                                         request_urn,
+                                         json.dumps(params).encode('utf8'))
+        if ret['status'] != FreeNASServer.STATUS_OK:
+            msg = ('Error while updating volume: %s' % ret['response'])
+            raise FreeNASApiError('Unexpected error', msg)
+
+    def _target_to_extent(self, target_id, extent_id, name=None,
+                          lunid=None):
         """Create relationship between iscsi target to iscsi extent."""
 
         LOG.debug('_target_to_extent target id : %s extend id : %s',
@@ -118,21 +685,36 @@ class TrueNASCommon(object):
         params['target'] = target_id
         params['extent'] = extent_id
         # params['iscsi_lunid'] = 0   # no longer needed with API v2.0
+        if lunid is not None:
+            params['lunid'] = lunid
         jparams = json.dumps(params)
         jparams = jparams.encode('utf8')
 
         LOG.debug('_create_target_to_extent params : %s', json.dumps(params))
 
-        tgt_ext = self.handle.invoke_command(FreeNASServer.CREATE_COMMAND,
-                                             request_urn, jparams)
+        tgt_ext = self._invoke_create(request_urn, jparams)
 
         LOG.debug('_target_to_extent response : %s', json.dumps(tgt_ext))
 
+        if self._already_exists(tgt_ext):
+            tgt_ext = self.handle.query(
+                FreeNASServer.REST_API_TARGET_TO_EXTENT,
+                [('target', '=', target_id), ('extent', '=', extent_id)],
+                {'limit': 1, 'select': ['id']})
+            if (tgt_ext['status'] == FreeNASServer.STATUS_OK and
+                    json.loads(tgt_ext['response'])):
+                tgt_ext = tgt_ext._replace(response=json.dumps(
+                    json.loads(tgt_ext['response'])[0]).encode('utf8'))
         if tgt_ext['status'] != FreeNASServer.STATUS_OK:
             msg = ('Error while creating relation between '
                    'target and extent: %s' % tgt_ext['response'])
             raise FreeNASApiError('Unexpected error', msg)
 
+        tgt_ext_id = json.loads(tgt_ext['response'])['id']
+        if name:
+            self.inventory.update(name, targetextent=tgt_ext_id)
+        return tgt_ext_id
+
     def _create_target(self, name):
         # v2.0 API - targetgroup can now be added when target is created
         targetgroup_params = [{}]
@@ -143,6 +725,9 @@ class TrueNASCommon(object):
         # TODO: Decide to create initiator or not
         targetgroup_params[0]['initiator'] = int(
             self.configuration.ixsystems_initiator_id)
+        if self.configuration.ixsystems_initiator_groups:
+            # Hosts are allowed one by one as volumes are attached.
+            targetgroup_params = []
         tgt_params = {}
         tgt_params['name'] = name
         tgt_params['groups'] = targetgroup_params
@@ -150,22 +735,27 @@ class TrueNASCommon(object):
         jtgt_params = jtgt_params.encode('utf8')
         LOG.debug('_create_target params : %s', json.dumps(tgt_params))
         request_urn = ('%s/') % (FreeNASServer.REST_API_TARGET)
-        target = self.handle.invoke_command(FreeNASServer.CREATE_COMMAND,
-                                            request_urn, jtgt_params)
+        target = self._invoke_create(request_urn, jtgt_params)
         LOG.debug('_create_target response : %s', json.dumps(target))
 
-        if target['status'] != FreeNASServer.STATUS_OK:
+        if self._already_exists(target):
+            target_id = self.get_iscsitarget_id(name)
+        elif target['status'] != FreeNASServer.STATUS_OK:
+            target_id = 0
+        else:
+            target_id = json.loads(target['response'])['id']
+        if not target_id:
             msg = ('Error while creating iscsi target: {}'.format(
                 target['response']))
             raise FreeNASApiError('Unexpected error', msg)
-
-        target_id = json.loads(target['response'])['id']
         # self._create_target_group(target_id)
+        self.inventory.update(name, target=target_id)
 
         return target_id
 
-    def _create_extent(self, name, volume_name, from_snapshot=False):
-        ext_params = {}
+    def _create_extent(self, name, volume_name, from_snapshot=False,
+                       properties=None):
+        ext_params = dict(properties or {})
         if from_snapshot:
             ext_params['Source'] = volume_name
         else:
@@ -177,98 +767,641 @@ class TrueNASCommon(object):
         LOG.debug('_create_extent params : %s', jext_params)
         jext_params = jext_params.encode('utf8')
         request_urn = ('%s/') % (FreeNASServer.REST_API_EXTENT)
-        extent = self.handle.invoke_command(FreeNASServer.CREATE_COMMAND,
-                                            request_urn, jext_params)
+        extent = self._invoke_create(request_urn, jext_params)
 
         LOG.debug('_create_extent response : %s', json.dumps(extent))
 
-        if extent['status'] != FreeNASServer.STATUS_OK:
+        if self._already_exists(extent) and not from_snapshot:
+            extent_id = self.get_extent_id(name)
+        elif extent['status'] != FreeNASServer.STATUS_OK:
+            extent_id = 0
+        else:
+            extent_id = json.loads(extent['response'])['id']
+        if not extent_id:
             msg = ('Error while creating iscsi target extent: {}'.format(
                 extent['response']))
             raise FreeNASApiError('Unexpected error', msg)
+        self.inventory.update(name, extent=extent_id)
+        return extent_id
 
-        return json.loads(extent['response'])['id']
-
-    def get_iscsitarget_id(self, name):
-        """get iscsi target id from target name."""
+    def _query_id(self, request_urn, field, value, errmsg):
+        """Returns id of the row whose field equals value, 0 if none.
 
-        request_urn = ('%s') % (FreeNASServer.REST_API_TARGET)
-        LOG.debug('get_iscsitarget_id request_urn : %s', request_urn)
-        ret = self.handle.invoke_command(FreeNASServer.SELECT_COMMAND,
-                                         request_urn, None)
-        LOG.debug('get_iscsitarget_id response : %s', json.dumps(ret))
+           The filter is evaluated by TrueNAS so only the matching row is
+           returned, no matter how large the collection is.
+        """
+        ret = self.handle.query(request_urn, [(field, '=', value)],
+                                {'limit': 1, 'select': ['id', field]})
+        LOG.debug('_query_id %s response : %s', request_urn, json.dumps(ret))
         if ret['status'] != FreeNASServer.STATUS_OK:
-            msg = ('Error while deleting iscsi target: %s' % ret['response'])
+            msg = ('%s: %s' % (errmsg, ret['response']))
             raise FreeNASApiError('Unexpected error', msg)
 
-        uresp = ret['response']
-        resp = json.loads(uresp.decode('utf8'))
-        try:
-            return (item for item in resp
-                    if item['name'] == name).__next__()['id']
-        except StopIteration:
+        resp = json.loads(ret['response'].decode('utf8'))
+        if not resp:
             return 0
+        return resp[0]['id']
 
-    def get_tgt_ext_id(self, name):
-        """Get target-extent mapping id from target name."""
+    def get_iscsitarget_id(self, name):
+        """get iscsi target id from target name."""
 
-        request_urn = ('%s') % (FreeNASServer.REST_API_TARGET_TO_EXTENT)
-        LOG.debug('get_tgt_ext_id urn : %s', request_urn)
-        ret = self.handle.invoke_command(FreeNASServer.SELECT_COMMAND,
-                                         request_urn, None)
-        LOG.debug('get_tgt_ext_id response : %s', json.dumps(ret))
-        if ret['status'] != FreeNASServer.STATUS_OK:
-            msg = ('Error while deleting iscsi target: %s' % ret['response'])
-            raise FreeNASApiError('Unexpected error', msg)
+        LOG.debug('get_iscsitarget_id name : %s', name)
+        return self._query_id(FreeNASServer.REST_API_TARGET, 'name', name,
+                              'Error while getting iscsi target id')
 
-        uresp = ret['response']
-        resp = json.loads(uresp.decode('utf8'))
-        try:
-            return (item for item in resp
-                    if item['target'] == name).__next__()['id']
-        except StopIteration:
+    def get_tgt_ext_id(self, name, target_id=None):
+        """Get target-extent mapping id from target name."""
+
+        LOG.debug('get_tgt_ext_id name : %s', name)
+        if target_id is None:
+            target_id = self.get_iscsitarget_id(name)
+        if not target_id:
             return 0
+        return self._query_id(FreeNASServer.REST_API_TARGET_TO_EXTENT,
+                              'target', target_id,
+                              'Error while getting target-extent id')
 
     def get_extent_id(self, name):
         """Get Extent ID from Extent Name."""
 
-        request_urn = ('%s') % (FreeNASServer.REST_API_EXTENT)
-        LOG.debug('get_extent_id urn : %s', request_urn)
-        ret = self.handle.invoke_command(FreeNASServer.SELECT_COMMAND,
-                                         request_urn, None)
-        LOG.debug('get_extent_id response : %s', json.dumps(ret))
-        if ret['status'] != FreeNASServer.STATUS_OK:
-            msg = ('Error while getting extent id: %s' % ret['response'])
-            raise FreeNASApiError('Unexpected error', msg)
+        LOG.debug('get_extent_id name : %s', name)
+        return self._query_id(FreeNASServer.REST_API_EXTENT, 'name', name,
+                              'Error while getting extent id')
 
-        uresp = ret['response']
-        resp = json.loads(uresp.decode('utf8'))
+    def _get_extent_properties(self, extra_specs):
+        """Validates ixsystems: extent extra specs of a volume type.
+
+           Returns the iscsi.extent fields they set. Raises
+           InvalidVolumeType for values TrueNAS does not accept.
+        """
+        specs = ix_utils.get_ixsystems_specs(extra_specs)
+        properties = {}
         try:
-            return (item for item in resp
-                    if item['name'] == name).__next__()['id']
-        except StopIteration:
-            return 0
+            if 'blocksize' in specs:
+                size = ix_utils.parse_block_size(specs['blocksize'])
+                if size not in self.EXTENT_BLOCKSIZES:
+                    raise ValueError('blocksize must be one of 512, 1024, '
+                                     '2048 or 4096')
+                properties['blocksize'] = size
+            for spec in ('pblocksize', 'insecure_tpc', 'xen'):
+                if spec in specs:
+                    properties[spec] = ix_utils.parse_spec_bool(specs[spec])
+            if 'rpm' in specs:
+                rpm = specs['rpm'].upper()
+                if rpm not in self.EXTENT_RPMS:
+                    raise ValueError('rpm must be one of %s' %
+                                     ', '.join(self.EXTENT_RPMS))
+                properties['rpm'] = rpm
+            if 'avail_threshold' in specs:
+                threshold = int(specs['avail_threshold'])
+                if not 1 <= threshold <= 99:
+                    raise ValueError('avail_threshold must be from 1 to 99')
+                properties['avail_threshold'] = threshold
+        except ValueError as e:
+            raise exception.InvalidVolumeType(
+                reason=_('invalid ixsystems: extra spec, %s') % e)
+        LOG.debug('_get_extent_properties : %s', properties)
+        return properties
+
+    def _update_extent(self, name, properties, missing_ok=False):
+        """Sets attributes of the extent exporting target name.
+
+           With missing_ok, a target name that is not exported is skipped.
+        """
+        if not properties:
+            return
+        extent_id = self.get_extent_id(name)
+        if not extent_id and missing_ok:
+            LOG.debug('_update_extent %s is not exported', name)
+            return
+        if not extent_id:
+            msg = ('Extent of %s not found' % name)
+            raise FreeNASApiError('Unexpected error', msg)
+        request_urn = ('%s/id/%s') % (FreeNASServer.REST_API_EXTENT,
+                                      extent_id)
+        LOG.debug('_update_extent %s params : %s', name, properties)
+        ret = self.handle.invoke_command(
+            FreeNASServer.UPDATE_COMMAND, request_urn,
+            json.dumps(properties).encode('utf8'))
+        if ret['status'] != FreeNASServer.STATUS_OK:
+            msg = ('Error while updating iscsi extent: %s' % ret['response'])
+            raise FreeNASApiError('Unexpected error', msg)
 
-    def _create_iscsitarget(self, name, volume_name):
+    def _create_iscsitarget(self, name, volume_name, extent_properties=None):
         """Creates a iSCSI target on specified volume OR snapshot.
 
            TODO : Skipped part for snapshot, review once iscsi target working
            TODO: Add cleanup if any operation fails
         """
 
+        with self._flatten_lock:
+            if volume_name in self._flattening:
+                self._flattening[volume_name] = True
+        if self.configuration.ixsystems_export_mode == 'shared':
+            ext_id = self._create_extent(name, volume_name,
+                                         properties=extent_properties)
+            self._map_shared_lun(name, ext_id)
+            return
+
         # Create iscsi target for specified volume
         tgt_id = self._create_target(name)
 
         # Create extent for iscsi target for specified volume
-        ext_id = self._create_extent(name, volume_name)
+        ext_id = self._create_extent(name, volume_name,
+                                     properties=extent_properties)
 
         # Create target to extent mapping for specified volume
-        self._target_to_extent(tgt_id, ext_id)
+        self._target_to_extent(tgt_id, ext_id, name)
+
+    def _ensure_iscsitarget(self, name, volume_name, extent_properties=None):
+        """Creates the iSCSI objects of name unless they all exist.
+
+           Objects left over from a partial export are removed first.
+        """
+        with lockutils.lock('ixsystems-export-' + name):
+            ids, cached = self._get_iscsitarget_ids(name)
+            if self.configuration.ixsystems_export_mode == 'shared':
+                fields = ('extent', 'targetextent')
+            else:
+                fields = ISCSIInventory.FIELDS
+            if all(ids[field] for field in fields):
+                return
+            if any(ids[field] for field in ISCSIInventory.FIELDS):
+                LOG.debug('_ensure_iscsitarget partial export of %s: %s',
+                          name, ids)
+                self._delete_iscsitarget(name)
+            self._create_iscsitarget(name, volume_name, extent_properties)
+
+    def _remove_iscsitarget(self, name):
+        """Deletes the iSCSI objects of name, remembering they are gone."""
+        with lockutils.lock('ixsystems-export-' + name):
+            self._delete_iscsitarget(name)
+            self.inventory.update(name, target=0, extent=0, targetextent=0)
+
+    def _find_igroup(self, name):
+        """Returns the initiator group named name, None if none exists."""
+        with self._igroups_lock:
+            igroup = self._igroups.get(name)
+        if igroup is not None:
+            return igroup
+        ret = self.handle.query(FreeNASServer.REST_API_INITIATOR,
+                                [('comment', '=', name)], {'limit': 1})
+        if ret['status'] != FreeNASServer.STATUS_OK:
+            msg = ('Error while getting initiator group: %s' %
+                   ret['response'])
+            raise FreeNASApiError('Unexpected error', msg)
+        igroups = json.loads(ret['response'].decode('utf8'))
+        if not igroups:
+            return None
+        with self._igroups_lock:
+            self._igroups[name] = igroups[0]
+        return igroups[0]
+
+    def _get_igroup(self, host, initiator):
+        """Returns the initiator group id of host, created on demand.
+
+           The group is named IGROUP_PREFIX plus host in its comment, and
+           initiator is added to it if missing. Callers hold the igroup
+           lock of host, so the group is not garbage collected meanwhile.
+        """
+        name = self.IGROUP_PREFIX + host
+        igroup = self._find_igroup(name)
+        if igroup is None:
+            LOG.info('Creating initiator group %s', name)
+            request_urn = ('%s/') % (FreeNASServer.REST_API_INITIATOR)
+            params = {'initiators': [initiator], 'comment': name}
+            ret = self.handle.invoke_command(
+                FreeNASServer.CREATE_COMMAND, request_urn,
+                json.dumps(params).encode('utf8'))
+            if ret['status'] != FreeNASServer.STATUS_OK:
+                msg = ('Error while creating initiator group: %s' %
+                       ret['response'])
+                raise FreeNASApiError('Unexpected error', msg)
+            igroup = json.loads(ret['response'].decode('utf8'))
+        elif initiator not in igroup['initiators']:
+            request_urn = ('%s/id/%s') % (
+                FreeNASServer.REST_API_INITIATOR, igroup['id'])
+            params = {'initiators': igroup['initiators'] + [initiator]}
+            ret = self.handle.invoke_command(
+                FreeNASServer.UPDATE_COMMAND, request_urn,
+                json.dumps(params).encode('utf8'))
+            if ret['status'] != FreeNASServer.STATUS_OK:
+                msg = ('Error while updating initiator group: %s' %
+                       ret['response'])
+                raise FreeNASApiError('Unexpected error', msg)
+            igroup = json.loads(ret['response'].decode('utf8'))
+        with self._igroups_lock:
+            self._igroups[name] = igroup
+        return igroup['id']
+
+    def _update_target_groups(self, target_id, igroup_id, allow):
+        """Adds or removes igroup_id in the groups of target_id."""
+        with lockutils.lock('ixsystems-target-%s' % target_id):
+            request_urn = ('%s/id/%s') % (FreeNASServer.REST_API_TARGET,
+                                          target_id)
+            ret = self.handle.invoke_command(FreeNASServer.SELECT_COMMAND,
+                                             request_urn, None)
+            if ret['status'] != FreeNASServer.STATUS_OK:
+                msg = ('Error while getting iscsi target: %s' %
+                       ret['response'])
+                raise FreeNASApiError('Unexpected error', msg)
+            groups = json.loads(ret['response'].decode('utf8'))['groups']
+            others = [group for group in groups
+                      if group.get('initiator') != igroup_id]
+            if allow:
+                if len(others) < len(groups):
+                    return
+                others.append({'portal': int(
+                    self.configuration.ixsystems_portal_id),
+                    'initiator': igroup_id})
+            elif len(others) == len(groups):
+                return
+            LOG.debug('_update_target_groups %s : %s', target_id, others)
+            ret = self.handle.invoke_command(
+                FreeNASServer.UPDATE_COMMAND, request_urn,
+                json.dumps({'groups': others}).encode('utf8'))
+            if ret['status'] != FreeNASServer.STATUS_OK:
+                msg = ('Error while updating iscsi target: %s' %
+                       ret['response'])
+                raise FreeNASApiError('Unexpected error', msg)
+
+    def _get_export_target_id(self, name):
+        """Returns the id of the iSCSI target exporting target name."""
+        if self.configuration.ixsystems_export_mode == 'shared':
+            self._get_export(name)
+            return self.inventory.get(name, ('lun_target',))['lun_target']
+        ids, cached = self._get_iscsitarget_ids(name, ('target',))
+        return ids['target']
+
+    def _allow_host(self, name, host, initiator):
+        """Allows the initiator group of host on the target of name."""
+        target_id = self._get_export_target_id(name)
+        # Held until the reference is recorded, so _gc_igroup can not
+        # delete the group in between.
+        with lockutils.lock('ixsystems-igroup-' + self.IGROUP_PREFIX + host):
+            igroup_id = self._get_igroup(host, initiator)
+            self._update_target_groups(target_id, igroup_id, True)
+            with self._igroups_lock:
+                self._igroup_refs.setdefault(igroup_id, set()).add(target_id)
+
+    def _disallow_host(self, name, host, initiator):
+        """Removes host from the target of name once it uses no LUN there.
+
+           The initiator group of host is deleted when no target allows
+           it any more.
+        """
+        igroup = self._find_igroup(self.IGROUP_PREFIX + host)
+        if igroup is None:
+            return
+        igroup_id = igroup['id']
+        target_id = self._get_export_target_id(name)
+        if not target_id:
+            return
+        if self.configuration.ixsystems_export_mode == 'shared':
+            for other in self.attachments.targets_of(initiator):
+                ids = self.inventory.get(other, ('lun_target',))
+                if ids is not None and ids['lun_target'] == target_id:
+                    # Another volume of the host is on this target.
+                    return
+        self._update_target_groups(target_id, igroup_id, False)
+        with self._igroups_lock:
+            refs = self._igroup_refs.setdefault(igroup_id, set())
+            refs.discard(target_id)
+            if refs:
+                return
+        self._gc_igroup(host, igroup_id)
+
+    def _load_igroup_refs(self):
+        """Adds the targets allowing each initiator group on the array."""
+        ret = self.handle.query(FreeNASServer.REST_API_TARGET, None,
+                                {'select': ['id', 'groups']})
+        if ret['status'] != FreeNASServer.STATUS_OK:
+            msg = ('Error while listing iscsi targets: %s' %
+                   ret['response'])
+            raise FreeNASApiError('Unexpected error', msg)
+        with self._igroups_lock:
+            for target in json.loads(ret['response'].decode('utf8')):
+                for group in target.get('groups', []):
+                    if group.get('initiator'):
+                        self._igroup_refs.setdefault(
+                            group['initiator'], set()).add(target['id'])
+            self._igroup_refs_loaded = True
+
+    def _gc_igroup(self, host, igroup_id):
+        """Deletes the initiator group of host unless a target uses it."""
+        name = self.IGROUP_PREFIX + host
+        with lockutils.lock('ixsystems-igroup-' + name):
+            if not self._igroup_refs_loaded:
+                # Targets allowed before this process started are only
+                # known from the array, _warm_inventory usually loaded them.
+                try:
+                    self._load_igroup_refs()
+                except FreeNASApiError as e:
+                    LOG.warning('Not deleting initiator group %s: %s', name,
+                                e)
+                    return
+            with self._igroups_lock:
+                if self._igroup_refs.get(igroup_id):
+                    return
+            LOG.info('Deleting initiator group %s', name)
+            request_urn = ('%s/id/%s') % (FreeNASServer.REST_API_INITIATOR,
+                                          igroup_id)
+            ret = self.handle.invoke_command(FreeNASServer.DELETE_COMMAND,
+                                             request_urn, None)
+            if (ret['status'] != FreeNASServer.STATUS_OK and
+                    ret['code'] != 404):
+                msg = ('Error while deleting initiator group: %s' %
+                       ret['response'])
+                raise FreeNASApiError('Unexpected error', msg)
+            with self._igroups_lock:
+                self._igroups.pop(name, None)
+                self._igroup_refs.pop(igroup_id, None)
+
+    def _get_portals(self):
+        """Returns the 'ip:port' listen addresses of the iSCSI portal.
+
+           They are cached like the capabilities. Wildcard addresses are
+           replaced with ixsystems_server_hostname, which is also the
+           only portal returned if the portal cannot be read.
+        """
+        ttl = self.configuration.ixsystems_capabilities_ttl
+        port = self.configuration.ixsystems_server_iscsi_port
+        hostname = self.configuration.ixsystems_server_hostname
+        with self._portals_lock:
+            if self._portals and time.time() - self._portals[1] < ttl:
+                return self._portals[0]
+        request_urn = ('%s/id/%s') % (FreeNASServer.REST_API_PORTAL,
+                                      self.configuration.ixsystems_portal_id)
+        ret = self.handle.invoke_command(FreeNASServer.SELECT_COMMAND,
+                                         request_urn, None)
+        if ret['status'] != FreeNASServer.STATUS_OK:
+            LOG.warning('Error while getting iscsi portal: %s',
+                        ret['response'])
+            return [ix_utils.get_iscsi_portal(hostname, port)]
+        portals = []
+        for listen in json.loads(ret['response'].decode('utf8'))['listen']:
+            ip = listen['ip']
+            if ip in ('0.0.0.0', '::'):
+                ip = hostname
+            elif ':' in ip:
+                ip = '[%s]' % ip
+            portal = ix_utils.get_iscsi_portal(ip, listen.get('port', port))
+            if portal not in portals:
+                portals.append(portal)
+        if not portals:
+            portals = [ix_utils.get_iscsi_portal(hostname, port)]
+        LOG.debug('_get_portals : %s', portals)
+        with self._portals_lock:
+            self._portals = (portals, time.time())
+        return portals
+
+    def _select_portal(self, target, initiator):
+        """Picks the portal of a single path attach of target."""
+        selection = self.configuration.ixsystems_portal_selection
+        if selection == 'hostname':
+            return ix_utils.get_iscsi_portal(
+                self.configuration.ixsystems_server_hostname,
+                self.configuration.ixsystems_server_iscsi_port)
+        portals = self._get_portals()
+        with self._portals_lock:
+            portal = self._portal_choices.get((target, initiator))
+            if portal in portals:
+                return portal
+            if selection == 'least_loaded':
+                portal = min(portals, key=lambda p: self._portal_load[p])
+            else:
+                portal = portals[self._portal_turn % len(portals)]
+                self._portal_turn += 1
+            self._portal_load[portal] += 1
+            self._portal_choices[(target, initiator)] = portal
+        return portal
+
+    def _release_portal(self, target, initiator=None):
+        """Forgets the portal of target, for all initiators if None."""
+        with self._portals_lock:
+            for key in [key for key in self._portal_choices
+                        if key[0] == target and
+                        initiator in (None, key[1])]:
+                portal = self._portal_choices.pop(key)
+                self._portal_load[portal] -= 1
+
+    def _get_shared_target(self, index):
+        """Returns the id of shared target index, creating it if needed."""
+        name = '%s%d' % (self.SHARED_TARGET_PREFIX, index)
+        with self._shared_targets_lock:
+            if name not in self._shared_targets:
+                target_id = self.get_iscsitarget_id(name)
+                if not target_id:
+                    LOG.info('Creating shared iSCSI target %s', name)
+                    target_id = self._create_target(name)
+                self._shared_targets[name] = target_id
+                self._shared_targets[target_id] = name
+            target_id = self._shared_targets[name]
+        if not self.luns.is_loaded(target_id):
+            ret = self.handle.query(FreeNASServer.REST_API_TARGET_TO_EXTENT,
+                                    [('target', '=', target_id)],
+                                    {'select': ['lunid']})
+            if ret['status'] != FreeNASServer.STATUS_OK:
+                msg = ('Error while listing LUNs of %s: %s' %
+                       (name, ret['response']))
+                raise FreeNASApiError('Unexpected error', msg)
+            self.luns.load(target_id, [
+                item['lunid'] for item in
+                json.loads(ret['response'].decode('utf8'))])
+        return target_id
+
+    def _map_shared_lun(self, name, extent_id):
+        """Maps extent_id as a LUN of a shared target.
+
+           Volumes are spread over the shared targets by a hash of their
+           name, moving on to the next target when one is full.
+        """
+        count = self.configuration.ixsystems_shared_targets
+        first = zlib.crc32(name.encode('utf8')) % count
+        for offset in range(count):
+            target_id = self._get_shared_target((first + offset) % count)
+            lunid = self.luns.allocate(target_id)
+            if lunid is None:
+                continue
+            try:
+                tgt_ext_id = self._target_to_extent(target_id, extent_id,
+                                                    name, lunid)
+            except FreeNASApiError:
+                # The id may have been taken outside of this process,
+                # reload the target's LUNs before the next allocation.
+                self.luns.forget(target_id)
+                raise
+            self.inventory.update(name, target=0, extent=extent_id,
+                                  targetextent=tgt_ext_id, lun=lunid,
+                                  lun_target=target_id)
+            return target_id, lunid
+        msg = ('All %d shared iSCSI targets are full' % count)
+        raise FreeNASApiError('LUN limit reached', msg)
+
+    def _get_export(self, name):
+        """Returns the IQN and LUN that export target name."""
+        if self.configuration.ixsystems_export_mode != 'shared':
+            return {'iqn': self.configuration.ixsystems_iqn_prefix + name,
+                    'lun': 0}
+        ids = self.inventory.get(name, ('lun', 'lun_target'))
+        if ids is None:
+            extent_id = self.get_extent_id(name)
+            ret = self.handle.query(FreeNASServer.REST_API_TARGET_TO_EXTENT,
+                                    [('extent', '=', extent_id)],
+                                    {'limit': 1})
+            if ret['status'] != FreeNASServer.STATUS_OK:
+                msg = ('Error while getting LUN of %s: %s' %
+                       (name, ret['response']))
+                raise FreeNASApiError('Unexpected error', msg)
+            mappings = json.loads(ret['response'].decode('utf8'))
+            if not extent_id or not mappings:
+                msg = ('No LUN is mapped for %s' % name)
+                raise FreeNASApiError('Unexpected error', msg)
+            ids = {'target': 0, 'extent': extent_id,
+                   'targetextent': mappings[0]['id'],
+                   'lun': mappings[0]['lunid'],
+                   'lun_target': mappings[0]['target']}
+            self.inventory.update(name, **ids)
+        target_name = self._get_target_name(ids['lun_target'])
+        return {'iqn': self.configuration.ixsystems_iqn_prefix + target_name,
+                'lun': ids['lun']}
+
+    def _get_target_name(self, target_id):
+        """Returns the name of a shared target from its id."""
+        with self._shared_targets_lock:
+            if target_id in self._shared_targets:
+                return self._shared_targets[target_id]
+        request_urn = ('%s/id/%s') % (FreeNASServer.REST_API_TARGET,
+                                      target_id)
+        ret = self.handle.invoke_command(FreeNASServer.SELECT_COMMAND,
+                                         request_urn, None)
+        if ret['status'] != FreeNASServer.STATUS_OK:
+            msg = ('Error while getting iscsi target: %s' % ret['response'])
+            raise FreeNASApiError('Unexpected error', msg)
+        name = json.loads(ret['response'].decode('utf8'))['name']
+        with self._shared_targets_lock:
+            self._shared_targets[name] = target_id
+            self._shared_targets[target_id] = name
+        return name
+
+    def _warm_inventory(self):
+        """Fills the iSCSI inventory with one listing per object type."""
+        def _list(request_urn):
+            ret = self.handle.invoke_command(FreeNASServer.SELECT_COMMAND,
+                                             request_urn, None)
+            if ret['status'] != FreeNASServer.STATUS_OK:
+                msg = ('Error while listing %s: %s' % (request_urn,
+                                                      ret['response']))
+                raise FreeNASApiError('Unexpected error', msg)
+            return json.loads(ret['response'].decode('utf8'))
+
+        targets, extents, tgt_exts = self._fan_out(
+            (_list, FreeNASServer.REST_API_TARGET),
+            (_list, FreeNASServer.REST_API_EXTENT),
+            (_list, FreeNASServer.REST_API_TARGET_TO_EXTENT))
+
+        target_ids = dict((item['name'], item['id']) for item in targets)
+        igroup_refs = {}
+        for item in targets:
+            for group in item.get('groups', []):
+                if group.get('initiator'):
+                    igroup_refs.setdefault(group['initiator'],
+                                           set()).add(item['id'])
+        with self._igroups_lock:
+            self._igroup_refs = igroup_refs
+            self._igroup_refs_loaded = True
+        mappings = dict((item['extent'], item) for item in tgt_exts)
+        index = {}
+        for item in extents:
+            mapping = mappings.get(item['id'], {})
+            index[item['name']] = {
+                'target': target_ids.get(item['name'], 0),
+                'extent': item['id'],
+                'targetextent': mapping.get('id', 0)}
+            if mapping.get('target') not in (None, index[item['name']]
+                                             ['target']):
+                # Mapped as a LUN of a shared target.
+                index[item['name']]['lun'] = mapping['lunid']
+                index[item['name']]['lun_target'] = mapping['target']
+        for name, target_id in target_ids.items():
+            index.setdefault(name, {'target': target_id, 'extent': 0,
+                                    'targetextent': 0})
+        self.inventory.replace(index)
+        lunids = {}
+        for item in tgt_exts:
+            lunids.setdefault(item['target'], []).append(item['lunid'])
+        self.luns.forget()
+        for target_id, ids in lunids.items():
+            self.luns.load(target_id, ids)
+        LOG.debug('_warm_inventory indexed %s targets', len(index))
+
+    def _fan_out(self, *calls):
+        """Runs independent calls on the worker pool.
+
+           Each call is a tuple of a callable and its arguments. Returns
+           the results in order, or raises the first error in order once
+           all calls have finished.
+        """
+        pending = [self.executor.submit(
+            freenasapi.inherit_call_priority(call[0]), *call[1:])
+            for call in calls]
+        futures.wait(pending)
+        return [future.result() for future in pending]
+
+    def _refresh_iscsitarget_ids(self, name, fields=ISCSIInventory.FIELDS):
+        """Looks up the iSCSI ids of name on TrueNAS and indexes them.
+
+           Target and extent are looked up concurrently. The mapping lookup
+           needs the target id, so it is chained after the target lookup
+           and skipped unless 'targetextent' is in fields.
+        """
+        def _target_ids():
+            target_id = self.get_iscsitarget_id(name)
+            ids = {'target': target_id}
+            if 'targetextent' in fields:
+                ids['targetextent'] = self.get_tgt_ext_id(name, target_id)
+            return ids
+
+        ids, extent_id = self._fan_out((_target_ids,),
+                                       (self.get_extent_id, name))
+        ids['extent'] = extent_id
+        self.inventory.update(name, **ids)
+        return ids
+
+    def _get_iscsitarget_ids(self, name, fields=ISCSIInventory.FIELDS):
+        """Returns (ids, cached) for the iSCSI objects of name."""
+        ids = self.inventory.get(name, fields)
+        if ids is not None:
+            return ids, True
+        return self._refresh_iscsitarget_ids(name, fields), False
+
+    def _sync_attachments(self):
+        """Counts attached export targets from live iSCSI sessions."""
+        if self.configuration.ixsystems_export_mode == 'shared':
+            # Sessions name the shared targets, not the volumes attached
+            # through them, attaches are counted in-process only.
+            return
+        request_urn = '/iscsi/global/sessions'
+        ret = self.handle.invoke_command(FreeNASServer.SELECT_COMMAND,
+                                         request_urn, None)
+        if ret['status'] != FreeNASServer.STATUS_OK:
+            msg = ('Error while getting iscsi sessions: %s' %
+                   ret['response'])
+            raise FreeNASApiError('Unexpected error', msg)
+        prefix = self.configuration.ixsystems_iqn_prefix
+        attached = {}
+        for item in json.loads(ret['response'].decode('utf8')):
+            if item.get('target', '').startswith(prefix):
+                attached.setdefault(item['target'][len(prefix):],
+                                    set()).add(item.get('initiator'))
+        self.attachments.resync(attached)
+        LOG.debug('_sync_attachments %s targets attached', len(attached))
 
     def delete_target_to_extent(self, tgt_ext_id):
         pass
 
     def delete_target(self, target_id):
+        """Deletes iscsi target, returns False if it was not found."""
         if target_id:
             request_urn = ('%s/id/%s') % (
                 FreeNASServer.REST_API_TARGET, target_id)
@@ -276,12 +1409,16 @@ class TrueNASCommon(object):
             ret = self.handle.invoke_command(FreeNASServer.DELETE_COMMAND,
                                              request_urn, None)
             LOG.debug('delete_target response : %s', json.dumps(ret))
-            if ret['status'] != FreeNASServer.STATUS_OK:
+            if ret['status'] == 'error' and ret['code'] == 404:
+                return False
+            elif ret['status'] != FreeNASServer.STATUS_OK:
                 msg = (
                     'Error while deleting iscsi target: %s' % ret['response'])
                 raise FreeNASApiError('Unexpected error', msg)
+        return True
 
     def delete_extent(self, extent_id):
+        """Deletes iscsi extent, returns False if it was not found."""
         if extent_id:
             request_urn = ('%s/id/%s') % (
                 FreeNASServer.REST_API_EXTENT, extent_id)
@@ -289,20 +1426,44 @@ class TrueNASCommon(object):
             ret = self.handle.invoke_command(FreeNASServer.DELETE_COMMAND,
                                              request_urn, None)
             LOG.debug('delete_extent response : %s', json.dumps(ret))
-            if ret['status'] != FreeNASServer.STATUS_OK:
+            if ret['status'] == 'error' and ret['code'] == 404:
+                return False
+            elif ret['status'] != FreeNASServer.STATUS_OK:
                 msg = (
                     'Error while deleting iscsi extent: %s' % ret['response'])
                 raise FreeNASApiError('Unexpected error', msg)
+        return True
+
+    def _delete_iscsitarget_ids(self, ids):
+        """Deletes iSCSI objects by id, returns False if any was missing.
+
+           TrueNAS drops the target-extent mapping together with either
+           its target or its extent. Deleting both at once would race on
+           removing that mapping, so the extent is deleted only after the
+           target is gone.
+        """
+        found = self.delete_target(ids['target'])
+        return self.delete_extent(ids['extent']) and found
 
     def _delete_iscsitarget(self, name):
         """Deletes specified iSCSI target."""
-        tgt_ext_id = self.get_tgt_ext_id(name)
-        target_id = self.get_iscsitarget_id(name)
-        extent_id = self.get_extent_id(name)
-
-        self.delete_target_to_extent(tgt_ext_id)
-        self.delete_target(target_id)
-        self.delete_extent(extent_id)
+        fields = ('target', 'extent')
+        lun = None
+        if self.configuration.ixsystems_export_mode == 'shared':
+            lun = self.inventory.get(name, ('lun', 'lun_target'))
+        ids, cached = self._get_iscsitarget_ids(name, fields)
+        if not self._delete_iscsitarget_ids(ids) and cached:
+            # Indexed ids went stale, objects were changed outside of
+            # this driver. Look name up again and delete what is there.
+            LOG.debug('_delete_iscsitarget stale inventory for %s', name)
+            self._delete_iscsitarget_ids(
+                self._refresh_iscsitarget_ids(name, fields))
+        self.inventory.remove(name)
+        if lun is not None:
+            self.luns.release(lun['lun_target'], lun['lun'])
+        elif self.configuration.ixsystems_export_mode == 'shared':
+            # The LUN freed with the extent is unknown, reload them all.
+            self.luns.forget()
 
     def _dependent_clone(self, name):
         """returns the fullname of snapshot used to create volume 'name'."""
@@ -332,8 +1493,8 @@ class TrueNASCommon(object):
         LOG.debug('_delete_volume urn : %s', request_urn)
         # add check for dependent clone, if exists will delete
         clone = self._dependent_clone(name)
-        ret = self.handle.invoke_command(FreeNASServer.DELETE_COMMAND,
-                                         request_urn, None)
+        ret = self.handle.jobs.invoke(FreeNASServer.DELETE_COMMAND,
+                                      request_urn, None, 'delete')
         LOG.debug('_delete_volume response : %s', json.dumps(ret))
 
         # delete the cloned-from snapshot.
@@ -353,6 +1514,64 @@ class TrueNASCommon(object):
             msg = ('Error while deleting volume: %s' % ret['response'])
             raise FreeNASApiError('Unexpected error', msg)
 
+    def _defer_delete_volume(self, name):
+        """Queues name to be destroyed once its dependents are gone."""
+        LOG.info('Deferring delete of %s until its clones are deleted', name)
+        self.deferred_deletes.add(name)
+
+    @freenasapi.with_call_priority(freenasapi.PRIORITY_LOW)
+    def _reap_volume(self, name):
+        """Tries to destroy a deferred volume, returns True once gone."""
+        request_urn = ('%s/id/%s') % (
+            FreeNASServer.REST_API_VOLUME,
+            urllib.parse.quote_plus(
+                self.configuration.ixsystems_dataset_path + '/' + name))
+        try:
+            ret = self.handle.invoke_command(FreeNASServer.SELECT_COMMAND,
+                                             request_urn, None)
+            if ret['status'] == 'error' and ret['code'] == 404:
+                LOG.info('Deferred delete of %s: already gone', name)
+            else:
+                self._delete_volume(name)
+                LOG.info('Deferred delete of %s done', name)
+        except exception.VolumeIsBusy:
+            self.deferred_deletes.tried(name)
+            return False
+        except Exception as e:
+            LOG.warning('Deferred delete of %s failed: %s', name, e)
+            self.deferred_deletes.tried(name)
+            return False
+        self.deferred_deletes.remove(name)
+        return True
+
+    def _reap_deferred_deletes(self):
+        """Destroys a batch of deferred volumes with bounded concurrency."""
+        names = self.deferred_deletes.due(
+            self.configuration.ixsystems_reaper_batch)
+        if not names:
+            return
+        try:
+            with futures.ThreadPoolExecutor(
+                    max_workers=self.configuration.ixsystems_reaper_workers
+            ) as pool:
+                reaped = sum(pool.map(self._reap_volume, names))
+        except Exception as e:
+            LOG.warning('Failed to reap deferred deletes: %s', e)
+            return
+        LOG.debug('_reap_deferred_deletes reaped %s of %s, %s queued',
+                  reaped, len(names), len(self.deferred_deletes))
+
+    def _start_deferred_reaper(self):
+        """Starts destroying deferred volumes in the background."""
+        if (not self.configuration.ixsystems_deferred_delete or
+                self._deferred_reaper):
+            return
+        self._deferred_reaper = loopingcall.FixedIntervalLoopingCall(
+            self._reap_deferred_deletes)
+        self._deferred_reaper.start(
+            interval=self.configuration.ixsystems_reaper_interval,
+            initial_delay=self.configuration.ixsystems_reaper_interval)
+
     def _create_snapshot(self, name, volume_name):
         """Creates a snapshot of specified volume."""
         args = {}
@@ -365,8 +1584,10 @@ class TrueNASCommon(object):
         LOG.debug('_create_snapshot urn : %s', request_urn)
 
         try:
-            ret = self.handle.invoke_command(FreeNASServer.CREATE_COMMAND,
-                                             request_urn, jargs)
+            # Waits for _flatten_volume to swap in a copy of volume_name.
+            with lockutils.lock('ixsystems-volume-' + volume_name):
+                ret = self.handle.jobs.invoke(FreeNASServer.CREATE_COMMAND,
+                                              request_urn, jargs, 'snapshot')
             LOG.debug('_create_snapshot response : %s', json.dumps(ret))
             if ret['status'] != FreeNASServer.STATUS_OK:
                 msg = ('Error while creating snapshot: %s' % ret['response'])
@@ -374,6 +1595,84 @@ class TrueNASCommon(object):
         except Exception as e:
             raise FreeNASApiError('Unexpected error', e)
 
+    def _create_group_snapshot(self, name, volume_names):
+        """Snapshots volume_names atomically, all with snapshot name.
+
+           One recursive snapshot of the dataset excludes every dataset
+           outside of the group, so ZFS takes all member snapshots in a
+           single transaction group. The middleware snapshots one dataset
+           tree per call, so the exclusions can not be avoided. Snapshots
+           this leaves on the dataset itself, and on datasets created
+           after the listing, are deleted afterwards.
+        """
+        path = self.configuration.ixsystems_dataset_path
+        members = set('%s/%s' % (path, volume_name)
+                      for volume_name in volume_names)
+        ret = self.handle.query(FreeNASServer.REST_API_VOLUME,
+                                [('name', '^', path + '/')],
+                                {'select': ['name']})
+        if ret['status'] != FreeNASServer.STATUS_OK:
+            msg = ('Error while listing volumes: %s' % ret['response'])
+            raise FreeNASApiError('Unexpected error', msg)
+        exclude = sorted(item['name'] for item in
+                         json.loads(ret['response'].decode('utf8'))
+                         if item['name'] not in members)
+        args = {'dataset': path, 'name': name, 'recursive': True,
+                'exclude': exclude}
+        request_urn = ('%s') % (FreeNASServer.REST_API_SNAPSHOT)
+        LOG.debug('_create_group_snapshot %s of %s, excluding %s',
+                  name, ', '.join(sorted(members)), len(exclude))
+        ret = self.handle.jobs.invoke(FreeNASServer.CREATE_COMMAND,
+                                      request_urn,
+                                      json.dumps(args).encode('utf8'),
+                                      'snapshot')
+        LOG.debug('_create_group_snapshot response : %s', json.dumps(ret))
+        if ret['status'] != FreeNASServer.STATUS_OK:
+            msg = ('Error while creating group snapshot: %s' %
+                   ret['response'])
+            raise FreeNASApiError('Unexpected error', msg)
+        request_urn = ('%s/id/%s@%s') % (FreeNASServer.REST_API_SNAPSHOT,
+                                         urllib.parse.quote_plus(path), name)
+        ret = self.handle.jobs.invoke(FreeNASServer.DELETE_COMMAND,
+                                      request_urn, None, 'snapshot')
+        if ret['status'] != FreeNASServer.STATUS_OK:
+            LOG.warning('Failed to delete snapshot %s@%s: %s', path, name,
+                        ret['response'])
+        self._delete_stray_group_snapshots(name, members)
+
+    def _delete_stray_group_snapshots(self, name, members):
+        """Deletes group snapshot name from datasets outside members.
+
+           A dataset created between the listing and the snapshot is not
+           excluded, its snapshot would keep it from being deleted.
+        """
+        path = self.configuration.ixsystems_dataset_path
+        ret = self.handle.query(FreeNASServer.REST_API_SNAPSHOT,
+                                [('snapshot_name', '=', name),
+                                 ('name', '^', path + '/')],
+                                {'select': ['name', 'dataset']})
+        if ret['status'] != FreeNASServer.STATUS_OK:
+            LOG.warning('Failed to list snapshots %s: %s', name,
+                        ret['response'])
+            return
+        strays = [item['dataset'][len(path) + 1:] for item in
+                  json.loads(ret['response'].decode('utf8'))
+                  if item['dataset'] not in members]
+        if not strays:
+            return
+        LOG.info('Deleting snapshot %s of datasets outside of the group: %s',
+                 name, ', '.join(strays))
+        try:
+            self._fan_out(*[(self._delete_snapshot, name, stray)
+                            for stray in strays])
+        except Exception as e:
+            LOG.warning('Failed to delete snapshots %s: %s', name, e)
+
+    def _delete_group_snapshot(self, name, volume_names):
+        """Deletes the member snapshots of a group snapshot."""
+        self._fan_out(*[(self._delete_snapshot, name, volume_name)
+                        for volume_name in volume_names])
+
     def _delete_snapshot(self, name, volume_name):
         """Delets a snapshot of specified volume."""
         LOG.debug('_delete_snapshot, deleting name: %s from volume: %s',
@@ -396,11 +1695,21 @@ class TrueNASCommon(object):
         except Exception as e:
             raise FreeNASApiError('Unexpected error', e)
         try:
-            ret = self.handle.invoke_command(FreeNASServer.DELETE_COMMAND,
-                                             request_urn, None)
+            ret = self.handle.jobs.invoke(FreeNASServer.DELETE_COMMAND,
+                                          request_urn, None, 'snapshot')
             LOG.debug('_delete_snapshot delete response : %s', json.dumps(ret))
             # When deleting volume with dependent snapsnot clone, 422 error triggered. Throw VolumeIsBusy exception ensures
             # upper stream cinder manager mark volume status available instead of error-deleting.
+            if (ret['status'] == 'error' and ret['code'] == 422 and
+                    self.configuration.ixsystems_deferred_delete):
+                # Let ZFS destroy the snapshot once its clones are gone.
+                LOG.info('Deferring destroy of snapshot %s of %s', name,
+                         volume_name)
+                ret = self.handle.jobs.invoke(
+                    FreeNASServer.DELETE_COMMAND, request_urn,
+                    json.dumps({'defer': True}).encode('utf8'), 'snapshot')
+                LOG.debug('_delete_snapshot deferred delete response : %s',
+                          json.dumps(ret))
             if ret['status'] == 'error' and ret['code'] == 422:
                 errorexception = exception.VolumeIsBusy(
                     _("Cannot delete volume when clone child volume or snapshot exists!"), volume_name=name)
@@ -412,6 +1721,56 @@ class TrueNASCommon(object):
             if not isinstance(e, exception.VolumeIsBusy):
                 raise FreeNASApiError('Unexpected error', e)
 
+    def _get_newer_snapshots(self, name, volume_name):
+        """Lists the snapshots of volume_name taken after snapshot name.
+
+           Snapshots are ordered by their creation transaction group.
+        """
+        dataset = self.configuration.ixsystems_dataset_path + '/' + volume_name
+        ret = self.handle.query(FreeNASServer.REST_API_SNAPSHOT,
+                                [('dataset', '=', dataset)],
+                                {'select': ['name', 'properties']})
+        if ret['status'] != FreeNASServer.STATUS_OK:
+            msg = ('Error while listing snapshots: %s' % ret['response'])
+            raise FreeNASApiError('Unexpected error', msg)
+        createtxg = {}
+        for item in json.loads(ret['response'].decode('utf8')):
+            createtxg[item['name']] = int(
+                item['properties']['createtxg']['value'])
+        snapshot = '%s@%s' % (dataset, name)
+        if snapshot not in createtxg:
+            msg = ('Snapshot %s not found' % snapshot)
+            raise FreeNASApiError('Unexpected error', msg)
+        return sorted(other for other, txg in createtxg.items()
+                      if txg > createtxg[snapshot])
+
+    def _rollback_snapshot(self, name, volume_name):
+        """Rolls volume_name back to its snapshot name.
+
+           Newer snapshots, and clones made from them, are never
+           destroyed. NotImplementedError is raised when there are any,
+           so Cinder falls back to its generic revert.
+        """
+        newer = self._get_newer_snapshots(name, volume_name)
+        if newer:
+            LOG.warning('Cannot roll %s back to %s, newer snapshots exist: '
+                        '%s', volume_name, name, ', '.join(newer))
+            raise NotImplementedError(
+                _('Snapshots newer than %(snapshot)s exist on %(volume)s') %
+                {'snapshot': name, 'volume': volume_name})
+        args = {'id': '%s/%s@%s' % (self.configuration.ixsystems_dataset_path,
+                                    volume_name, name),
+                'options': {}}
+        request_urn = ('%s/rollback') % (FreeNASServer.REST_API_SNAPSHOT)
+        LOG.debug('_rollback_snapshot urn : %s args : %s', request_urn, args)
+        ret = self.handle.invoke_command(FreeNASServer.CREATE_COMMAND,
+                                         request_urn,
+                                         json.dumps(args).encode('utf8'))
+        LOG.debug('_rollback_snapshot response : %s', json.dumps(ret))
+        if ret['status'] != FreeNASServer.STATUS_OK:
+            msg = ('Error while rolling back snapshot: %s' % ret['response'])
+            raise FreeNASApiError('Unexpected error', msg)
+
     def _create_volume_from_snapshot(self, name, snapshot_name,
                                      snap_zvol_name):
         """creates a volume from a snapshot"""
@@ -428,16 +1787,270 @@ class TrueNASCommon(object):
             FreeNASServer.REST_API_SNAPSHOT, FreeNASServer.CLONE)
         LOG.debug('_create_volume_from_snapshot urn : %s', request_urn)
         try:
-            ret = self.handle.invoke_command(FreeNASServer.CREATE_COMMAND,
-                                             request_urn, jargs)
+            # Wait for the clone to finish before the caller exports it.
+            ret = self._invoke_create(request_urn, jargs, 'clone')
             LOG.debug('_create_volume_from_snapshot response : %s',
                       json.dumps(ret))
-            if ret['status'] != FreeNASServer.STATUS_OK:
+            if self._already_exists(ret):
+                LOG.info('_create_volume_from_snapshot: %s already exists',
+                         name)
+            elif ret['status'] != FreeNASServer.STATUS_OK:
                 msg = ('Error while creating snapshot: %s' % ret['response'])
                 raise FreeNASApiError('Unexpected error', msg)
         except Exception as e:
             raise FreeNASApiError('Unexpected error', e)
 
+    def _get_clone_mode(self, extra_specs):
+        """Returns 'linked' or 'full' for a volume type's clones.
+
+           full falls back to linked when the array cannot run one-time
+           replications selected by snapshot name.
+        """
+        mode = ix_utils.get_ixsystems_specs(extra_specs).get(
+            'clone_mode', self.configuration.ixsystems_clone_mode).lower()
+        if mode not in self.CLONE_MODES:
+            raise exception.InvalidVolumeType(
+                reason=_('invalid ixsystems: extra spec, clone_mode must '
+                         'be linked or full'))
+        if (mode == 'full' and not self._get_capabilities()['features'].get(
+                'replication_name_regex')):
+            LOG.warning('Full clones need TrueNAS 13.0 or later, making a '
+                        'linked clone')
+            return 'linked'
+        return mode
+
+    def _copy_volume_from_snapshot(self, name, snapshot_name,
+                                   snap_zvol_name):
+        """Copies a snapshot into a new independent volume.
+
+           The copy is a one-time local replication of the snapshot, the
+           snapshot it leaves on the new volume is deleted afterwards.
+        """
+        path = self.configuration.ixsystems_dataset_path
+        args = {'direction': 'PUSH',
+                'transport': 'LOCAL',
+                'source_datasets': ['%s/%s' % (path, snap_zvol_name)],
+                'target_dataset': '%s/%s' % (path, name),
+                'recursive': False,
+                'name_regex': '^%s$' % re.escape(snapshot_name),
+                'retention_policy': 'NONE'}
+        if self._get_capabilities()['features'].get('scale'):
+            # Keep the copy writable, SCALE sets targets read-only.
+            args['readonly'] = 'IGNORE'
+        request_urn = FreeNASServer.REST_API_REPLICATION_ONETIME
+        LOG.debug('_copy_volume_from_snapshot args : %s', args)
+        ret = self.handle.jobs.invoke(FreeNASServer.CREATE_COMMAND,
+                                      request_urn,
+                                      json.dumps(args).encode('utf8'),
+                                      'clone')
+        LOG.debug('_copy_volume_from_snapshot response : %s',
+                  json.dumps(ret))
+        if ret['status'] != FreeNASServer.STATUS_OK:
+            msg = ('Error while copying snapshot: %s' % ret['response'])
+            raise FreeNASApiError('Unexpected error', msg)
+        self._delete_snapshot(snapshot_name, name)
+
+    def _rename_volume(self, name, new_name):
+        """Renames a volume within the dataset."""
+        path = self.configuration.ixsystems_dataset_path
+        request_urn = ('%s/id/%s/rename') % (
+            FreeNASServer.REST_API_VOLUME,
+            urllib.parse.quote_plus(path + '/' + name))
+        args = {'new_name': path + '/' + new_name}
+        ret = self.handle.invoke_command(FreeNASServer.CREATE_COMMAND,
+                                         request_urn,
+                                         json.dumps(args).encode('utf8'))
+        if ret['status'] != FreeNASServer.STATUS_OK:
+            msg = ('Error while renaming volume: %s' % ret['response'])
+            raise FreeNASApiError('Unexpected error', msg)
+
+    def _destroy_volume(self, name):
+        """Deletes a volume with its snapshots, returns the response."""
+        request_urn = ('%s/id/%s') % (
+            FreeNASServer.REST_API_VOLUME,
+            urllib.parse.quote_plus(
+                self.configuration.ixsystems_dataset_path + '/' + name))
+        return self.handle.jobs.invoke(
+            FreeNASServer.DELETE_COMMAND, request_urn,
+            json.dumps({'recursive': True}).encode('utf8'), 'delete')
+
+    def _get_clone_depths(self):
+        """Returns the linked clone depth of every zvol of the dataset.
+
+           An independent zvol has depth 0, a clone of it depth 1 and so
+           on. Origins outside of the dataset count as independent.
+        """
+        ret = self.handle.query(
+            FreeNASServer.REST_API_VOLUME,
+            [('type', '=', 'VOLUME'),
+             ('name', '^', self.configuration.ixsystems_dataset_path + '/')],
+            {'select': ['name', 'origin']})
+        if ret['status'] != FreeNASServer.STATUS_OK:
+            msg = ('Error while listing volumes: %s' % ret['response'])
+            raise FreeNASApiError('Unexpected error', msg)
+        origins = {}
+        for item in json.loads(ret['response'].decode('utf8')):
+            origin = item['origin']['value']
+            origins[item['name']] = origin.split('@')[0] if origin else None
+        depths = {}
+        for name in origins:
+            chain = []
+            while (name in origins and name not in depths and
+                   name not in chain):
+                chain.append(name)
+                name = origins[name]
+            depth = depths.get(name, 0)
+            for link in reversed(chain):
+                depth = depth + 1 if origins[link] else 0
+                depths[link] = depth
+        return depths
+
+    def _get_volume_state(self, name):
+        """Returns the snapshot names and volsize of volume name."""
+        path = self.configuration.ixsystems_dataset_path + '/' + name
+        request_urn = ('%s/id/%s') % (FreeNASServer.REST_API_VOLUME,
+                                      urllib.parse.quote_plus(path))
+        ret, snapshots = self._fan_out(
+            (self.handle.invoke_command, FreeNASServer.SELECT_COMMAND,
+             request_urn, None),
+            (self.handle.query, FreeNASServer.REST_API_SNAPSHOT,
+             [('dataset', '=', path)], {'select': ['name']}))
+        for result in (ret, snapshots):
+            if result['status'] != FreeNASServer.STATUS_OK:
+                msg = ('Error while getting volume: %s' % result['response'])
+                raise FreeNASApiError('Unexpected error', msg)
+        volsize = json.loads(ret['response'].decode('utf8'))['volsize']
+        return (sorted(item['name'].split('@', 1)[1] for item in
+                       json.loads(snapshots['response'].decode('utf8'))),
+                volsize['parsed'])
+
+    def _flatten_volume(self, name):
+        """Replaces linked clone name with an independent copy.
+
+           Only volumes without snapshots and without an iSCSI export are
+           flattened. The copy is made without holding any lock, and is
+           dropped instead of swapped in if name was exported, snapshotted
+           or extended meanwhile. Returns False if name was skipped.
+        """
+        target = ix_utils.generate_freenas_volume_name(
+            name, self.configuration.ixsystems_iqn_prefix)['target']
+        with lockutils.lock('ixsystems-export-' + target):
+            ids, cached = self._get_iscsitarget_ids(target)
+            if any(ids[field] for field in ISCSIInventory.FIELDS):
+                return False
+            snapshots, volsize = self._get_volume_state(name)
+            if snapshots:
+                return False
+            with self._flatten_lock:
+                # Set by _create_iscsitarget if name is exported.
+                self._flattening[name] = False
+        try:
+            origin = self._dependent_clone(name)
+            LOG.info('Flattening %s, a clone of %s', name, origin)
+            snapshot = 'flatten-%d' % int(time.time())
+            self._create_snapshot(snapshot, name)
+            try:
+                self._copy_volume_from_snapshot(name + '-flat', snapshot,
+                                                name)
+            except Exception:
+                with excutils.save_and_reraise_exception():
+                    self._delete_snapshot(snapshot, name)
+            with lockutils.lock('ixsystems-export-' + target), \
+                    lockutils.lock('ixsystems-volume-' + name):
+                ids, cached = self._get_iscsitarget_ids(target)
+                with self._flatten_lock:
+                    exported = self._flattening[name] or any(
+                        ids[field] for field in ISCSIInventory.FIELDS)
+                if exported or self._get_volume_state(name) != (
+                        [snapshot], volsize):
+                    # The copy may miss writes, snapshots or a new size.
+                    LOG.info('Not flattening %s, it changed during the copy',
+                             name)
+                    self._destroy_volume(name + '-flat')
+                    self._delete_snapshot(snapshot, name)
+                    return False
+                try:
+                    self._rename_volume(name, name + '-old')
+                except Exception:
+                    with excutils.save_and_reraise_exception():
+                        self._destroy_volume(name + '-flat')
+                        self._delete_snapshot(snapshot, name)
+                try:
+                    self._rename_volume(name + '-flat', name)
+                except Exception:
+                    with excutils.save_and_reraise_exception():
+                        self._rename_volume(name + '-old', name)
+                        self._destroy_volume(name + '-flat')
+        finally:
+            with self._flatten_lock:
+                self._flattening.pop(name, None)
+        ret = self._destroy_volume(name + '-old')
+        if ret['status'] != FreeNASServer.STATUS_OK:
+            LOG.warning('Failed to delete %s-old after flattening: %s',
+                        name, ret['response'])
+            return True
+        # Drop the snapshot the old clone was made from, as deleting
+        # the clone in _delete_volume would have.
+        fullvolume, snapname = origin.split('@')
+        self._delete_snapshot(snapname, fullvolume.rsplit('/', 1)[1])
+        return True
+
+    @freenasapi.with_call_priority(freenasapi.PRIORITY_LOW)
+    def _flatten_clones(self):
+        """Flattens volumes that are linked clones deeper than allowed.
+
+           Shallower volumes go first. A volume that still has snapshots,
+           such as the origin of another clone, is skipped until that
+           clone is flattened or deleted.
+        """
+        max_depth = self.configuration.ixsystems_clone_max_depth
+        features = self._get_capabilities()['features']
+        if not (features.get('dataset_rename') and
+                features.get('replication_name_regex')):
+            LOG.debug('_flatten_clones: dataset rename is not supported')
+            return
+        prefix = self.configuration.ixsystems_dataset_path + '/'
+        depths = self._get_clone_depths()
+        candidates = sorted(
+            (name[len(prefix):] for name, depth in depths.items()
+             if depth > max_depth and
+             re.match(r'^volume-[^-/]+$', name[len(prefix):])),
+            key=lambda name: depths[prefix + name])
+        flattened = 0
+        for name in candidates:
+            if flattened >= self.FLATTEN_BATCH:
+                break
+            try:
+                if self._flatten_volume(name):
+                    flattened += 1
+            except Exception as e:
+                LOG.warning('Failed to flatten %s: %s', name, e)
+        LOG.debug('_flatten_clones flattened %s of %s candidates', flattened,
+                  len(candidates))
+
+    def _run_clone_flattener(self):
+        try:
+            self._flatten_clones()
+        except Exception as e:
+            LOG.warning('Failed to flatten clone chains: %s', e)
+
+    def _start_clone_flattener(self):
+        """Starts flattening deep clone chains in the background."""
+        if (self.configuration.ixsystems_clone_max_depth <= 0 or
+                self._clone_flattener):
+            return
+        if not self.configuration.ixsystems_lazy_export:
+            # Exported volumes are never flattened, and without lazy
+            # export every volume is exported.
+            LOG.warning('ixsystems_clone_max_depth is ignored, flattening '
+                        'needs ixsystems_lazy_export')
+            return
+        self._clone_flattener = loopingcall.FixedIntervalLoopingCall(
+            self._run_clone_flattener)
+        self._clone_flattener.start(
+            interval=self.configuration.ixsystems_flatten_interval,
+            initial_delay=self.configuration.ixsystems_flatten_interval)
+
     def _promote_volume(self, volume_name):
         """Promote a volume"""
         request_urn = ('%s/id/%s/promote') % (
@@ -446,39 +2059,79 @@ class TrueNASCommon(object):
                 self.configuration.ixsystems_dataset_path + '/' + volume_name))
         LOG.debug('_promote_volume urn : %s', request_urn)
         try:
-            ret = self.handle.invoke_command(FreeNASServer.CREATE_COMMAND,
-                                             request_urn, None)
+            ret = self.handle.jobs.invoke(FreeNASServer.CREATE_COMMAND,
+                                          request_urn, None, 'promote')
             if ret['status'] != FreeNASServer.STATUS_OK:
                 msg = ('Error while promoting volume: %s' % ret['response'])
                 raise FreeNASApiError('Unexpected error', msg)
         except Exception as e:
             raise FreeNASApiError('Unexpected error', e)
 
+    def _get_keystone_client(self):
+        """Returns keystone client on a session reused across calls.
+
+           The session authenticates with the keystone_authtoken
+           credentials of the cinder service, scoped to its service
+           project, and renews its token when needed.
+        """
+        with self._keystone_lock:
+            if self._keystone is None:
+                grp = cfg.OptGroup('keystone_authtoken')
+                CONF.register_group(grp)
+                CONF.register_opts(keystone_authtoken_opts, group=grp)
+                auth = v3.Password(
+                    auth_url=CONF.keystone_authtoken.auth_url,
+                    username=CONF.keystone_authtoken.username,
+                    password=CONF.keystone_authtoken.password,
+                    project_name=CONF.keystone_authtoken.project_name,
+                    user_domain_name=CONF.keystone_authtoken.user_domain_name,
+                    project_domain_name=(
+                        CONF.keystone_authtoken.project_domain_name))
+                self._keystone = client.Client(
+                    session=session.Session(auth=auth))
+            return self._keystone
+
     def _is_service_project(self, project_id):
         # Use keystone api to check project_id is service project
         # Return True if it is service project, otherwise return False
-        grp = cfg.OptGroup('keystone_authtoken')
-        ops = [cfg.StrOpt('auth_url'), cfg.StrOpt('username'), cfg.StrOpt('password'),
-               cfg.StrOpt('project_name'), cfg.StrOpt('user_domain_name'), cfg.StrOpt('project_domain_name')]
-        CONF.register_group(grp)
-        CONF.register_opts(ops, group=grp)
-        auth = v3.Password(auth_url=CONF.keystone_authtoken.auth_url,
-                           username=CONF.keystone_authtoken.username,
-                           password=CONF.keystone_authtoken.password,
-                           project_id=project_id,
-                           user_domain_name=CONF.keystone_authtoken.user_domain_name,
-                           project_domain_name=CONF.keystone_authtoken.project_domain_name)
-        sess = session.Session(auth=auth)
-        keystone = client.Client(session=sess)
+        is_service = self._service_projects.get(project_id)
+        if is_service is not None:
+            return is_service
+
+        is_service = False
+        cacheable = True
+        start = time.monotonic()
         try:
-            project = keystone.projects.get(project_id)
-            if project.name == CONF.keystone_authtoken.project_name:
-                return True
-        except Exception:
+            project = self._get_keystone_client().projects.get(project_id)
+            is_service = (
+                project.name == CONF.keystone_authtoken.project_name)
+        except ks_exceptions.HttpError:
             # Invalid project id will cause exeception from keystone client,
             # in this case it is allowed and normal, hence do nothing
             pass
-        return False
+        except Exception as e:
+            # Keystone unreachable, answer as before but ask again next time
+            LOG.warning('_is_service_project keystone error: %s', e)
+            cacheable = False
+        elapsed = time.monotonic() - start
+        with self._keystone_lock:
+            self._keystone_stats['calls'] += 1
+            self._keystone_stats['errors'] += 0 if cacheable else 1
+            self._keystone_stats['total_seconds'] += elapsed
+            self._keystone_stats['max_seconds'] = max(
+                self._keystone_stats['max_seconds'], elapsed)
+        LOG.debug('_is_service_project %s: %s, keystone took %.3fs',
+                  project_id, is_service, elapsed)
+        if cacheable:
+            self._service_projects.set(project_id, is_service)
+        return is_service
+
+    def _get_keystone_stats(self):
+        with self._keystone_lock:
+            stats = dict(self._keystone_stats)
+        stats['cache_hits'] = self._service_projects.hits
+        stats['cache_misses'] = self._service_projects.misses
+        return stats
 
     def _system_version(self):
         LOG.debug('_update_volume_stats start /system/version request')
@@ -516,9 +2169,159 @@ class TrueNASCommon(object):
         finally:
             return tunableresult
 
+    def _probe_capabilities(self):
+        """Reads TrueNAS version, CTL limits and feature flags."""
+        version = self._system_version()
+        parsed_version = ix_utils.parse_truenas_version(version)
+        release = ix_utils.get_truenas_release(parsed_version)
+        features = {
+            # CORE exports LUNs through CTL, bounded by kern.cam.ctl
+            # tunables; SCALE uses SCST without these limits.
+            'ctl_tunables': parsed_version[1] in ('12.0', '13.0'),
+            'scale': version.find('SCALE') >= 0,
+            # One-time replications select snapshots by name_regex.
+            'replication_name_regex': release >= (13, 0),
+            'dataset_rename': release >= (24, 4),
+        }
+        # Default value from Truenas 12 kern.cam.ctl.max_ports 256,
+        # kern.cam.ctl.max_luns 1024
+        max_ports, max_luns = 256, 1024
+        if features['ctl_tunables']:
+            # _tunable() returns a list of dict
+            # [{'var':'kern.cam.ctl.max_luns','enabled':True,'value':'256'},
+            #  {'var':'kern.cam.ctl.max_ports','enabled':True,'value':'1024'}]
+            for item in self._tunable():
+                if (item.get('enabled') and
+                        item.get('var') == 'kern.cam.ctl.max_luns' and
+                        str(item.get('value')).isnumeric()):
+                    max_luns = int(item['value'])
+                if (item.get('enabled') and
+                        item.get('var') == 'kern.cam.ctl.max_ports' and
+                        str(item.get('value')).isnumeric()):
+                    max_ports = int(item['value'])
+        compression_choices = None
+        if version != 'VersionNotFound':
+            compression_choices = self._compression_choices()
+        return {'version': version,
+                'parsed_version': parsed_version,
+                'max_luns': max_luns,
+                'max_ports': max_ports,
+                'features': features,
+                'compression_choices': compression_choices,
+                'updated_at': time.time()}
+
+    def _compression_choices(self):
+        """Lists zvol compression algorithms, None if not available."""
+        request_urn = ('%s/compression_choices') % (
+            FreeNASServer.REST_API_VOLUME)
+        ret = self.handle.invoke_command(FreeNASServer.SELECT_COMMAND,
+                                         request_urn, None)
+        if ret['status'] != FreeNASServer.STATUS_OK:
+            LOG.debug('_compression_choices failed : %s', ret['response'])
+            return None
+        return sorted(json.loads(ret['response']))
+
+    def _get_capabilities(self):
+        """Returns cached TrueNAS capabilities, probing when stale.
+
+           Concurrent callers share a single probe. An unreachable
+           array (VersionNotFound) is reported but never cached.
+        """
+        ttl = self.configuration.ixsystems_capabilities_ttl
+
+        def cached():
+            with self._capabilities_lock:
+                caps = self._capabilities
+            if caps and time.time() - caps['updated_at'] < ttl:
+                return caps
+            return None
+        caps = cached()
+        if caps:
+            return caps
+        with self._capabilities_probe_lock:
+            # Another caller may have probed while this one waited.
+            caps = cached()
+            if caps:
+                return caps
+            caps = self._probe_capabilities()
+            if caps['version'] == 'VersionNotFound':
+                return caps
+            with self._capabilities_lock:
+                previous = self._capabilities
+                self._capabilities = caps
+            if previous and previous['version'] != caps['version']:
+                LOG.info('TrueNAS version changed from %s to %s',
+                         previous['version'], caps['version'])
+            self._save_capabilities(caps)
+            return caps
+
+    def _invalidate_capabilities(self):
+        with self._capabilities_lock:
+            self._capabilities = None
+        with self._portals_lock:
+            self._portals = None
+
+    def _on_api_error(self, request_urn, ret):
+        """Drops cached capabilities when an error hints at an upgrade.
+
+           A lost connection is what a middleware restart looks like, and
+           a missing endpoint or method is what an API change looks like.
+           Missing objects (404 on an /id/ path) are normal errors.
+        """
+        if (ret['code'] == -1 or ret['code'] in (405, 501) or
+                (ret['code'] == 404 and '/id/' not in request_urn)):
+            if self._capabilities:
+                LOG.debug('Invalidating TrueNAS capabilities after %s on %s',
+                          ret['response'], request_urn)
+            self._invalidate_capabilities()
+
+    def _load_capabilities(self):
+        """Loads capabilities persisted by an earlier run, if fresh."""
+        cache_file = self.configuration.ixsystems_capabilities_cache_file
+        if not cache_file or not os.path.exists(cache_file):
+            return
+        try:
+            with open(cache_file) as fd:
+                caps = json.load(fd)
+            caps['parsed_version'] = tuple(caps['parsed_version'])
+        except Exception as e:
+            LOG.warning('Ignoring capabilities cache %s: %s', cache_file, e)
+            return
+        if (time.time() - caps['updated_at'] <
+                self.configuration.ixsystems_capabilities_ttl):
+            with self._capabilities_lock:
+                self._capabilities = caps
+
+    def _save_capabilities(self, caps):
+        cache_file = self.configuration.ixsystems_capabilities_cache_file
+        if not cache_file:
+            return
+        try:
+            with open(cache_file + '.tmp', 'w') as fd:
+                json.dump(caps, fd)
+            os.replace(cache_file + '.tmp', cache_file)
+        except Exception as e:
+            LOG.warning('Failed to save capabilities cache %s: %s',
+                        cache_file, e)
+
+    @freenasapi.with_call_priority(freenasapi.PRIORITY_LOW)
     def _update_volume_stats(self):
         data = {}
-        nasversion = self._system_version()
+        if not self.handle.is_available():
+            # Fail fast while the circuit breaker is open, keeping the
+            # last stats but no free space so nothing is scheduled here.
+            data = dict(self.stats)
+            data.update(volume_backend_name=self.backend_name,
+                        vendor_name=self.vendor_name,
+                        driver_version=self.VERSION,
+                        storage_protocol=self.storage_protocol,
+                        backend_state='down', free_capacity_gb=0)
+            LOG.warning('_update_volume_stats: %s is unreachable, '
+                        'reporting backend down',
+                        self.configuration.ixsystems_server_hostname)
+            self.stats = data
+            return self.stats
+        nasversion = self._get_capabilities()['version']
         # Implementation for TrueNAS 12.0 upwards on API V2.0
         # If user are connecting to FreeNAS report error
         if nasversion.find("FreeNAS") >= 0:
@@ -536,26 +2339,93 @@ class TrueNASCommon(object):
             """
             self.handle.set_api_version('v2.0')
             request_urn = ('%s%s') % ('/pool/dataset/id/', urllib.parse.quote_plus(self.configuration.ixsystems_dataset_path))
-            ret = self.handle.invoke_command(FreeNASServer.SELECT_COMMAND, request_urn, None)
+            ret, provisioned = self._fan_out(
+                (self.handle.invoke_command, FreeNASServer.SELECT_COMMAND,
+                 request_urn, None),
+                (self._get_provisioned_bytes,))
             retresult = json.loads(ret['response'])
             avail = retresult['available']['parsed']
             used = retresult['used']['parsed']
             LOG.info('_update_volume_stats avail : %s', avail)
             LOG.info('_update_volume_stats used : %s', used)
+            LOG.info('_update_volume_stats provisioned : %s', provisioned)
+            LOG.info('_update_volume_stats iscsi inventory : %s',
+                     self.inventory.get_stats())
+            LOG.info('_update_volume_stats keystone : %s',
+                     self._get_keystone_stats())
+            LOG.info('_update_volume_stats api limiter : %s, coalesced '
+                     'reads : %s', self.handle.limiter.get_stats(),
+                     self.handle.coalesced_reads)
+            if self.configuration.ixsystems_deferred_delete:
+                LOG.info('_update_volume_stats deferred deletes queued : %s',
+                         len(self.deferred_deletes))
+            try:
+                self._sync_attachments()
+            except Exception as e:
+                LOG.warning('Failed to read iSCSI sessions: %s', e)
             data["volume_backend_name"] = self.backend_name
             data["vendor_name"] = self.vendor_name
             data["driver_version"] = self.VERSION
             data["storage_protocol"] = self.storage_protocol
             data['total_capacity_gb'] = ix_utils.get_size_in_gb(avail+used)
             data['free_capacity_gb'] = ix_utils.get_size_in_gb(avail)
+            data['provisioned_capacity_gb'] = ix_utils.get_size_in_gb(
+                provisioned)
             data['reserved_percentage'] = (
                 self.configuration.ixsystems_reserved_percentage)
-            data['reserved_percentage'] = 0
+            # Zvols are thick unless sparse, so the scheduler may only
+            # oversubscribe when volumes default to sparse.
+            data['thin_provisioning_support'] = (
+                self.configuration.ixsystems_sparse_volumes)
+            data['thick_provisioning_support'] = True
+            data['max_over_subscription_ratio'] = (
+                self.configuration.safe_get('max_over_subscription_ratio'))
             data['QoS_support'] = False
+            data['consistent_group_snapshot_enabled'] = True
+            data['backend_state'] = 'up'
 
         self.stats = data
         return self.stats
 
+    def _get_provisioned_bytes(self):
+        """Sums volsize of all zvols under the dataset in one listing."""
+        ret = self.handle.query(
+            FreeNASServer.REST_API_VOLUME,
+            [('type', '=', 'VOLUME'),
+             ('name', '^', self.configuration.ixsystems_dataset_path + '/')],
+            {'select': ['name', 'volsize']})
+        if ret['status'] != FreeNASServer.STATUS_OK:
+            msg = ('Error while listing volumes: %s' % ret['response'])
+            raise FreeNASApiError('Unexpected error', msg)
+        return sum(item['volsize']['parsed']
+                   for item in json.loads(ret['response'].decode('utf8')))
+
+    def _collect_volume_stats(self):
+        """Refreshes volume stats, keeping the last good ones on error."""
+        try:
+            self._update_volume_stats()
+        except Exception as e:
+            LOG.warning('Failed to refresh volume stats, serving last '
+                        'collected stats: %s', e)
+
+    def _start_stats_collector(self):
+        """Starts refreshing volume stats in the background."""
+        interval = self.configuration.ixsystems_stats_interval
+        if interval <= 0 or self._stats_collector:
+            return
+        self._stats_collector = loopingcall.FixedIntervalLoopingCall(
+            self._collect_volume_stats)
+        self._stats_collector.start(interval=interval, initial_delay=0)
+
+    def _get_volume_stats(self):
+        """Returns the last collected stats, collecting if there are none.
+
+           Without a background collector stats are refreshed in place.
+        """
+        if self._stats_collector and self.stats:
+            return self.stats
+        return self._update_volume_stats()
+
     def _create_cloned_volume_to_snapshot_map(self, volume_name, snapshot):
         """maintain a mapping between cloned volume and tempary snapshot."""
         map_file = os.path.join(CONF.volumes_dir, volume_name)
@@ -578,8 +2448,10 @@ class TrueNASCommon(object):
             FreeNASServer.REST_API_VOLUME,
             urllib.parse.quote_plus(
                 self.configuration.ixsystems_dataset_path + '/' + name))
-        ret = self.handle.invoke_command(FreeNASServer.UPDATE_COMMAND,
-                                         request_urn, jparams)
+        # Waits for _flatten_volume to swap in a copy of name.
+        with lockutils.lock('ixsystems-volume-' + name):
+            ret = self.handle.invoke_command(FreeNASServer.UPDATE_COMMAND,
+                                             request_urn, jparams)
         if ret['status'] != FreeNASServer.STATUS_OK:
             msg = ('Error while extending volume: %s' % ret['response'])
             raise FreeNASApiError('Unexpected error', msg)
@@ -592,6 +2464,13 @@ class TrueNASCommon(object):
         if freenas_volume is None:
             LOG.error('Error in exporting FREENAS volume!')
             handle = None
+        elif self.configuration.ixsystems_export_mode == 'shared':
+            export = self._get_export(freenas_volume['target'])
+            handle = "%s:%s,%s %s %s" % \
+                     (self.configuration.ixsystems_server_hostname,
+                      self.configuration.ixsystems_server_iscsi_port,
+                      freenas_volume['target'],
+                      export['iqn'], export['lun'])
         else:
             handle = "%s:%s,%s %s" % \
                      (self.configuration.ixsystems_server_hostname,
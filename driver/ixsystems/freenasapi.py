@@ -19,7 +19,16 @@ Contains classes required to issue REST based api calls to FREENAS system.
 """
 
 import base64
+import collections
+import contextlib
+import functools
+import http.client
+import io
+import random
 import simplejson as json
+import threading
+import time
+import uuid
 
 from oslo_log import log as logging
 import urllib.error
@@ -29,6 +38,300 @@ import ssl
 
 LOG = logging.getLogger(__name__)
 
+# Priorities of API calls, attach and detach go ahead of normal calls,
+# which go ahead of stats and background cleanup.
+PRIORITY_HIGH = 'high'
+PRIORITY_NORMAL = 'normal'
+PRIORITY_LOW = 'low'
+PRIORITIES = (PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW)
+
+_call_priority = threading.local()
+
+
+def get_call_priority():
+    """Returns the priority of API calls made by the current thread."""
+    return getattr(_call_priority, 'priority', PRIORITY_NORMAL)
+
+
+@contextlib.contextmanager
+def call_priority(priority):
+    """Makes the API calls of the current thread with priority."""
+    previous = get_call_priority()
+    _call_priority.priority = priority
+    try:
+        yield
+    finally:
+        _call_priority.priority = previous
+
+
+def with_call_priority(priority):
+    """Decorates a method to make its API calls with priority."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with call_priority(priority):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def inherit_call_priority(func):
+    """Returns func bound to the priority of the current thread.
+
+       For calls handed to worker threads, which start out normal.
+    """
+    return with_call_priority(get_call_priority())(func)
+
+
+class FreeNASResponse(collections.namedtuple(
+        'FreeNASResponse',
+        ['status', 'response', 'code', 'latency', 'request_id',
+         'attempts'])):
+    """Result of a single FREENAS api call.
+
+       status is STATUS_OK or STATUS_ERROR, response the raw body or the
+       error message, code the HTTP status of an error (-1 otherwise),
+       latency the call duration in seconds, request_id a unique id of
+       the call for log correlation and attempts the number of times the
+       call was sent. Results are immutable, so concurrent calls never
+       share state. Fields may also be read by key, e.g. ret['status'].
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, status, response, code=-1, latency=None,
+                request_id=None, attempts=1):
+        return super(FreeNASResponse, cls).__new__(
+            cls, status, response, code, latency, request_id, attempts)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return getattr(self, key)
+        return super(FreeNASResponse, self).__getitem__(key)
+
+
+class _PooledHTTPSConnection(http.client.HTTPSConnection):
+    """HTTPS connection resuming the TLS session shared by its pool."""
+
+    def __init__(self, host, pool, **kwargs):
+        super(_PooledHTTPSConnection, self).__init__(
+            host, context=pool.ssl_context, **kwargs)
+        self._pool = pool
+
+    def connect(self):
+        http.client.HTTPConnection.connect(self)
+        self.sock = self._context.wrap_socket(
+            self.sock, server_hostname=self.host,
+            session=self._pool.ssl_session)
+
+
+class FreeNASConnectionPool(object):
+    """Persistent keep-alive connections to a single FREENAS server.
+
+       At most `size` connections are open at any time, callers block
+       until one is released. All https connections share one SSL context
+       and resume the last negotiated TLS session, so only the first
+       connection pays for a full handshake. Connections idle for longer
+       than `idle_timeout` seconds are closed when the pool is next used.
+    """
+
+    def __init__(self, host, transport_type, size=4, idle_timeout=60):
+        self._host = host
+        self._transport_type = transport_type
+        self._idle_timeout = idle_timeout
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+        self.ssl_context = None
+        self.ssl_session = None
+        if transport_type == 'https':
+            # Same trust model as before pooling: the certificate of the
+            # storage controller is not verified.
+            self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            self.ssl_context.check_hostname = False
+            self.ssl_context.verify_mode = ssl.CERT_NONE
+
+    def _new_connection(self):
+        if self.ssl_context:
+            return _PooledHTTPSConnection(self._host, self)
+        return http.client.HTTPConnection(self._host)
+
+    def _reap_idle(self):
+        """Close connections idle for longer than idle_timeout.
+
+           Must be called with _lock held.
+        """
+        now = time.monotonic()
+        keep = []
+        for conn, last_used in self._idle:
+            if now - last_used > self._idle_timeout:
+                conn.close()
+            else:
+                keep.append((conn, last_used))
+        self._idle = keep
+
+    def acquire(self):
+        """Returns (connection, reused) with a free pool slot held."""
+        self._slots.acquire()
+        try:
+            with self._lock:
+                self._reap_idle()
+                if self._idle:
+                    return self._idle.pop()[0], True
+            return self._new_connection(), False
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, conn, reusable=True):
+        """Returns connection to the pool and frees its slot."""
+        try:
+            if reusable and conn.sock is not None:
+                session = getattr(conn.sock, 'session', None)
+                if session is not None:
+                    self.ssl_session = session
+                with self._lock:
+                    self._idle.append((conn, time.monotonic()))
+                    self._reap_idle()
+            else:
+                conn.close()
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """Closes all idle connections."""
+        with self._lock:
+            for conn, last_used in self._idle:
+                conn.close()
+            self._idle = []
+
+
+class _Budget(object):
+    """Concurrency budget of one kind of API call."""
+
+    def __init__(self, max_limit):
+        self.max_limit = max_limit
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        # Tickets of waiting calls, by priority in arrival order
+        self.waiting = [collections.deque() for _ in PRIORITIES]
+        self.last_decrease = 0
+        self.calls = 0
+        self.waited = 0
+        self.wait_seconds = 0.0
+        self.decreases = 0
+
+
+class FreeNASCallLimiter(object):
+    """Admission control for API calls to the FREENAS middleware.
+
+       Reads and mutating calls have separate concurrency budgets. Calls
+       over budget wait, and are admitted highest priority first. Each
+       budget adapts to the observed latency (AIMD): it grows by one call
+       per limit calls answered within target_latency, and halves, at
+       most once per target_latency, when a call is slower. A transport
+       that waits for a connection after admission calls restart_clock
+       once it has one, so the wait is not counted as latency.
+    """
+
+    READ = 'read'
+    WRITE = 'write'
+
+    def __init__(self, read_limit, write_limit, target_latency=0):
+        self._budgets = {self.READ: _Budget(read_limit),
+                         self.WRITE: _Budget(write_limit)}
+        self._target_latency = target_latency
+        self._cond = threading.Condition()
+        # Start time of the call of the current thread, by slot
+        self._call_start = threading.local()
+
+    def _admit(self, budget, rank, ticket=None):
+        """Returns True if a call of rank may start now."""
+        return (budget.in_flight < max(int(budget.limit), 1) and
+                not any(budget.waiting[:rank]) and
+                (not budget.waiting[rank] or
+                 budget.waiting[rank][0] is ticket))
+
+    def acquire(self, kind):
+        budget = self._budgets[kind]
+        rank = PRIORITIES.index(get_call_priority())
+        with self._cond:
+            if not self._admit(budget, rank):
+                start = time.monotonic()
+                ticket = object()
+                budget.waiting[rank].append(ticket)
+                try:
+                    while not self._admit(budget, rank, ticket):
+                        self._cond.wait()
+                finally:
+                    budget.waiting[rank].remove(ticket)
+                    self._cond.notify_all()
+                budget.waited += 1
+                budget.wait_seconds += time.monotonic() - start
+            budget.in_flight += 1
+            budget.calls += 1
+
+    def release(self, kind, latency):
+        budget = self._budgets[kind]
+        with self._cond:
+            budget.in_flight -= 1
+            if self._target_latency:
+                now = time.monotonic()
+                if latency > self._target_latency:
+                    if now - budget.last_decrease > self._target_latency:
+                        budget.limit = max(budget.limit / 2, 1.0)
+                        budget.last_decrease = now
+                        budget.decreases += 1
+                        LOG.debug('%s calls took %.2fs, limiting to %d',
+                                  kind, latency, int(budget.limit))
+                else:
+                    budget.limit = min(budget.limit + 1 / budget.limit,
+                                       float(budget.max_limit))
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self, kind):
+        """Holds a slot of the kind budget for the duration of a call."""
+        self.acquire(kind)
+        outer = getattr(self._call_start, 'start', None)
+        self._call_start.start = time.monotonic()
+        try:
+            yield
+        finally:
+            latency = time.monotonic() - self._call_start.start
+            self._call_start.start = outer
+            self.release(kind, latency)
+
+    def restart_clock(self):
+        """Measures the latency of the current call from now on."""
+        if getattr(self._call_start, 'start', None) is not None:
+            self._call_start.start = time.monotonic()
+
+    def get_stats(self):
+        """Returns the counters of each budget."""
+        with self._cond:
+            return dict((kind, {'limit': int(budget.limit),
+                                'in_flight': budget.in_flight,
+                                'waiting': sum(len(waiting) for waiting
+                                               in budget.waiting),
+                                'calls': budget.calls,
+                                'waited': budget.waited,
+                                'wait_seconds': round(budget.wait_seconds,
+                                                      3),
+                                'decreases': budget.decreases})
+                        for kind, budget in self._budgets.items())
+
+
+class _Flight(object):
+    """A read in flight, shared by identical concurrent reads."""
+
+    __slots__ = ('done', 'response', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
 
 class FreeNASServer(object):
     """FreeNAS server connection logic."""
@@ -47,30 +350,83 @@ class FreeNASServer(object):
     REST_API_EXTENT = "/iscsi/extent"
     REST_API_TARGET = "/iscsi/target"
     REST_API_TARGET_TO_EXTENT = "/iscsi/targetextent"
+    REST_API_INITIATOR = "/iscsi/initiator"
+    REST_API_PORTAL = "/iscsi/portal"
+    REST_API_REPLICATION_ONETIME = "/replication/run_onetime"
+    REST_API_BULK = "/core/bulk"
     # REST_API_TARGET_GROUP = "/services/iscsi/targetgroup/"
     REST_API_SNAPSHOT = "/zfs/snapshot"
     ZVOLS = "zvols"
     TARGET_ID = -1  # We assume invalid id to begin with
     STORAGE_TABLE = "/storage"
     CLONE = "clone"
-    # Command response format
-    COMMAND_RESPONSE = {'status': '%s',
-                        'response': '%s',
-                        'code': -1}
 
     # Command status
     STATUS_OK = 'ok'
     STATUS_ERROR = 'error'
 
+    # Connection pool defaults
+    POOL_SIZE = 4
+    POOL_IDLE_TIMEOUT = 60
+
+    # Call limiter defaults
+    READ_LIMIT = 8
+    WRITE_LIMIT = 4
+
+    # Seconds to wait for a response, by command
+    CALL_TIMEOUTS = {SELECT_COMMAND: 30, CREATE_COMMAND: 120,
+                     UPDATE_COMMAND: 120, DELETE_COMMAND: 120}
+    # Commands safe to send again when no response was received
+    IDEMPOTENT_COMMANDS = (SELECT_COMMAND, DELETE_COMMAND)
+    # Error codes of an unreachable or restarting server, -1 is a
+    # connection failure without any HTTP response
+    UNAVAILABLE_CODES = (-1, 502, 503, 504)
+    MAX_RETRY_DELAY = 10
+    REST_API_PING = '/core/ping'
+    # Reads whose responses are never reused beyond their flight, job
+    # polls must see the current job state.
+    UNCACHED_READS = ('/core/get_jobs',)
+
     def __init__(self, host, port,
                  username=None, password=None, apikey=None,
                  api_version=FREENAS_API_VERSION,
-                 transport_type=TRANSPORT_TYPE):
+                 transport_type=TRANSPORT_TYPE,
+                 pool_size=POOL_SIZE,
+                 pool_idle_timeout=POOL_IDLE_TIMEOUT,
+                 job_timeouts=None, call_timeouts=None, retries=0,
+                 retry_backoff=0.5, breaker_threshold=0,
+                 breaker_probe_interval=30, read_limit=READ_LIMIT,
+                 write_limit=WRITE_LIMIT, target_latency=0, read_window=0):
         self._host = host
         self._port = port
         self._username = username
         self._password = password
         self._apikey = apikey
+        self._pool = None
+        self._pool_size = pool_size
+        self._pool_idle_timeout = pool_idle_timeout
+        self._pool_lock = threading.Lock()
+        self._error_listeners = []
+        self._call_timeouts = dict(call_timeouts or {})
+        self._retries = retries
+        self._retry_backoff = retry_backoff
+        self._breaker_threshold = breaker_threshold
+        self._breaker_probe_interval = breaker_probe_interval
+        self._breaker_lock = threading.Lock()
+        self._failures = 0
+        # Time of the next probe while the breaker is open, else None.
+        self._next_probe = None
+        self.limiter = FreeNASCallLimiter(read_limit, write_limit,
+                                          target_latency)
+        self._read_window = read_window
+        self._flights = {}
+        self._fresh = {}
+        # Bumped by every mutating call, reads started before are not
+        # reused after it.
+        self._generation = 0
+        self._flights_lock = threading.Lock()
+        self.coalesced_reads = 0
+        self.jobs = FreeNASJobTracker(self, job_timeouts)
         self.set_api_version(api_version)
         self.set_transport_type(transport_type)
 
@@ -91,6 +447,7 @@ class FreeNASServer(object):
 
     def set_host(self, host):
         self._host = host
+        self._reset_pool()
 
     def set_port(self, port):
         try:
@@ -109,6 +466,24 @@ class FreeNASServer(object):
 
     def set_transport_type(self, transport_type):
         self._protocol = transport_type
+        self._reset_pool()
+
+    def _get_pool(self):
+        """Returns the connection pool, creating it on first use."""
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = FreeNASConnectionPool(
+                    self._host, self._protocol,
+                    size=self._pool_size,
+                    idle_timeout=self._pool_idle_timeout)
+            return self._pool
+
+    def _reset_pool(self):
+        """Drops the connection pool after host or transport changes."""
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.close()
+            self._pool = None
 
     def get_url(self):
         """Returns connection string.
@@ -119,6 +494,200 @@ class FreeNASServer(object):
                                    self._host,
                                    self._api_version)
 
+    def add_error_listener(self, listener):
+        """Registers listener(request_d, response) for failed calls."""
+        self._error_listeners.append(listener)
+
+    def _notify_error(self, request_d, response):
+        for listener in self._error_listeners:
+            try:
+                listener(request_d, response)
+            except Exception as e:
+                LOG.warning('Error listener failed: %s', e)
+
+    def get_call_timeout(self, command_d):
+        """Returns seconds to wait for the response to command_d."""
+        return float(self._call_timeouts.get(
+            command_d, self._call_timeouts.get(
+                'default', self.CALL_TIMEOUTS[command_d])))
+
+    def is_available(self):
+        """Returns False while the circuit breaker is open.
+
+           An open breaker probes /core/ping at most every probe interval
+           and closes once the probe succeeds.
+        """
+        with self._breaker_lock:
+            if self._next_probe is None:
+                return True
+            if time.monotonic() < self._next_probe:
+                return False
+            self._next_probe = (time.monotonic() +
+                                self._breaker_probe_interval)
+        response = self._send(self.SELECT_COMMAND, self.REST_API_PING, None,
+                              self.get_call_timeout(self.SELECT_COMMAND))
+        if response.status != self.STATUS_OK:
+            LOG.debug('Circuit breaker probe of %s failed: %s', self._host,
+                      response.response)
+            return False
+        LOG.info('%s is reachable again, closing circuit breaker',
+                 self._host)
+        with self._breaker_lock:
+            self._failures = 0
+            self._next_probe = None
+        return True
+
+    def _record_result(self, response):
+        """Opens the circuit breaker after too many unreachable calls."""
+        if not self._breaker_threshold:
+            return
+        with self._breaker_lock:
+            if (response.status == self.STATUS_OK or
+                    response.code not in self.UNAVAILABLE_CODES):
+                self._failures = 0
+                return
+            self._failures += 1
+            if (self._failures >= self._breaker_threshold and
+                    self._next_probe is None):
+                LOG.warning('%s unreachable for %d calls, opening circuit '
+                            'breaker: %s', self._host, self._failures,
+                            response.response)
+                self._next_probe = (time.monotonic() +
+                                    self._breaker_probe_interval)
+
+    def _single_flight(self, key, fetch, reuse=True):
+        """Shares the response of fetch() among identical reads.
+
+           Reads of key arriving while one is in flight wait for its
+           response instead of sending their own. With a read window and
+           reuse, a successful response is also reused for that many
+           seconds, unless a mutating call was made since the read
+           started.
+        """
+        with self._flights_lock:
+            now = time.monotonic()
+            fresh = self._fresh.get(key)
+            if fresh and fresh[0] > now:
+                self.coalesced_reads += 1
+                return fresh[1]
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                generation = self._generation
+            else:
+                self.coalesced_reads += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.response
+        try:
+            flight.response = fetch()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._flights_lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+                if (reuse and self._read_window > 0 and
+                        flight.response is not None and
+                        flight.response.status == self.STATUS_OK and
+                        generation == self._generation):
+                    now = time.monotonic()
+                    self._fresh = dict(
+                        (k, v) for k, v in self._fresh.items() if v[0] > now)
+                    self._fresh[key] = (now + self._read_window,
+                                        flight.response)
+            flight.done.set()
+        return flight.response
+
+    def _invalidate_reads(self):
+        """Makes reads after a mutating call see its effect."""
+        with self._flights_lock:
+            self._generation += 1
+            self._flights = {}
+            self._fresh = {}
+
+    def _call(self, command_d, request_d, send, retry=None):
+        """Sends a call through the circuit breaker.
+
+           send(timeout) sends the call once and returns its
+           FreeNASResponse. Idempotent commands, and others when retry is
+           True, are sent again with jittered exponential backoff while
+           the server is unreachable, the response tells how many times
+           the call was sent. A DELETE whose retry finds nothing to
+           delete succeeded on the attempt without a response.
+        """
+        if not self._get_method(command_d):
+            raise FreeNASApiError("Invalid FREENAS command")
+        if retry is None:
+            retry = command_d in self.IDEMPOTENT_COMMANDS
+        attempts = 1 + (self._retries if retry else 0)
+        timeout = self.get_call_timeout(command_d)
+        kind = (FreeNASCallLimiter.READ
+                if command_d == self.SELECT_COMMAND
+                else FreeNASCallLimiter.WRITE)
+        for attempt in range(attempts):
+            if not self.is_available():
+                return FreeNASResponse(
+                    self.STATUS_ERROR,
+                    '503:Circuit breaker open, %s is unreachable' %
+                    self._host, code=503)
+            with self.limiter.slot(kind):
+                response = send(timeout)
+            # Outside of the slot, listeners may take locks held by
+            # callers waiting for one.
+            if response.status != self.STATUS_OK:
+                self._notify_error(request_d, response)
+            self._record_result(response)
+            if (response.status == self.STATUS_OK or
+                    response.code not in self.UNAVAILABLE_CODES or
+                    attempt + 1 == attempts):
+                break
+            delay = random.uniform(0, min(self.MAX_RETRY_DELAY,
+                                          self._retry_backoff * 2 ** attempt))
+            LOG.info('Retrying %s %s in %.2fs after: %s', command_d,
+                     request_d, delay, response.response)
+            time.sleep(delay)
+        response = response._replace(attempts=attempt + 1)
+        if command_d != self.SELECT_COMMAND:
+            self._invalidate_reads()
+        if (attempt and command_d == self.DELETE_COMMAND and
+                response.code == 404):
+            response = response._replace(status=self.STATUS_OK,
+                                         response=b'null', code=-1)
+        return response
+
+    def get_query_urn(self, request_d, filters=None, options=None):
+        """Returns request_d with query filters encoded as query string.
+
+           filters is a list of (field, operator, value) tuples and options
+           may carry 'limit', 'offset' and 'sort' as understood by the
+           v2.0 query methods. The REST query string has no way to select
+           fields, so a 'select' option is ignored by this transport.
+        """
+        params = []
+        for field, op, value in filters or []:
+            key = field if op == '=' else '%s__%s' % (field, op)
+            params.append((key, value))
+        options = options or {}
+        for key in ('limit', 'offset'):
+            if key in options:
+                params.append((key, options[key]))
+        if options.get('sort'):
+            params.append(('sort', ','.join(options['sort'])))
+        if not params:
+            return request_d
+        return '%s?%s' % (request_d, urllib.parse.urlencode(params))
+
+    def query(self, request_d, filters=None, options=None):
+        """Runs a filtered select against a v2.0 collection."""
+        return self.invoke_command(
+            self.SELECT_COMMAND,
+            self.get_query_urn(request_d, filters, options), None)
+
     def _create_request(self, request_d, param_list):
         """Creates urllib2.Request object."""
         headers = {'Content-Type': 'application/json'}
@@ -152,14 +721,48 @@ class FreeNASServer(object):
         else:
             return None
 
-    def _parse_result(self, command_d, response_d):
+    def _urlopen(self, request, timeout=None):
+        """Sends request over a pooled keep-alive connection.
+
+           Returns the response body. Raises urllib.error.HTTPError on
+           HTTP error status and urllib.error.URLError on connection
+           failure or timeout, the same errors urllib.request.urlopen
+           raises.
+        """
+        pool = self._get_pool()
+        headers = dict(request.header_items())
+        for attempt in range(2):
+            conn, reused = pool.acquire()
+            self.limiter.restart_clock()
+            try:
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                conn.request(request.get_method(), request.selector,
+                             body=request.data, headers=headers)
+                resp = conn.getresponse()
+                body = resp.read()
+            except (http.client.HTTPException, OSError) as e:
+                pool.release(conn, reusable=False)
+                # The server may close a keep-alive connection while it
+                # sits idle in the pool, retry once on a new connection.
+                if reused and attempt == 0 and isinstance(e, ConnectionError):
+                    LOG.debug('Stale pooled connection, reconnecting: %s', e)
+                    continue
+                raise urllib.error.URLError(e)
+            pool.release(conn, reusable=not resp.will_close)
+            if resp.status >= 400:
+                raise urllib.error.HTTPError(request.full_url, resp.status,
+                                             resp.reason, resp.headers,
+                                             io.BytesIO(body))
+            return body
+
+    def _parse_result(self, command_d, response_str):
         """parses the response upon execution of FREENAS API.
 
-           COMMAND_RESPONSE is
-           the dictionary object with status and response fields.
+           Returns FreeNASResponse with status and response fields.
            If error, set status to ERROR else set it to OK
         """
-        response_str = response_d.read()
         status = None
         if command_d == self.SELECT_COMMAND:
             status = self.STATUS_OK
@@ -173,56 +776,204 @@ class FreeNASServer(object):
             status = self.STATUS_ERROR
             response_obj = None
 
-        self.COMMAND_RESPONSE['status'] = status
-        self.COMMAND_RESPONSE['response'] = response_obj
-        return self.COMMAND_RESPONSE
+        return FreeNASResponse(status, response_obj)
 
     def _get_error_info(self, err):
         """Collects error response message."""
-        self.COMMAND_RESPONSE['status'] = self.STATUS_ERROR
         if isinstance(err, urllib.error.HTTPError):
-            self.COMMAND_RESPONSE['response'] = '%d:%s' % (err.code, err.msg)
-            self.COMMAND_RESPONSE['code'] = err.code
+            return FreeNASResponse(self.STATUS_ERROR,
+                                   '%d:%s' % (err.code, err.msg),
+                                   code=err.code)
         elif isinstance(err, urllib.error.URLError):
-            self.COMMAND_RESPONSE['response'] = '%s:%s' % \
-                                                (str(err.reason.errno),
-                                                 err.reason.strerror)
-        else:
-            return None
-        return self.COMMAND_RESPONSE
-
-    def invoke_command(self, command_d, request_d, param_list):
-        """Invokes api and returns response object."""
-        LOG.debug('invoke_command')
+            return FreeNASResponse(
+                self.STATUS_ERROR,
+                '%s:%s' % (str(getattr(err.reason, 'errno', None)),
+                           getattr(err.reason, 'strerror', None) or
+                           str(err.reason)))
+        return None
+
+    def _get_error_message(self, err):
+        """Returns the error message in the body of an HTTPError."""
+        body = err.read().decode('utf8', 'replace')
+        try:
+            detail = json.loads(body)
+        except ValueError:
+            return body or err.msg
+        if isinstance(detail, dict) and 'message' in detail:
+            return detail['message']
+        # Validation errors map each field to its messages.
+        return json.dumps(detail)
+
+    def invoke_command(self, command_d, request_d, param_list, retry=None):
+        """Invokes api and returns FreeNASResponse object.
+
+           Safe to call from concurrent threads or green threads, each call
+           builds its own request and result. See _call for retries and
+           _single_flight for how identical reads are shared.
+        """
+        def call():
+            return self._call(command_d, request_d,
+                              lambda timeout: self._send(
+                                  command_d, request_d, param_list, timeout),
+                              retry)
+        if command_d == self.SELECT_COMMAND:
+            return self._single_flight(request_d, call,
+                                       self._may_reuse(request_d))
+        return call()
+
+    def _may_reuse(self, request_d):
+        """Returns False for reads listed in UNCACHED_READS."""
+        return not request_d.split('?', 1)[0].startswith(
+            self.UNCACHED_READS)
+
+    def _send(self, command_d, request_d, param_list, timeout=None):
+        """Sends a call once and returns FreeNASResponse object."""
+        request_id = uuid.uuid4().hex
+        LOG.debug('invoke_command %s', request_id)
         request = self._create_request(request_d, param_list)
         method = self._get_method(command_d)
         if not method:
             raise FreeNASApiError("Invalid FREENAS command")
         request.get_method = lambda: method
+        start = time.monotonic()
         try:
-            response_d = urllib.request.urlopen(request, context=ssl.SSLContext())
+            response_d = self._urlopen(request, timeout)
             response = self._parse_result(command_d, response_d)
-            LOG.debug("invoke_command : response for request %s : %s",
-                      request_d, json.dumps(response))
         except urllib.error.HTTPError as e:
             # LOG the error message received from FreeNAS/TrueNAS:
             # https://github.com/iXsystems/cinder/issues/11
-            LOG.info('Error returned from server: "%s"',
-                     json.loads(e.read().decode('utf8'))['message'])
-            error_d = self._get_error_info(e)
-            if error_d:
-                return error_d
-            else:
+            message = self._get_error_message(e)
+            LOG.info('Error returned from server: "%s"', message)
+            response = self._get_error_info(e)
+            if not response:
                 raise FreeNASApiError(e.code, e.msg)
+            response = response._replace(response='%d:%s' % (e.code,
+                                                              message))
         except Exception as e:
-            error_d = self._get_error_info(e)
-            if error_d:
-                return error_d
-            else:
+            response = self._get_error_info(e)
+            if not response:
                 raise FreeNASApiError('Unexpected error', e)
+        response = response._replace(latency=time.monotonic() - start,
+                                     request_id=request_id)
+        LOG.debug("invoke_command : response for request %s : %s",
+                  request_d, json.dumps(response))
         return response
 
 
+class FreeNASJobTracker(object):
+    """Tracks middleware jobs started through a FreeNASServer.
+
+       Many middleware methods run as jobs, their REST call returns the
+       job id while the work continues on TrueNAS. The tracker waits for
+       such jobs to finish, using job state events when the server
+       transport provides them (wait_job) and polling core.get_jobs with
+       an exponential backoff otherwise.
+    """
+
+    REST_API_JOBS = '/core/get_jobs'
+    FINAL_STATES = ('SUCCESS', 'FAILED', 'ABORTED')
+    DEFAULT_TIMEOUT = 300
+    POLL_INTERVAL = 0.1
+    MAX_POLL_INTERVAL = 5
+
+    def __init__(self, server, timeouts=None):
+        self._server = server
+        self._timeouts = dict(timeouts or {})
+
+    def get_timeout(self, op_type):
+        """Returns seconds to wait for a job of op_type."""
+        return float(self._timeouts.get(
+            op_type, self._timeouts.get('default', self.DEFAULT_TIMEOUT)))
+
+    @staticmethod
+    def get_job_id(ret):
+        """Returns the job id of a call response, None if not a job."""
+        if ret['status'] != FreeNASServer.STATUS_OK or not ret['response']:
+            return None
+        try:
+            job_id = json.loads(ret['response'])
+        except ValueError:
+            return None
+        if isinstance(job_id, int) and not isinstance(job_id, bool):
+            return job_id
+        return None
+
+    def get_job(self, job_id):
+        """Returns the current state of job_id, None if unknown."""
+        ret = self._server.query(self.REST_API_JOBS, [('id', '=', job_id)],
+                                 {'limit': 1})
+        if ret['status'] != FreeNASServer.STATUS_OK:
+            msg = ('Error while getting job %s: %s' % (job_id,
+                                                      ret['response']))
+            raise FreeNASApiError('Unexpected error', msg)
+        jobs = json.loads(ret['response'])
+        return jobs[0] if jobs else None
+
+    def wait(self, job_id, op_type='default', timeout=None):
+        """Waits until job_id finishes and returns the finished job."""
+        if timeout is None:
+            timeout = self.get_timeout(op_type)
+        deadline = time.monotonic() + timeout
+        wait_job = getattr(self._server, 'wait_job', None)
+        interval = self.POLL_INTERVAL
+        while True:
+            job = self.get_job(job_id)
+            if job and job.get('state') in self.FINAL_STATES:
+                return job
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise FreeNASApiError(
+                    'Job timeout', '%s job %s did not finish within %ss' %
+                    (op_type, job_id, timeout))
+            if wait_job:
+                # Events end the wait as soon as the job finishes, the
+                # poll above only covers events missed while reconnecting.
+                job = wait_job(job_id, min(self.MAX_POLL_INTERVAL,
+                                           remaining))
+                if job:
+                    return job
+            else:
+                time.sleep(min(interval, remaining))
+                interval = min(interval * 2, self.MAX_POLL_INTERVAL)
+
+    def wait_all(self, job_ids, op_type='default', timeout=None):
+        """Waits for several jobs, returns the finished jobs in order."""
+        if timeout is None:
+            timeout = self.get_timeout(op_type)
+        deadline = time.monotonic() + timeout
+        return [self.wait(job_id, op_type,
+                          max(deadline - time.monotonic(), 0))
+                for job_id in job_ids]
+
+    def to_response(self, job, ret):
+        """Builds the FreeNASResponse of a finished job."""
+        if job.get('state') == 'SUCCESS':
+            return ret._replace(
+                response=json.dumps(job.get('result')).encode('utf8'))
+        LOG.info('Job %s returned error: "%s"', job.get('id'),
+                 job.get('error'))
+        return ret._replace(status=FreeNASServer.STATUS_ERROR,
+                            response='422:%s' % job.get('error'),
+                            code=422)
+
+    def invoke(self, command_d, request_d, param_list, op_type='default',
+               wait=True, retry=None):
+        """Invokes api and waits for the job it starts, if any.
+
+           Returns the FreeNASResponse of the call, with the job result as
+           response once the job finished. With wait=False the response
+           of a job is its id, to be waited for later with wait_all.
+           retry is passed on to invoke_command.
+        """
+        ret = self._server.invoke_command(command_d, request_d, param_list,
+                                          retry)
+        job_id = self.get_job_id(ret)
+        if job_id is None or not wait:
+            return ret
+        LOG.debug('Waiting for %s job %s', op_type, job_id)
+        return self.to_response(self.wait(job_id, op_type), ret)
+
+
 class FreeNASApiError(Exception):
     """Base exception class for FREENAS api errors."""
 
@@ -0,0 +1,376 @@
+# Copyright (c) 2016 iXsystems
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+TrueNAS websocket api for iXsystems FREENAS system.
+
+Contains the JSON-RPC 2.0 websocket transport, an alternative to the REST
+transport of freenasapi with the same FreeNASServer interface. All calls
+share one long-lived authenticated connection and are matched to their
+responses by message id, so many calls can be in flight at once. The
+/api/current endpoint is served by TrueNAS 25.04 and later.
+"""
+
+import itertools
+import simplejson as json
+import ssl
+import threading
+import time
+import urllib.parse
+import uuid
+
+from cinder.volume.drivers.ixsystems.freenasapi import FreeNASApiError
+from cinder.volume.drivers.ixsystems.freenasapi import FreeNASResponse
+from cinder.volume.drivers.ixsystems.freenasapi import FreeNASServer
+from oslo_log import log as logging
+
+try:
+    import websocket
+except ImportError:
+    websocket = None
+
+LOG = logging.getLogger(__name__)
+
+
+class _PendingCall(object):
+    """A call waiting for its response on a websocket connection."""
+
+    __slots__ = ('ws', 'event', 'message')
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.event = threading.Event()
+        self.message = None
+
+
+class FreeNASWebSocketServer(FreeNASServer):
+    """TrueNAS middleware connection over the JSON-RPC websocket API.
+
+       REST style requests given to invoke_command are translated to the
+       middleware methods the REST api would call, and results are
+       returned as JSON encoded bytes exactly like the REST transport.
+    """
+
+    TRANSPORT_TYPES = ('ws', 'wss')
+    WEBSOCKET_PATH = '/api/current'
+    CALL_TIMEOUT = 600
+
+    # REST collections served by CRUD services. A path outside of these
+    # names the middleware method itself, e.g. /zfs/snapshot/clone.
+    CRUD_NAMESPACES = ('pool.dataset', 'zfs.snapshot', 'iscsi.target',
+                       'iscsi.extent', 'iscsi.targetextent',
+                       'iscsi.initiator', 'iscsi.portal', 'tunable')
+    # Methods read with GET that take no query arguments.
+    PLAIN_METHODS = ('system.version', 'system.info', 'core.ping',
+                     'pool.dataset.compression_choices')
+    # Methods taking several arguments, REST accepts those as an object
+    # keyed by argument name.
+    METHOD_ARGS = {'core.bulk': ('method', 'params', 'description'),
+                   'zfs.snapshot.rollback': ('id', 'options')}
+
+    JOBS_COLLECTION = 'core.get_jobs'
+    JOB_FINAL_STATES = ('SUCCESS', 'FAILED', 'ABORTED')
+    MAX_TRACKED_JOBS = 1000
+
+    def __init__(self, *args, **kwargs):
+        self._ws = None
+        self._ws_lock = threading.Lock()
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._jobs = {}
+        self._jobs_cond = threading.Condition()
+        super(FreeNASWebSocketServer, self).__init__(*args, **kwargs)
+
+    def get_url(self):
+        """Returns websocket connection string."""
+        return '%s://%s%s' % (self._protocol, self._host,
+                              self.WEBSOCKET_PATH)
+
+    def _reset_pool(self):
+        """Closes the websocket after host or transport changes."""
+        with self._ws_lock:
+            ws, self._ws = self._ws, None
+        if ws is not None:
+            ws.close()
+
+    def _get_connection(self):
+        with self._ws_lock:
+            if self._ws is None:
+                self._ws = self._connect()
+            return self._ws
+
+    def _connect(self):
+        """Opens, authenticates and subscribes a websocket connection."""
+        if websocket is None:
+            raise FreeNASApiError(
+                'Transport not available',
+                'websocket-client is required for the %s transport' %
+                self._protocol)
+        LOG.debug('Connecting to %s', self.get_url())
+        ws = websocket.create_connection(
+            self.get_url(), enable_multithread=True,
+            sslopt={'cert_reqs': ssl.CERT_NONE, 'check_hostname': False})
+        reader = threading.Thread(target=self._read_loop, args=(ws,))
+        reader.daemon = True
+        reader.start()
+        try:
+            if self._apikey != '':
+                login = self._call_on(ws, 'auth.login_with_api_key',
+                                      [self._apikey])
+            elif self._username != '' and self._password != '':
+                login = self._call_on(ws, 'auth.login',
+                                      [self._username, self._password])
+            else:
+                raise ValueError(
+                    "Username and password, or API key is required")
+            if login.get('result') is not True:
+                raise FreeNASApiError(401, 'Authentication failed')
+            self._call_on(ws, 'core.subscribe', [self.JOBS_COLLECTION])
+        except Exception:
+            ws.close()
+            raise
+        return ws
+
+    def _read_loop(self, ws):
+        """Dispatches responses and events received on ws."""
+        try:
+            while True:
+                try:
+                    raw = ws.recv()
+                except Exception as e:
+                    LOG.debug('Websocket connection closed: %s', e)
+                    break
+                if not raw:
+                    break
+                try:
+                    self._dispatch(json.loads(raw))
+                except Exception as e:
+                    LOG.warning('Ignoring websocket message %.200r: %s',
+                                raw, e)
+        finally:
+            self._on_connection_lost(ws)
+
+    def _dispatch(self, message):
+        """Hands a response to its caller or records an event."""
+        if not isinstance(message, dict):
+            raise ValueError('not a JSON-RPC message')
+        if message.get('id') is not None:
+            with self._pending_lock:
+                pending = self._pending.pop(message['id'], None)
+            if pending is not None:
+                pending.message = message
+                pending.event.set()
+        elif message.get('method') == 'collection_update':
+            self._on_collection_update(message.get('params') or {})
+
+    def _on_connection_lost(self, ws):
+        """Fails the calls waiting on ws and drops it for a reconnect."""
+        # Fail calls still waiting on ws before taking _ws_lock, a login
+        # in progress holds that lock while it waits for its response.
+        with self._pending_lock:
+            lost = [call_id for call_id, pending in self._pending.items()
+                    if pending.ws is ws]
+            lost = [self._pending.pop(call_id) for call_id in lost]
+        for pending in lost:
+            pending.event.set()
+        with self._ws_lock:
+            if self._ws is ws:
+                self._ws = None
+        try:
+            ws.close()
+        except Exception:
+            pass
+
+    def _on_collection_update(self, params):
+        """Records job state changes pushed by the middleware."""
+        if params.get('collection') != self.JOBS_COLLECTION:
+            return
+        with self._jobs_cond:
+            job = self._jobs.pop(params.get('id'), {})
+            job.update(params.get('fields') or {})
+            self._jobs[params.get('id')] = job
+            if len(self._jobs) > self.MAX_TRACKED_JOBS:
+                for job_id in list(self._jobs):
+                    if len(self._jobs) <= self.MAX_TRACKED_JOBS:
+                        break
+                    if (self._jobs[job_id].get('state') in
+                            self.JOB_FINAL_STATES):
+                        del self._jobs[job_id]
+            self._jobs_cond.notify_all()
+
+    def wait_job(self, job_id, timeout):
+        """Waits for job state events until job_id finishes.
+
+           Returns the last known job fields, or None if no final state
+           was received within timeout seconds.
+        """
+        deadline = time.monotonic() + timeout
+        with self._jobs_cond:
+            while True:
+                job = self._jobs.get(job_id)
+                if job and job.get('state') in self.JOB_FINAL_STATES:
+                    return dict(job)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._jobs_cond.wait(remaining)
+
+    def _call_on(self, ws, method, params, timeout=CALL_TIMEOUT):
+        """Sends a JSON-RPC request on ws and waits for its response."""
+        call_id = next(self._ids)
+        pending = _PendingCall(ws)
+        with self._pending_lock:
+            self._pending[call_id] = pending
+        try:
+            ws.send(json.dumps({'jsonrpc': '2.0', 'id': call_id,
+                                'method': method, 'params': params}))
+            if not pending.event.wait(timeout):
+                raise TimeoutError('No response to %s within %ss' %
+                                   (method, timeout))
+        finally:
+            with self._pending_lock:
+                self._pending.pop(call_id, None)
+        if pending.message is None:
+            raise ConnectionError('Connection lost during %s' % method)
+        return pending.message
+
+    @staticmethod
+    def _convert(value):
+        """Converts a query string value like the REST api does."""
+        if value.isdigit():
+            return int(value)
+        if value.lower() in ('true', 'false'):
+            return value.lower() == 'true'
+        return value
+
+    def _get_rpc_call(self, http_method, request_d, param_list):
+        """Translates a REST request into a middleware method and params."""
+        url = urllib.parse.urlsplit(request_d)
+        parts = [part for part in url.path.split('/') if part]
+        obj_id = action = None
+        if 'id' in parts:
+            idx = parts.index('id')
+            obj_id = self._convert(urllib.parse.unquote_plus(parts[idx + 1]))
+            action = parts[idx + 2] if len(parts) > idx + 2 else None
+            parts = parts[:idx]
+        namespace = '.'.join(parts)
+        body = json.loads(param_list) if param_list else None
+
+        if http_method == 'GET':
+            if obj_id is not None:
+                return '%s.get_instance' % namespace, [obj_id]
+            if namespace in self.PLAIN_METHODS:
+                return namespace, []
+            filters = []
+            options = {}
+            for key, value in urllib.parse.parse_qsl(url.query):
+                if key in ('limit', 'offset'):
+                    options[key] = int(value)
+                elif key == 'sort':
+                    options['order_by'] = value.split(',')
+                else:
+                    field, _, op = key.partition('__')
+                    filters.append([field, op or '=', self._convert(value)])
+            if namespace in self.CRUD_NAMESPACES:
+                namespace = '%s.query' % namespace
+            return namespace, [filters, options]
+
+        if http_method == 'PUT':
+            return '%s.update' % namespace, [obj_id, body]
+        if http_method == 'DELETE':
+            params = [obj_id]
+            if body is not None:
+                params.append(body)
+            return '%s.delete' % namespace, params
+
+        # POST
+        if obj_id is not None:
+            params = [obj_id]
+            if body is not None:
+                params.append(body)
+            return '%s.%s' % (namespace, action), params
+        if namespace in self.CRUD_NAMESPACES:
+            return '%s.create' % namespace, [body]
+        if isinstance(body, list):
+            return namespace, body
+        if namespace in self.METHOD_ARGS and isinstance(body, dict):
+            return namespace, [body[arg] for arg in
+                               self.METHOD_ARGS[namespace] if arg in body]
+        return namespace, [] if body is None else [body]
+
+    def _get_rpc_error_info(self, error):
+        """Maps a JSON-RPC error to the REST style error response."""
+        data = error.get('data') or {}
+        reason = data.get('reason') or error.get('message')
+        if data.get('errname') == 'ENOENT' or error.get('code') == -32601:
+            code = 404
+        elif data.get('errname') == 'ENOTAUTHENTICATED':
+            code = 401
+        else:
+            code = 422
+        LOG.info('Error returned from server: "%s"', reason)
+        return FreeNASResponse(self.STATUS_ERROR, '%d:%s' % (code, reason),
+                               code=code)
+
+    def _invoke(self, method, params, request_d=None, timeout=CALL_TIMEOUT):
+        """Calls middleware method and returns FreeNASResponse object."""
+        request_id = uuid.uuid4().hex
+        LOG.debug('invoke_command %s : %s %s', request_id, method, params)
+        start = time.monotonic()
+        try:
+            message = self._call_on(self._get_connection(), method, params,
+                                    timeout)
+        except (FreeNASApiError, ValueError):
+            raise
+        except Exception as e:
+            response = FreeNASResponse(
+                self.STATUS_ERROR,
+                '%s:%s' % (str(getattr(e, 'errno', None)),
+                           getattr(e, 'strerror', None) or str(e)))
+        else:
+            if message.get('error'):
+                response = self._get_rpc_error_info(message['error'])
+            else:
+                response = FreeNASResponse(
+                    self.STATUS_OK,
+                    json.dumps(message.get('result')).encode('utf8'))
+        response = response._replace(latency=time.monotonic() - start,
+                                     request_id=request_id)
+        LOG.debug("invoke_command : response for %s : %s",
+                  method, json.dumps(response))
+        return response
+
+    def query(self, request_d, filters=None, options=None):
+        """Runs a filtered query, selecting fields on the server."""
+        method, params = self._get_rpc_call('GET', request_d, None)
+        options = dict(options or {})
+        if 'sort' in options:
+            options['order_by'] = options.pop('sort')
+        params = [[list(f) for f in filters or []], options]
+        return self._single_flight(
+            (method, json.dumps(params, sort_keys=True)),
+            lambda: self._call(self.SELECT_COMMAND, request_d,
+                               lambda timeout: self._invoke(
+                                   method, params, request_d, timeout)),
+            self._may_reuse(request_d))
+
+    def _send(self, command_d, request_d, param_list, timeout=CALL_TIMEOUT):
+        """Sends a call once and returns FreeNASResponse object."""
+        http_method = self._get_method(command_d)
+        if not http_method:
+            raise FreeNASApiError("Invalid FREENAS command")
+        method, params = self._get_rpc_call(http_method, request_d,
+                                            param_list)
+        return self._invoke(method, params, request_d, timeout)
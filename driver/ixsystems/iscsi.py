@@ -18,11 +18,16 @@ Volume driver for iXsystems iSCSI storage systems.
 This driver requires iXsystems storage systems with installed iSCSI licenses.
 """
 
+from concurrent import futures
 import simplejson as json
 import re
 
+from cinder import exception
+from cinder.objects import fields
 from cinder.volume import driver
+from cinder.volume import volume_types
 from cinder.volume.drivers.ixsystems import common
+from cinder.volume.drivers.ixsystems import freenasapi
 from cinder.volume.drivers.ixsystems.options import ixsystems_basicauth_opts
 from cinder.volume.drivers.ixsystems.options import ixsystems_apikeyauth_opts
 from cinder.volume.drivers.ixsystems.options import ixsystems_connection_opts
@@ -31,11 +36,17 @@ from cinder.volume.drivers.ixsystems.options import ixsystems_transport_opts
 from cinder.volume.drivers.ixsystems.freenasapi import FreeNASApiError
 from cinder.volume.drivers.ixsystems import utils as ix_utils
 from cinder import context
-import cinder.db.api as cinderapi
 from cinder.message import api
 from cinder.message.message_field import Action, Detail
 from oslo_config import cfg
 from oslo_log import log as logging
+from oslo_utils import excutils
+
+try:
+    from cinder.volume import volume_utils
+except ImportError:
+    # Train and older
+    from cinder.volume import utils as volume_utils
 
 LOG = logging.getLogger(__name__)
 
@@ -51,7 +62,6 @@ class FreeNASISCSIDriver(driver.ISCSIDriver):
     """FREENAS iSCSI volume driver."""
 
     VERSION = "2.0.0"
-    IGROUP_PREFIX = 'openstack-'
 
     required_flags = ['ixsystems_transport_type', 'ixsystems_server_hostname',
                       'ixsystems_server_port', 'ixsystems_server_iscsi_port',
@@ -88,6 +98,9 @@ class FreeNASISCSIDriver(driver.ISCSIDriver):
         # truenas array
         self.check_for_setup_error()
         self.common._do_custom_setup()
+        self.common._start_stats_collector()
+        self.common._start_clone_flattener()
+        self.common._start_deferred_reaper()
 
     def create_volume(self, volume):
         """Creates a volume of specified size and export it as iscsi target."""
@@ -104,11 +117,13 @@ class FreeNASISCSIDriver(driver.ISCSIDriver):
         freenas_volume['size'] = volume['size']
         freenas_volume['target_size'] = volume['size']
 
+        specs = self._get_volume_type_specs(volume['volume_type_id'])
+        properties = self.common._get_zvol_properties(specs)
+        extent_properties = self.common._get_extent_properties(specs)
         self.common._create_volume(freenas_volume['name'],
-                                   freenas_volume['size'])
+                                   freenas_volume['size'], properties)
         # Remove LUN Creation from here,check at initi
-        self.common._create_iscsitarget(freenas_volume['target'],
-                                        freenas_volume['name'])
+        self._export_new_volume(freenas_volume, extent_properties)
 
     def delete_volume(self, volume):
         """Deletes volume and corresponding iscsi target."""
@@ -122,13 +137,53 @@ class FreeNASISCSIDriver(driver.ISCSIDriver):
         if freenas_volume['target']:
             self.common._delete_iscsitarget(freenas_volume['target'])
         if freenas_volume['name']:
-            self.common._delete_volume(freenas_volume['name'])
+            try:
+                self.common._delete_volume(freenas_volume['name'])
+            except exception.VolumeIsBusy:
+                if not self.configuration.ixsystems_deferred_delete:
+                    raise
+                # Unexported above, destroyed once its clones are gone.
+                self.common._defer_delete_volume(freenas_volume['name'])
+
+    def _export_new_volume(self, freenas_volume, extent_properties):
+        """Exports a new volume, unless exports are created lazily."""
+        if self.configuration.ixsystems_lazy_export:
+            # Known not to be exported, the first attach needs no lookup.
+            self.common.inventory.update(freenas_volume['target'], target=0,
+                                         extent=0, targetextent=0)
+            return
+        self.common._create_iscsitarget(freenas_volume['target'],
+                                        freenas_volume['name'],
+                                        extent_properties)
+
+    def _ensure_lazy_export(self, volume):
+        """Creates the export of volume if exports are created lazily."""
+        if not self.configuration.ixsystems_lazy_export:
+            return
+        freenas_volume = ix_utils.generate_freenas_volume_name(
+            volume['name'], self.configuration.ixsystems_iqn_prefix)
+        extent_properties = self.common._get_extent_properties(
+            self._get_volume_type_specs(volume['volume_type_id']))
+        self.common._ensure_iscsitarget(freenas_volume['target'],
+                                        freenas_volume['name'],
+                                        extent_properties)
+
+    def _remove_lazy_export(self, volume):
+        """Removes the export of volume once nothing is attached to it."""
+        if not self.configuration.ixsystems_lazy_export:
+            return
+        freenas_volume = ix_utils.generate_freenas_volume_name(
+            volume['name'], self.configuration.ixsystems_iqn_prefix)
+        if self.common.attachments.is_attached(freenas_volume['target']):
+            return
+        self.common._remove_iscsitarget(freenas_volume['target'])
 
     def create_export(self, context, volume, connector):
         """Driver entry point to get the export info for a new volume."""
         LOG.info('iXsystems Create Export')
         LOG.debug('create_export %s', volume['name'])
 
+        self._ensure_lazy_export(volume)
         handle = self.common._create_export(volume['name'])
         LOG.info('provider_location: %s', handle)
         return {'provider_location': handle}
@@ -138,6 +193,7 @@ class FreeNASISCSIDriver(driver.ISCSIDriver):
         LOG.info('iXsystems Ensure Export')
         LOG.debug('ensure_export %s', volume['name'])
 
+        self._ensure_lazy_export(volume)
         handle = self.common._create_export(volume['name'])
         LOG.info('provider_location: %s', handle)
         return {'provider_location': handle}
@@ -145,61 +201,40 @@ class FreeNASISCSIDriver(driver.ISCSIDriver):
     def remove_export(self, context, volume):
         """Driver exntry point to remove an export for a volume.
 
-           we have nothing to do for unexporting.
+           Only lazily created exports are removed, otherwise the export
+           lives as long as the volume.
         """
-        pass
+        LOG.debug('remove_export %s', volume['name'])
+        self._remove_lazy_export(volume)
 
-    def check_connection(self):
+    def check_connection(self, target, initiator):
+        """Admits an attach of target within the array LUN/port limits.
+
+           Counts the targets attached through this backend, seeded from
+           the array's live iSCSI sessions, so no Cinder DB scan is needed.
+        """
         # connection safety check for #27
-        if ix_utils.parse_truenas_version(self.common._system_version())[1] in ('12.0', '13.0'):
-            LOG.debug("Tunable: %s", str(self.common._tunable()))
-            tunable = self.common._tunable()
-            # Default value from Truenas 12 kern.cam.ctl.max_ports 256, kern.cam.ctl.max_luns 1024
-            # common._tunable() returns a list of dict [{'var':'kern.cam.ctl.max_luns','enabled':True,'value':'256'}
-            # ,{'var':'kern.cam.ctl.max_ports','enabled':True,'value':'1024'}]
-            # Retrive attach_max_allow from min value of common._tunable()
+        capabilities = self.common._get_capabilities()
+        attach_max_allow = None
+        if capabilities['features']['ctl_tunables']:
+            # Retrive attach_max_allow from min value of cached
             # kern.cam.ctl.max_luns and kern.cam.ctl.max_ports
-            max_ports, max_luns = 256, 1024
-            attach_max_allow = min(max_luns, max_ports)            
-            for item in tunable:
-                if (item.get('enabled') and
-                        item.get('var') == 'kern.cam.ctl.max_luns' and
-                        str(item.get('value')).isnumeric()):
-                    max_luns = int(item['value'])
-                if (item.get('enabled') and
-                        item.get('var') == 'kern.cam.ctl.max_ports' and
-                        str(item.get('value')).isnumeric()):
-                    max_ports = int(item['value'])
-            attach_max_allow = min(max_luns, max_ports)
+            attach_max_allow = min(capabilities['max_luns'],
+                                   capabilities['max_ports'])
+            if self.configuration.ixsystems_export_mode == 'shared':
+                # Shared targets use a fixed set of ports, every attached
+                # volume only takes a LUN.
+                attach_max_allow = capabilities['max_luns']
             LOG.debug("Tunable OS max_luns/max_ports: %s", attach_max_allow)
-
-            # check cinder driver already loaded before executing upstream code
-            if (len(cinderapi.CONF.list_all_sections()) > 0):
-                ctx = context.get_admin_context()
-                ctx.__setattr__("read_deleted", "no")
-                ctx.__setattr__("project_only", "True")
-                vols = cinderapi.volume_get_all(ctx)
-                attached_truenas_vol_count = 0                
-                attached_truenas_vol_count = len([vol for vol in vols
-                                                if vol.host and vol.host.find("@ixsystems-iscsi#") > 0
-                                                and vol.attach_status == 'attached'])
-                if (attached_truenas_vol_count >= attach_max_allow):
-                    LOG.error("Maximum lun/port limitation reached. Change kern.cam.ctl.max_luns and "
-                            + "kern.cam.ctl.max_ports in tunable settings to allow more lun attachments.")
-                    return False
+        if not self.common.attachments.admit(target, initiator,
+                                             attach_max_allow):
+            LOG.error("Maximum lun/port limitation reached. Change kern.cam.ctl.max_luns and "
+                      + "kern.cam.ctl.max_ports in tunable settings to allow more lun attachments.")
+            return False
         return True
 
+    @freenasapi.with_call_priority(freenasapi.PRIORITY_HIGH)
     def initialize_connection(self, volume, connector):
-        """Do connection validation for know faiture before return connection to upstream cinder manager"""
-        if self.check_connection() is False:
-            exception = FreeNASApiError('Maximum lun/port limitation reached. Change kern.cam.ctl.max_luns and '
-                                        + 'kern.cam.ctl.max_ports in tunable settings to allow more lun attachments.')
-            message_api = api.API()
-            ctx = context.get_admin_context()
-            ctx.project_id = volume.project_id
-            message_api.create(ctx, action=Action.ATTACH_VOLUME, resource_uuid=volume.id,
-                               exception=exception, detail=Detail.ATTACH_ERROR)
-            raise exception
         """Driver entry point to attach a volume to an instance."""
         LOG.info('iXsystems Initialise Connection')
         freenas_volume = ix_utils.generate_freenas_volume_name(
@@ -212,20 +247,66 @@ class FreeNASISCSIDriver(driver.ISCSIDriver):
                 volume['name'],
                 self.configuration.ixsystems_iqn_prefix)
 
+        # Do connection validation for know faiture before return
+        # connection to upstream cinder manager
+        if self.check_connection(freenas_volume['target'],
+                                 connector.get('initiator')) is False:
+            exception = FreeNASApiError('Maximum lun/port limitation reached. Change kern.cam.ctl.max_luns and '
+                                        + 'kern.cam.ctl.max_ports in tunable settings to allow more lun attachments.')
+            message_api = api.API()
+            ctx = context.get_admin_context()
+            ctx.project_id = volume.project_id
+            message_api.create(ctx, action=Action.ATTACH_VOLUME, resource_uuid=volume.id,
+                               exception=exception, detail=Detail.ATTACH_ERROR)
+            raise exception
+
         properties = {}
-        properties['target_discovered'] = False
-        properties['target_portal'] = ix_utils.get_iscsi_portal(
-            self.configuration.ixsystems_server_hostname,
-            self.configuration.ixsystems_server_iscsi_port)
-        properties['target_iqn'] = freenas_volume['iqn']
-        properties['volume_id'] = volume['id']
+        try:
+            self._ensure_lazy_export(volume)
+            if self.configuration.ixsystems_initiator_groups:
+                self.common._allow_host(freenas_volume['target'],
+                                        connector['host'],
+                                        connector['initiator'])
+            properties['target_discovered'] = False
+            export = self.common._get_export(freenas_volume['target'])
+            if connector.get('multipath'):
+                portals = self.common._get_portals()
+                properties['target_portals'] = portals
+                properties['target_iqns'] = [export['iqn']] * len(portals)
+                properties['target_luns'] = [export['lun']] * len(portals)
+                properties['target_portal'] = portals[0]
+            else:
+                properties['target_portal'] = self.common._select_portal(
+                    freenas_volume['target'], connector.get('initiator'))
+            properties['target_iqn'] = export['iqn']
+            properties['target_lun'] = export['lun']
+            properties['volume_id'] = volume['id']
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                self.common.attachments.release(freenas_volume['target'],
+                                                connector.get('initiator'))
 
         LOG.debug('initialize_connection data: %s', properties)
         return {'driver_volume_type': 'iscsi', 'data': properties}
 
+    @freenasapi.with_call_priority(freenasapi.PRIORITY_HIGH)
     def terminate_connection(self, volume, connector, **kwargs):
         """Driver entry point to detach a volume from an instance."""
-        pass
+        freenas_volume = ix_utils.generate_freenas_volume_name(
+            volume['name'],
+            self.configuration.ixsystems_iqn_prefix)
+        # A connector of None detaches the volume from every host.
+        self.common.attachments.release(
+            freenas_volume['target'],
+            connector.get('initiator') if connector else None)
+        self.common._release_portal(
+            freenas_volume['target'],
+            connector.get('initiator') if connector else None)
+        if self.configuration.ixsystems_initiator_groups and connector:
+            self.common._disallow_host(freenas_volume['target'],
+                                       connector['host'],
+                                       connector['initiator'])
+        self._remove_lazy_export(volume)
 
     def create_snapshot(self, snapshot):
         """Driver entry point for creating a snapshot."""
@@ -244,16 +325,48 @@ class FreeNASISCSIDriver(driver.ISCSIDriver):
         """Driver entry point for deleting a snapshot."""
         LOG.info('iXsystems Delete Snapshot')
         LOG.debug('delete_snapshot %s', snapshot['name'])
-        freenas_snapshot = ix_utils.generate_freenas_snapshot_name(
-            snapshot['name'],
-            self.configuration.ixsystems_iqn_prefix)
         freenas_volume = ix_utils.generate_freenas_volume_name(
             snapshot['volume_name'],
             self.configuration.ixsystems_iqn_prefix)
 
-        self.common._delete_snapshot(freenas_snapshot['name'],
+        self.common._delete_snapshot(self._get_snapshot_name(snapshot),
                                      freenas_volume['name'])
 
+    def _get_snapshot_name(self, snapshot):
+        """Returns the ZFS snapshot name of a Cinder snapshot.
+
+           Members of a group snapshot share the name of the group's ZFS
+           snapshot, which is kept in their provider_location.
+        """
+        if snapshot.get('provider_location'):
+            return snapshot['provider_location']
+        return ix_utils.generate_freenas_snapshot_name(
+            snapshot['name'], self.configuration.ixsystems_iqn_prefix)['name']
+
+    def snapshot_revert_use_temp_snapshot(self):
+        # A ZFS rollback either completes or changes nothing, and a
+        # backup snapshot would be newer than every snapshot reverted to.
+        return False
+
+    def revert_to_snapshot(self, context, volume, snapshot):
+        """Rolls a volume back to a snapshot on the array.
+
+           Raises NotImplementedError, so Cinder reverts generically, when
+           newer snapshots would have to be destroyed.
+        """
+        LOG.info('iXsystems Revert To Snapshot')
+        LOG.debug('revert_to_snapshot %s to %s', volume['name'],
+                  snapshot['name'])
+        freenas_volume = ix_utils.generate_freenas_volume_name(
+            volume['name'], self.configuration.ixsystems_iqn_prefix)
+
+        self.common._rollback_snapshot(self._get_snapshot_name(snapshot),
+                                       freenas_volume['name'])
+        # Rolling back restores the size the volume had at the snapshot.
+        if volume['size'] > snapshot['volume_size']:
+            self.common._extend_volume(freenas_volume['name'],
+                                       volume['size'])
+
     def create_volume_from_snapshot(self, volume, snapshot):
         """Creates a volume from snapshot."""
         LOG.info('iXsystems Create Volume From Snapshot')
@@ -261,18 +374,32 @@ class FreeNASISCSIDriver(driver.ISCSIDriver):
 
         existing_vol = ix_utils.generate_freenas_volume_name(
             snapshot['volume_name'], self.configuration.ixsystems_iqn_prefix)
-        freenas_snapshot = ix_utils.generate_freenas_snapshot_name(
-            snapshot['name'], self.configuration.ixsystems_iqn_prefix)
+        snapshot_name = self._get_snapshot_name(snapshot)
         freenas_volume = ix_utils.generate_freenas_volume_name(
             volume['name'], self.configuration.ixsystems_iqn_prefix)
         freenas_volume['size'] = volume['size']
         freenas_volume['target_size'] = volume['size']
 
-        self.common._create_volume_from_snapshot(freenas_volume['name'],
-                                                 freenas_snapshot['name'],
-                                                 existing_vol['name'])
-        self.common._create_iscsitarget(freenas_volume['target'],
-                                        freenas_volume['name'])
+        specs = self._get_volume_type_specs(volume['volume_type_id'])
+        properties = self.common._get_zvol_properties(specs)
+        extent_properties = self.common._get_extent_properties(specs)
+        clone_mode = self.common._get_clone_mode(specs)
+        if clone_mode == 'full':
+            self.common._copy_volume_from_snapshot(freenas_volume['name'],
+                                                   snapshot_name,
+                                                   existing_vol['name'])
+        else:
+            self.common._create_volume_from_snapshot(freenas_volume['name'],
+                                                     snapshot_name,
+                                                     existing_vol['name'])
+        # A clone shares the origin's blocks, so only properties that
+        # can change on an existing zvol are applied.
+        if 'volblocksize' in properties:
+            LOG.warning('create_volume_from_snapshot: %s keeps the '
+                        'volblocksize of %s', freenas_volume['name'],
+                        existing_vol['name'])
+        self.common._update_zvol(freenas_volume['name'], properties)
+        self._export_new_volume(freenas_volume, extent_properties)
 
         # Promote image cache volume created by cinder service account
         # by checking project_id is cinder service project and display name match
@@ -280,17 +407,69 @@ class FreeNASISCSIDriver(driver.ISCSIDriver):
         # This is required because image cache volume cloned from the snapshot of first volume
         # provisioned by this image from upstream cinder flow code
         # Without promoting image cache volume, the first volume created can no longer be deleted
-        if (self.configuration.safe_get('image_volume_cache_enabled')
+        if (clone_mode == 'linked'
+            and self.configuration.safe_get('image_volume_cache_enabled')
             and self.common._is_service_project(volume['project_id'])
             and re.match(r"image-[a-zA-Z0-9]+-[a-z0-9]+-[a-z0-9]+-[a-z0-9]+-[a-z0-9]+",
                          volume['display_name'])):
             self.common._promote_volume(freenas_volume['name'])
 
+    def _get_volume_type_specs(self, volume_type_id):
+        """Returns the extra specs of a volume type, {} without one."""
+        if not volume_type_id:
+            return {}
+        return volume_types.get_volume_type_extra_specs(volume_type_id)
+
+    def retype(self, ctxt, volume, new_type, diff, host):
+        """Applies the zvol and extent properties of new_type in place.
+
+           Returns False, so Cinder migrates the volume, when the new host
+           is another backend or volblocksize, sparse, provisioning:type or
+           the extent blocksize change.
+        """
+        LOG.info('iXsystems Retype')
+        LOG.debug('retype %s to %s : %s', volume['name'], new_type['name'],
+                  diff)
+        backend_name = host.get('capabilities', {}).get('volume_backend_name')
+        if backend_name != self.configuration.ixsystems_volume_backend_name:
+            return False
+        changed_specs = dict(
+            (key, None) for key, (old, new) in
+            (diff.get('extra_specs') or {}).items() if old != new)
+        changed = ix_utils.get_ixsystems_specs(changed_specs)
+        # The extent blocksize is the logical sector size data was
+        # written with, it must not change under an existing volume.
+        if ('volblocksize' in changed or 'sparse' in changed or
+                'blocksize' in changed or
+                'provisioning:type' in changed_specs):
+            return False
+        specs = self._get_volume_type_specs(new_type['id'])
+        properties = self.common._get_zvol_properties(specs)
+        extent_properties = self.common._get_extent_properties(specs)
+        params = {}
+        for spec, field in self.common.ZVOL_UPDATABLE_SPECS:
+            if spec in changed:
+                # A spec the new type drops goes back to the pool value.
+                params[field] = properties.get(field, 'INHERIT')
+        extent_params = {}
+        for field, default in self.common.EXTENT_DEFAULTS.items():
+            if field in changed:
+                extent_params[field] = extent_properties.get(field, default)
+        freenas_volume = ix_utils.generate_freenas_volume_name(
+            volume['name'], self.configuration.ixsystems_iqn_prefix)
+        self.common._update_zvol(freenas_volume['name'], params)
+        # A lazily exported volume may have no extent, its next export
+        # is created with the extent specs of the new type.
+        self.common._update_extent(
+            freenas_volume['target'], extent_params,
+            missing_ok=self.configuration.ixsystems_lazy_export)
+        return True
+
     def get_volume_stats(self, refresh=False):
         """Get stats info from volume group / pool."""
         LOG.info('iXsystems Get Volume Status')
         if refresh:
-            self.stats = self.common._update_volume_stats()
+            self.stats = self.common._get_volume_stats()
         LOG.info('get_volume_stats: %s', self.stats)
         return self.stats
 
@@ -304,12 +483,155 @@ class FreeNASISCSIDriver(driver.ISCSIDriver):
 
         self.create_snapshot(temp_snapshot)
         self.create_volume_from_snapshot(volume, temp_snapshot)
-        # self.delete_snapshot(temp_snapshot)
+        clone_mode = self.common._get_clone_mode(
+            self._get_volume_type_specs(volume['volume_type_id']))
+        if clone_mode == 'full':
+            # A full copy does not depend on the temporary snapshot.
+            self.delete_snapshot(temp_snapshot)
+        # For linked clones self.delete_snapshot(temp_snapshot)
         # with API v2.0 this causes FreeNAS error
         # "snapshot has dependent clones".  Cannot delete while volume is
         # active.  Instead, added check and deletion of orphaned dependent
         # clones in common._delete_volume()
 
+    def _check_cg_type(self, group):
+        """Raises NotImplementedError unless group is a consistency group.
+
+           Cinder handles other groups generically, one volume at a time.
+        """
+        if not volume_utils.is_group_a_cg_snapshot_type(group):
+            raise NotImplementedError()
+
+    def create_group(self, context, group):
+        """Creates a consistency group, nothing is needed on the array."""
+        LOG.info('iXsystems Create Group')
+        self._check_cg_type(group)
+        LOG.debug('create_group %s', group.id)
+        return {'status': fields.GroupStatus.AVAILABLE}
+
+    def delete_group(self, context, group, volumes):
+        """Deletes a consistency group and its volumes."""
+        LOG.info('iXsystems Delete Group')
+        self._check_cg_type(group)
+        LOG.debug('delete_group %s', group.id)
+        model_update = {'status': fields.GroupStatus.DELETED}
+        volumes_model_update = []
+        for volume in volumes:
+            try:
+                self.delete_volume(volume)
+                status = 'deleted'
+            except Exception as e:
+                LOG.error('delete_group: failed to delete %s: %s',
+                          volume['name'], e)
+                status = 'error_deleting'
+                model_update['status'] = fields.GroupStatus.ERROR_DELETING
+            volumes_model_update.append({'id': volume.id,
+                                         'status': status})
+        return model_update, volumes_model_update
+
+    def update_group(self, context, group, add_volumes=None,
+                     remove_volumes=None):
+        """Changes consistency group members, nothing is needed on the array."""
+        LOG.info('iXsystems Update Group')
+        self._check_cg_type(group)
+        return None, None, None
+
+    def create_group_snapshot(self, context, group_snapshot, snapshots):
+        """Takes one atomic snapshot of all volumes of a consistency group.
+
+           The ZFS snapshot name of the members is returned as their
+           provider_location.
+        """
+        LOG.info('iXsystems Create Group Snapshot')
+        self._check_cg_type(group_snapshot)
+        name = ix_utils.generate_freenas_group_snapshot_name(
+            group_snapshot.id)
+        LOG.debug('create_group_snapshot %s as %s', group_snapshot.id, name)
+        self.common._create_group_snapshot(name, [
+            ix_utils.generate_freenas_volume_name(
+                snapshot['volume_name'],
+                self.configuration.ixsystems_iqn_prefix)['name']
+            for snapshot in snapshots])
+        snapshots_model_update = [
+            {'id': snapshot.id, 'provider_location': name,
+             'status': fields.SnapshotStatus.AVAILABLE}
+            for snapshot in snapshots]
+        return ({'status': fields.GroupSnapshotStatus.AVAILABLE},
+                snapshots_model_update)
+
+    def delete_group_snapshot(self, context, group_snapshot, snapshots):
+        """Deletes the member snapshots of a consistency group snapshot."""
+        LOG.info('iXsystems Delete Group Snapshot')
+        self._check_cg_type(group_snapshot)
+        LOG.debug('delete_group_snapshot %s', group_snapshot.id)
+        members = {}
+        for snapshot in snapshots:
+            members.setdefault(self._get_snapshot_name(snapshot), []).append(
+                ix_utils.generate_freenas_volume_name(
+                    snapshot['volume_name'],
+                    self.configuration.ixsystems_iqn_prefix)['name'])
+        for name, volume_names in members.items():
+            self.common._delete_group_snapshot(name, volume_names)
+        snapshots_model_update = [
+            {'id': snapshot.id, 'status': fields.SnapshotStatus.DELETED}
+            for snapshot in snapshots]
+        return ({'status': fields.GroupSnapshotStatus.DELETED},
+                snapshots_model_update)
+
+    def create_group_from_src(self, context, group, volumes,
+                              group_snapshot=None, snapshots=None,
+                              source_group=None, source_vols=None):
+        """Creates a consistency group from a group snapshot or group.
+
+           A source group is first snapshotted atomically. The volumes
+           are then cloned from the member snapshots concurrently.
+        """
+        LOG.info('iXsystems Create Group From Source')
+        self._check_cg_type(group)
+        temp_name = None
+        if group_snapshot:
+            sources = snapshots
+        else:
+            temp_name = ix_utils.generate_freenas_group_snapshot_name(
+                group.id)
+            self.common._create_group_snapshot(temp_name, [
+                ix_utils.generate_freenas_volume_name(
+                    src_vref['name'],
+                    self.configuration.ixsystems_iqn_prefix)['name']
+                for src_vref in source_vols])
+            sources = [{'name': temp_name,
+                        'volume_name': src_vref['name'],
+                        'volume_size': src_vref['size'],
+                        'provider_location': temp_name}
+                       for src_vref in source_vols]
+        LOG.debug('create_group_from_src %s from %s', group.id,
+                  ', '.join(source['volume_name'] for source in sources))
+        with futures.ThreadPoolExecutor(
+                max_workers=self.configuration.ixsystems_api_workers) as pool:
+            pending = [pool.submit(self.create_volume_from_snapshot,
+                                   volume, source)
+                       for volume, source in zip(volumes, sources)]
+        errors = [future.exception() for future in pending
+                  if future.exception()]
+        if temp_name:
+            # Linked clones keep their origin snapshots until deleted.
+            self.common._delete_group_snapshot(temp_name, [
+                ix_utils.generate_freenas_volume_name(
+                    source['volume_name'],
+                    self.configuration.ixsystems_iqn_prefix)['name']
+                for source in sources])
+        if errors:
+            raise errors[0]
+        volumes_model_update = []
+        for volume in volumes:
+            model_update = {'id': volume.id, 'status': 'available'}
+            # Lazily exported volumes get their location on first export.
+            if not self.configuration.ixsystems_lazy_export:
+                model_update['provider_location'] = (
+                    self.common._create_export(volume['name']))
+            volumes_model_update.append(model_update)
+        return None, volumes_model_update
+
     def extend_volume(self, volume, new_size):
         """Driver entry point to extend an existing volumes size."""
         LOG.info('iXsystems Extent Volume')
@@ -39,12 +39,107 @@ ixsystems_connection_opts = [
                help='vendor name on Storage controller'),
     cfg.StrOpt('ixsystems_storage_protocol',
                default='iscsi',
-               help='storage protocol on Storage controller'), ]
+               help='storage protocol on Storage controller'),
+    cfg.IntOpt('ixsystems_capabilities_ttl',
+               default=3600,
+               min=0,
+               help='Seconds the storage controller version, CTL limits '
+                    'and feature flags are cached before probing again'),
+    cfg.StrOpt('ixsystems_capabilities_cache_file',
+               default=None,
+               help='File to persist the cached storage controller '
+                    'capabilities to, so a restart does not probe again. '
+                    'Not persisted if unset'),
+    cfg.IntOpt('ixsystems_keystone_cache_ttl',
+               default=3600,
+               min=0,
+               help='Seconds the service or non-service classification '
+                    'of a project is cached for the image volume cache'), ]
 
 ixsystems_transport_opts = [
     cfg.StrOpt('ixsystems_transport_type',
                default='http',
-               help='Transport type protocol'), ]
+               choices=['http', 'https', 'ws', 'wss'],
+               help='Transport type protocol. http and https use the REST '
+                    'API, ws and wss the JSON-RPC websocket API served at '
+                    '/api/current by TrueNAS 25.04 and later'),
+    cfg.IntOpt('ixsystems_connection_pool_size',
+               default=4,
+               min=1,
+               help='Maximum number of persistent keep-alive connections '
+                    'kept open to the storage controller'),
+    cfg.IntOpt('ixsystems_connection_idle_timeout',
+               default=60,
+               min=0,
+               help='Seconds an idle pooled connection to the storage '
+                    'controller is kept open before it is closed'),
+    cfg.IntOpt('ixsystems_api_workers',
+               default=4,
+               min=1,
+               help='Maximum number of independent API calls a single '
+                    'driver operation issues concurrently'),
+    cfg.DictOpt('ixsystems_job_timeouts',
+                default={'default': '300', 'clone': '300', 'delete': '600',
+                         'promote': '300', 'snapshot': '300'},
+                help='Seconds to wait for a TrueNAS middleware job to '
+                     'finish, by operation type. Types without an entry '
+                     'use the default entry'),
+    cfg.DictOpt('ixsystems_call_timeouts',
+                default={'select': '30', 'create': '120', 'update': '120',
+                         'delete': '120'},
+                help='Seconds to wait for the response to a single API '
+                     'call, by command: select, create, update or delete. '
+                     'Commands without an entry use the default entry'),
+    cfg.IntOpt('ixsystems_api_retries',
+               default=3,
+               min=0,
+               help='Number of times an API call is retried while the '
+                    'storage controller is unreachable. Reads and deletes '
+                    'are retried, and so are creates, whose objects are '
+                    'looked up by name only when a retry finds them '
+                    'already created'),
+    cfg.FloatOpt('ixsystems_api_retry_backoff',
+                 default=0.5,
+                 min=0,
+                 help='Seconds of the first retry backoff, doubled for each '
+                      'further retry and jittered'),
+    cfg.IntOpt('ixsystems_breaker_threshold',
+               default=5,
+               min=0,
+               help='Consecutive unreachable API calls after which calls '
+                    'fail at once and the backend is reported down, until '
+                    'a probe of the storage controller succeeds. 0 '
+                    'disables the circuit breaker'),
+    cfg.IntOpt('ixsystems_breaker_probe_interval',
+               default=30,
+               min=1,
+               help='Seconds between probes of the storage controller '
+                    'while the circuit breaker is open'),
+    cfg.IntOpt('ixsystems_api_read_limit',
+               default=8,
+               min=1,
+               help='Maximum number of read API calls in flight to the '
+                    'storage controller'),
+    cfg.IntOpt('ixsystems_api_write_limit',
+               default=4,
+               min=1,
+               help='Maximum number of mutating API calls in flight to '
+                    'the storage controller'),
+    cfg.FloatOpt('ixsystems_api_target_latency',
+                 default=2.0,
+                 min=0,
+                 help='Seconds an API call may take before the read or '
+                      'write limit is halved. Limits grow back while '
+                      'calls are faster. Waiting for a pooled connection '
+                      'is not counted. 0 keeps the limits fixed'),
+    cfg.FloatOpt('ixsystems_api_read_window',
+                 default=0,
+                 min=0,
+                 help='Seconds the response of a read API call is reused '
+                      'for identical reads, until the next mutating call. '
+                      'Job state polls are never reused. Identical reads in '
+                      'flight at the same time always share one call, 0 '
+                      'reuses nothing beyond that'), ]
 
 ixsystems_basicauth_opts = [
     cfg.StrOpt('ixsystems_login',
@@ -71,12 +166,108 @@ ixsystems_provisioning_opts = [
     cfg.IntOpt('ixsystems_reserved_percentage',
                default=0,
                help='Reserved space on Storage controller'),
+    cfg.BoolOpt('ixsystems_sparse_volumes',
+                default=False,
+                help='Create volumes as sparse (thin) zvols without a '
+                     'space reservation, and report thin provisioning '
+                     'support to the scheduler. The ixsystems:sparse and '
+                     'provisioning:type volume type extra specs override '
+                     'this'),
+    cfg.StrOpt('ixsystems_clone_mode',
+               default='linked',
+               choices=['linked', 'full'],
+               help='How volumes are cloned unless the volume type sets '
+                    'ixsystems:clone_mode. linked makes a ZFS clone that '
+                    'depends on its source, full copies the data on the '
+                    'array with a one-time local replication'),
+    cfg.IntOpt('ixsystems_clone_max_depth',
+               default=0,
+               min=0,
+               help='Flatten volumes that are more than this many linked '
+                    'clones away from an independent volume, in the '
+                    'background. Only volumes that are not exported are '
+                    'flattened, so this needs ixsystems_lazy_export. 0 '
+                    'disables flattening'),
+    cfg.IntOpt('ixsystems_flatten_interval',
+               default=3600,
+               min=1,
+               help='Seconds between background searches for clone '
+                    'chains to flatten'),
+    cfg.BoolOpt('ixsystems_deferred_delete',
+                default=False,
+                help='Report deletes of volumes with dependent clones as '
+                     'done and destroy them on the storage controller '
+                     'once the clones are gone, instead of failing them '
+                     'with VolumeIsBusy'),
+    cfg.StrOpt('ixsystems_deferred_delete_file',
+               default=None,
+               help='File the deferred delete queue is persisted to. '
+                    'Defaults to ixsystems-deferred-deletes-<backend '
+                    'name>.json in state_path'),
+    cfg.IntOpt('ixsystems_reaper_interval',
+               default=300,
+               min=1,
+               help='Seconds between attempts to destroy deferred deletes'),
+    cfg.IntOpt('ixsystems_reaper_batch',
+               default=20,
+               min=1,
+               help='Maximum number of deferred deletes attempted per run'),
+    cfg.IntOpt('ixsystems_reaper_workers',
+               default=2,
+               min=1,
+               help='Maximum number of deferred deletes run concurrently'),
+    cfg.FloatOpt('ixsystems_bulk_window',
+                 default=0,
+                 min=0,
+                 help='Seconds a volume create, clone or export call waits '
+                      'for concurrent ones to send them together as one '
+                      'core.bulk job, 0 disables batching'),
+    cfg.IntOpt('ixsystems_bulk_max_batch',
+               default=50,
+               min=1,
+               help='Maximum number of calls sent in one core.bulk job'),
+    cfg.IntOpt('ixsystems_stats_interval',
+               default=60,
+               min=0,
+               help='Seconds between background refreshes of the volume '
+                    'stats reported to the scheduler. 0 refreshes them '
+                    'when the scheduler asks'),
     cfg.StrOpt('ixsystems_iqn_prefix',
                default='iqn.2005-10.org.freenas.ctl',
                help='Storage controller iSCSI Qualified Name prefix'),
     cfg.StrOpt('ixsystems_portal_id',
                default=1,
                help='Storage controller iSCSI portal ID'),
+    cfg.StrOpt('ixsystems_portal_selection',
+               default='hostname',
+               choices=['hostname', 'round_robin', 'least_loaded'],
+               help='Portal returned to single path attaches. hostname '
+                    'always uses ixsystems_server_hostname, round_robin '
+                    'and least_loaded spread attaches over the listen '
+                    'addresses of ixsystems_portal_id. Multipath '
+                    'attaches get every listen address'),
     cfg.StrOpt('ixsystems_initiator_id',
                default=1,
-               help='Storage controller iSCSI Initiator ID'), ]
+               help='Storage controller iSCSI Initiator ID'),
+    cfg.StrOpt('ixsystems_export_mode',
+               default='target',
+               choices=['target', 'shared'],
+               help='target exports every volume on an iSCSI target of '
+                    'its own. shared maps volumes as LUNs onto a pool of '
+                    'ixsystems_shared_targets shared iSCSI targets'),
+    cfg.IntOpt('ixsystems_shared_targets',
+               default=4,
+               min=1,
+               help='Number of shared iSCSI targets volumes are spread '
+                    'over in the shared export mode'),
+    cfg.BoolOpt('ixsystems_lazy_export',
+                default=False,
+                help='Create the iSCSI target, extent and mapping of a '
+                     'volume only while it is attached, instead of for '
+                     'every volume when it is created'),
+    cfg.BoolOpt('ixsystems_initiator_groups',
+                default=False,
+                help='Give each compute host an initiator group holding '
+                     'its initiator IQN, and allow only the hosts a '
+                     'volume is attached to on its target, instead of '
+                     'ixsystems_initiator_id for every target'), ]
@@ -13,6 +13,88 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+import threading
+import time
+
+
+class TTLCache(object):
+    """Thread-safe LRU cache whose entries expire after ttl seconds."""
+
+    def __init__(self, maxsize, ttl):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or time.monotonic() - entry[1] > self._ttl:
+                self._data.pop(key, None)
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic())
+            self._data.move_to_end(key)
+            while len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+SPEC_PREFIX = 'ixsystems:'
+
+
+def get_ixsystems_specs(extra_specs):
+    """Return ixsystems: scoped volume type extra specs without prefix."""
+    return dict((key[len(SPEC_PREFIX):], str(value).strip())
+                for key, value in (extra_specs or {}).items()
+                if key.startswith(SPEC_PREFIX))
+
+
+def parse_spec_bool(value):
+    """Parse a boolean extra spec, accepting the '<is> True' form."""
+    value = str(value).strip()
+    if value.lower().startswith('<is>'):
+        value = value[4:].strip()
+    if value.lower() in ('true', 'yes', 'on', '1'):
+        return True
+    if value.lower() in ('false', 'no', 'off', '0'):
+        return False
+    raise ValueError('%s is not a boolean' % value)
+
+
+def parse_block_size(value):
+    """Parse a block size like '16K', '16k' or '16384' into bytes."""
+    value = str(value).strip().upper()
+    multiplier = 1
+    if value.endswith('B'):
+        value = value[:-1]
+    if value.endswith('K'):
+        multiplier, value = 1024, value[:-1]
+    elif value.endswith('M'):
+        multiplier, value = 1024 * 1024, value[:-1]
+    if not value.isdigit():
+        raise ValueError('%s is not a block size' % value)
+    return int(value) * multiplier
+
 
 def get_size_in_gb(size_in_bytes):
     """convert size in gbs"""
@@ -42,6 +124,11 @@ def generate_freenas_snapshot_name(name, iqn_prefix):
             'target': backend_target, 'iqn': backend_iqn}
 
 
+def generate_freenas_group_snapshot_name(group_snapshot_id):
+    """Create the ZFS snapshot name shared by members of a group snapshot."""
+    return 'gsnap-' + group_snapshot_id.split('-')[0]
+
+
 def get_iscsi_portal(hostname, port):
     """Get iscsi portal info from iXsystems FREENAS configuration."""
     return "%s:%s" % (hostname, port)
@@ -60,3 +147,19 @@ def parse_truenas_version(version):
         mainversion = vsplit[1]
         return (main, mainversion, '')
     return ('VersionNotFound', '0', '')
+
+
+def get_truenas_release(parsed_version):
+    """Return the release of a parse_truenas_version tuple as ints.
+
+       ('TrueNAS', '13.0', 'U2') gives (13, 0) and
+       ('TrueNAS', 'SCALE', '24.04.1') gives (24, 4, 1).
+    """
+    release = parsed_version[2] if parsed_version[1] == 'SCALE' \
+        else parsed_version[1]
+    numbers = []
+    for part in release.split('.'):
+        if not part.isdigit():
+            break
+        numbers.append(int(part))
+    return tuple(numbers)
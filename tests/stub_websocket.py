@@ -0,0 +1,223 @@
+# Copyright (c) 2016 iXsystems
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+Local stub of the TrueNAS JSON-RPC 2.0 websocket API for tests.
+
+Speaks just enough RFC 6455 to serve websocket-client: the opening
+handshake, unfragmented text frames, ping and close. Each request is
+answered on its own thread by the handler registered for its method, so
+responses may arrive in any order.
+"""
+
+import base64
+import hashlib
+import simplejson as json
+import socket
+import struct
+import threading
+
+WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+class StubError(Exception):
+    """Raised by a handler to answer with a JSON-RPC error."""
+
+    def __init__(self, errname, reason):
+        super(StubError, self).__init__(reason)
+        self.errname = errname
+        self.reason = reason
+
+
+class StubConnection(object):
+    """One accepted websocket connection."""
+
+    def __init__(self, server, sock):
+        self.server = server
+        self.sock = sock
+        self._send_lock = threading.Lock()
+
+    def _recv_exact(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError('closed')
+            data += chunk
+        return data
+
+    def handshake(self):
+        request = b''
+        while b'\r\n\r\n' not in request:
+            chunk = self.sock.recv(4096)
+            if not chunk:
+                raise ConnectionError('closed')
+            request += chunk
+        headers = {}
+        for line in request.decode('latin1').split('\r\n')[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        accept = base64.b64encode(hashlib.sha1(
+            (headers['sec-websocket-key'] + WS_GUID).encode('ascii')
+        ).digest()).decode('ascii')
+        self.sock.sendall(('HTTP/1.1 101 Switching Protocols\r\n'
+                           'Upgrade: websocket\r\n'
+                           'Connection: Upgrade\r\n'
+                           'Sec-WebSocket-Accept: %s\r\n\r\n' %
+                           accept).encode('ascii'))
+
+    def recv_frame(self):
+        """Returns (opcode, payload) of the next client frame."""
+        first, second = self._recv_exact(2)
+        opcode = first & 0x0f
+        length = second & 0x7f
+        if length == 126:
+            length = struct.unpack('!H', self._recv_exact(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', self._recv_exact(8))[0]
+        mask = self._recv_exact(4) if second & 0x80 else b'\0\0\0\0'
+        payload = bytearray(self._recv_exact(length))
+        for i in range(length):
+            payload[i] ^= mask[i % 4]
+        return opcode, bytes(payload)
+
+    def send_frame(self, payload, opcode=0x1):
+        if isinstance(payload, str):
+            payload = payload.encode('utf8')
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('!BB', 0x80 | opcode, length)
+        elif length < 1 << 16:
+            header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+        with self._send_lock:
+            self.sock.sendall(header + payload)
+
+    def send(self, message):
+        self.send_frame(json.dumps(message))
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+    def _answer(self, message):
+        reply = {'jsonrpc': '2.0', 'id': message['id']}
+        handler = self.server.handlers.get(message['method'])
+        try:
+            if handler is None:
+                raise StubError('ENOMETHOD', 'Method does not exist')
+            reply['result'] = handler(self, *message.get('params', []))
+        except StubError as e:
+            reply['error'] = {'code': -32001, 'message': e.reason,
+                              'data': {'errname': e.errname,
+                                       'reason': e.reason}}
+        try:
+            self.send(reply)
+        except OSError:
+            pass
+
+    def serve(self):
+        try:
+            self.handshake()
+            while True:
+                opcode, payload = self.recv_frame()
+                if opcode == 0x8:
+                    break
+                if opcode == 0x9:
+                    self.send_frame(payload, 0xa)
+                    continue
+                message = json.loads(payload)
+                self.server.calls.append(message['method'])
+                thread = threading.Thread(target=self._answer,
+                                          args=(message,))
+                thread.daemon = True
+                thread.start()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.server.forget(self)
+            self.close()
+
+
+class StubWebSocketServer(object):
+    """JSON-RPC websocket server on a free local port."""
+
+    def __init__(self):
+        self.handlers = {
+            'auth.login': lambda conn, user, password: True,
+            'auth.login_with_api_key': lambda conn, key: True,
+            'core.subscribe': lambda conn, name: 'subscription-1',
+            'system.version': lambda conn: 'TrueNAS-SCALE-25.04.0',
+        }
+        self.calls = []
+        self.accepted = 0
+        self.connections = []
+        self._lock = threading.Lock()
+        self._sock = socket.socket()
+        self._sock.bind(('127.0.0.1', 0))
+        self._sock.listen(16)
+        self.host = '127.0.0.1:%d' % self._sock.getsockname()[1]
+        thread = threading.Thread(target=self._accept_loop)
+        thread.daemon = True
+        thread.start()
+
+    def _accept_loop(self):
+        while True:
+            try:
+                sock, _ = self._sock.accept()
+            except OSError:
+                return
+            conn = StubConnection(self, sock)
+            with self._lock:
+                self.accepted += 1
+                self.connections.append(conn)
+            thread = threading.Thread(target=conn.serve)
+            thread.daemon = True
+            thread.start()
+
+    def forget(self, conn):
+        with self._lock:
+            if conn in self.connections:
+                self.connections.remove(conn)
+
+    def broadcast(self, message):
+        """Sends message, a dict or raw text, on every connection."""
+        with self._lock:
+            connections = list(self.connections)
+        for conn in connections:
+            if isinstance(message, dict):
+                conn.send(message)
+            else:
+                conn.send_frame(message)
+
+    def send_job_update(self, job_id, **fields):
+        self.broadcast({'jsonrpc': '2.0', 'method': 'collection_update',
+                        'params': {'msg': 'changed',
+                                   'collection': 'core.get_jobs',
+                                   'id': job_id, 'fields': fields}})
+
+    def drop_connections(self):
+        """Closes every connection, like a middleware restart."""
+        with self._lock:
+            connections = list(self.connections)
+        for conn in connections:
+            conn.close()
+
+    def stop(self):
+        self._sock.close()
+        self.drop_connections()
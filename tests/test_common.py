@@ -0,0 +1,723 @@
+# Copyright (c) 2016 iXsystems
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Tests of TrueNASCommon with a mocked array."""
+
+import os
+import shutil
+import simplejson as json
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+import zlib
+
+from cinder import exception
+from cinder.volume import configuration
+from cinder.volume import driver
+from cinder.volume.drivers.ixsystems import common
+from cinder.volume.drivers.ixsystems.freenasapi import FreeNASApiError
+from cinder.volume.drivers.ixsystems.freenasapi import FreeNASResponse
+from cinder.volume.drivers.ixsystems.freenasapi import FreeNASServer
+from cinder.volume.drivers.ixsystems import iscsi
+from oslo_config import cfg
+
+
+class CommonTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.configuration = configuration.Configuration(
+            driver.volume_opts, config_group='ixsystems-test')
+        self.common = iscsi.FreeNASISCSIDriver(
+            configuration=self.configuration).common
+        self.common.handle = mock.Mock()
+        self.override(ixsystems_dataset_path='tank/cinder')
+
+    def override(self, **kwargs):
+        for name, value in kwargs.items():
+            cfg.CONF.set_override(name, value, group='ixsystems-test')
+            self.addCleanup(cfg.CONF.clear_override, name,
+                            group='ixsystems-test')
+
+
+class CapabilitiesTest(CommonTestCase):
+
+    def test_connection_error_keeps_keystone_state(self):
+        keystone = self.common._keystone = mock.Mock()
+        keystone_lock = self.common._keystone_lock
+        self.common._service_projects.set('project', True)
+        self.common._capabilities = {'version': 'TrueNAS-SCALE-25.04.0'}
+        self.common._on_api_error('/system/version', {
+            'status': FreeNASServer.STATUS_ERROR, 'code': -1,
+            'response': 'connection refused'})
+        self.assertIsNone(self.common._capabilities)
+        self.assertIs(keystone, self.common._keystone)
+        self.assertIs(keystone_lock, self.common._keystone_lock)
+        self.assertTrue(self.common._service_projects.get('project'))
+
+    def test_probe_does_not_block_invalidation(self):
+        def probe():
+            # An error listener running on another thread meanwhile.
+            thread = threading.Thread(
+                target=self.common._invalidate_capabilities)
+            thread.start()
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+            return {'version': 'TrueNAS-SCALE-25.04.0',
+                    'updated_at': time.time()}
+        self.common._probe_capabilities = probe
+        self.common._save_capabilities = mock.Mock()
+        caps = self.common._get_capabilities()
+        self.assertEqual('TrueNAS-SCALE-25.04.0', caps['version'])
+        self.assertIs(caps, self.common._get_capabilities())
+
+
+class ProvisioningTest(CommonTestCase):
+
+    def _sparse(self, extra_specs):
+        return self.common._get_zvol_properties(extra_specs)['sparse']
+
+    def test_sparse_follows_provisioning_type(self):
+        self.assertFalse(self._sparse({}))
+        self.assertTrue(self._sparse({'provisioning:type': 'thin'}))
+        self.override(ixsystems_sparse_volumes=True)
+        self.assertTrue(self._sparse({}))
+        self.assertFalse(self._sparse({'provisioning:type': 'thick'}))
+        self.assertTrue(self._sparse({'provisioning:type': 'thick',
+                                      'ixsystems:sparse': 'True'}))
+
+    def test_zvol_properties(self):
+        self.common._get_capabilities = mock.Mock(return_value={
+            'compression_choices': ['OFF', 'LZ4', 'ZSTD']})
+        self.assertEqual(
+            {'sparse': True, 'volblocksize': '16K', 'compression': 'ZSTD',
+             'sync': 'ALWAYS', 'deduplication': 'VERIFY'},
+            self.common._get_zvol_properties({
+                'ixsystems:sparse': '<is> True',
+                'ixsystems:volblocksize': '16384',
+                'ixsystems:compression': 'zstd',
+                'ixsystems:sync': 'always',
+                'ixsystems:dedup': 'verify'}))
+        self.assertEqual('512', self.common._get_zvol_properties(
+            {'ixsystems:volblocksize': '512'})['volblocksize'])
+
+    def test_invalid_zvol_properties(self):
+        self.common._get_capabilities = mock.Mock(return_value={})
+        for specs in ({'ixsystems:sparse': 'maybe'},
+                      {'ixsystems:volblocksize': '24K'},
+                      {'ixsystems:volblocksize': '256K'},
+                      {'ixsystems:volblocksize': 'big'},
+                      {'ixsystems:compression': 'zstd'},
+                      {'ixsystems:sync': 'sometimes'},
+                      {'ixsystems:dedup': 'yes'}):
+            self.assertRaises(exception.InvalidVolumeType,
+                              self.common._get_zvol_properties, specs)
+
+    def _stats(self):
+        self.common._get_capabilities = mock.Mock(
+            return_value={'version': 'TrueNAS-SCALE-25.04.0'})
+        self.common._get_provisioned_bytes = mock.Mock(return_value=0)
+        self.common._sync_attachments = mock.Mock()
+        self.common.handle.invoke_command.return_value = {
+            'status': FreeNASServer.STATUS_OK,
+            'response': json.dumps({'available': {'parsed': 1 << 30},
+                                    'used': {'parsed': 1 << 30}})}
+        self.common.handle.limiter.get_stats.return_value = {}
+        return self.common._update_volume_stats()
+
+    def test_thin_support_follows_sparse_volumes(self):
+        stats = self._stats()
+        self.assertFalse(stats['thin_provisioning_support'])
+        self.assertTrue(stats['thick_provisioning_support'])
+        self.override(ixsystems_sparse_volumes=True)
+        self.assertTrue(self._stats()['thin_provisioning_support'])
+
+
+class InitiatorGroupTest(CommonTestCase):
+
+    def setUp(self):
+        super(InitiatorGroupTest, self).setUp()
+        self.common._find_igroup = mock.Mock(return_value={
+            'id': 5, 'initiators': ['iqn.1993-08.org.debian:01:1']})
+        self.common._get_export_target_id = mock.Mock(return_value=1)
+        self.common.handle.invoke_command.return_value = {
+            'status': FreeNASServer.STATUS_OK, 'response': b'true'}
+
+    def _deletes(self):
+        return [c for c in self.common.handle.invoke_command.call_args_list
+                if c[0][0] == FreeNASServer.DELETE_COMMAND]
+
+    def test_gc_uses_tracked_references(self):
+        self.common._igroup_refs_loaded = True
+        self.common._igroup_refs = {5: {2}}
+        self.common._gc_igroup('compute-1', 5)
+        self.assertEqual([], self._deletes())
+        self.common._igroup_refs = {5: set()}
+        self.common._gc_igroup('compute-1', 5)
+        self.assertEqual(1, len(self._deletes()))
+        self.common.handle.query.assert_not_called()
+
+    def test_gc_loads_references_once(self):
+        self.common.handle.query.return_value = {
+            'status': FreeNASServer.STATUS_OK,
+            'response': json.dumps([
+                {'id': 9, 'groups': [{'portal': 1, 'initiator': 5}]},
+                {'id': 10, 'groups': [{'portal': 1, 'initiator': 6}]},
+            ]).encode('utf8')}
+        self.common._gc_igroup('compute-1', 5)
+        self.common._gc_igroup('compute-2', 6)
+        self.assertEqual([], self._deletes())
+        self.assertEqual(1, self.common.handle.query.call_count)
+
+    def test_gc_waits_for_a_concurrent_allow(self):
+        self.common._igroup_refs_loaded = True
+        updating = threading.Event()
+        release = threading.Event()
+
+        def update_target_groups(target_id, igroup_id, allow):
+            updating.set()
+            release.wait(5)
+        self.common._update_target_groups = update_target_groups
+        allow = threading.Thread(target=self.common._allow_host,
+                                 args=('target-1', 'compute-1',
+                                       'iqn.1993-08.org.debian:01:1'))
+        allow.start()
+        self.assertTrue(updating.wait(5))
+        gc = threading.Thread(target=self.common._gc_igroup,
+                              args=('compute-1', 5))
+        gc.start()
+        gc.join(0.2)
+        self.assertTrue(gc.is_alive())
+        release.set()
+        allow.join(5)
+        gc.join(5)
+        self.assertEqual([], self._deletes())
+        self.assertEqual({1}, self.common._igroup_refs[5])
+
+
+class FlattenTest(CommonTestCase):
+
+    NAME = 'volume-01234567'
+    TARGET = 'target-01234567'
+
+    def setUp(self):
+        super(FlattenTest, self).setUp()
+        common = self.common
+        common._get_iscsitarget_ids = mock.Mock(return_value=(
+            {'target': 0, 'extent': 0, 'targetextent': 0}, True))
+        common._dependent_clone = mock.Mock(
+            return_value='tank/cinder/volume-89abcdef@snap')
+        self.snapshots = []
+        common._create_snapshot = mock.Mock(
+            side_effect=lambda name, volume: self.snapshots.append(name))
+        self.state = None
+        common._get_volume_state = mock.Mock(
+            side_effect=lambda name: self.state or (self.snapshots, 1 << 30))
+        common._copy_volume_from_snapshot = mock.Mock()
+        common._rename_volume = mock.Mock()
+        common._destroy_volume = mock.Mock(
+            return_value={'status': FreeNASServer.STATUS_OK})
+        common._delete_snapshot = mock.Mock()
+
+
+    def test_flattener_needs_lazy_export(self):
+        self.override(ixsystems_clone_max_depth=2)
+        with mock.patch.object(common.loopingcall,
+                               'FixedIntervalLoopingCall') as looping:
+            self.common._start_clone_flattener()
+            self.assertFalse(looping.called)
+            self.override(ixsystems_lazy_export=True)
+            self.common._start_clone_flattener()
+            self.assertTrue(looping.return_value.start.called)
+
+    def test_flatten(self):
+        self.assertTrue(self.common._flatten_volume(self.NAME))
+        self.assertEqual(2, self.common._rename_volume.call_count)
+        self.common._destroy_volume.assert_called_once_with(
+            self.NAME + '-old')
+
+    def _changed_during_copy(self, change):
+        self.common._copy_volume_from_snapshot.side_effect = change
+        self.assertFalse(self.common._flatten_volume(self.NAME))
+        self.common._rename_volume.assert_not_called()
+        self.common._destroy_volume.assert_called_once_with(
+            self.NAME + '-flat')
+        self.common._delete_snapshot.assert_called_once_with(
+            self.snapshots[0], self.NAME)
+
+    def test_snapshot_during_copy(self):
+        def snapshot(*args):
+            self.state = (self.snapshots + ['snapshot-1'], 1 << 30)
+        self._changed_during_copy(snapshot)
+
+    def test_extend_during_copy(self):
+        def extend(*args):
+            self.state = (self.snapshots, 2 << 30)
+        self._changed_during_copy(extend)
+
+    def test_attach_during_copy(self):
+        self.common._create_target = mock.Mock(return_value=1)
+        self.common._create_extent = mock.Mock(return_value=2)
+        self.common._target_to_extent = mock.Mock(return_value=3)
+
+        def attach(*args):
+            # Not blocked by the copy, but the copy is then dropped.
+            thread = threading.Thread(
+                target=self.common._ensure_iscsitarget,
+                args=(self.TARGET, self.NAME))
+            thread.start()
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+        self._changed_during_copy(attach)
+
+
+class GroupSnapshotTest(CommonTestCase):
+
+    def _listing(self, items):
+        return {'status': FreeNASServer.STATUS_OK,
+                'response': json.dumps(items).encode('utf8')}
+
+    def test_stray_snapshots_are_deleted(self):
+        self.common.handle.query.side_effect = [
+            self._listing([{'name': 'tank/cinder/volume-a'},
+                           {'name': 'tank/cinder/volume-b'},
+                           {'name': 'tank/cinder/volume-c'}]),
+            self._listing([
+                {'name': 'tank/cinder/volume-a@gsnap-1',
+                 'dataset': 'tank/cinder/volume-a'},
+                {'name': 'tank/cinder/volume-b@gsnap-1',
+                 'dataset': 'tank/cinder/volume-b'},
+                # Created after the listing, so not excluded.
+                {'name': 'tank/cinder/volume-d@gsnap-1',
+                 'dataset': 'tank/cinder/volume-d'}])]
+        self.common.handle.jobs.invoke.return_value = {
+            'status': FreeNASServer.STATUS_OK, 'response': b'true'}
+        self.common._delete_snapshot = mock.Mock()
+        self.common._create_group_snapshot('gsnap-1',
+                                           ['volume-a', 'volume-b'])
+        create = self.common.handle.jobs.invoke.call_args_list[0]
+        self.assertEqual(['tank/cinder/volume-c'],
+                         json.loads(create[0][2])['exclude'])
+        self.common._delete_snapshot.assert_called_once_with('gsnap-1',
+                                                             'volume-d')
+
+
+class IdempotentCreateTest(CommonTestCase):
+
+    def _exists(self, attempts):
+        return FreeNASResponse(FreeNASServer.STATUS_ERROR,
+                               '422:Dataset already exists', code=422,
+                               attempts=attempts)
+
+    def test_first_attempt_does_not_adopt(self):
+        self.common.handle.jobs.invoke.return_value = self._exists(1)
+        self.assertRaises(FreeNASApiError, self.common._create_volume,
+                          'volume-01234567', 1)
+
+    def test_retry_adopts(self):
+        self.common.handle.jobs.invoke.return_value = self._exists(2)
+        self.common._create_volume('volume-01234567', 1)
+
+
+class DeferredDeleteQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.path = os.path.join(tmpdir, 'deferred.json')
+
+    def _queue(self):
+        queue = common.DeferredDeleteQueue(self.path)
+        queue.load()
+        return queue
+
+    def test_persisted_across_restarts(self):
+        queue = self._queue()
+        queue.add('volume-a')
+        queue.add('volume-b')
+        queue.remove('volume-a')
+        self.assertEqual(['volume-b'], self._queue().due(10))
+
+    def test_least_recently_tried_first(self):
+        queue = self._queue()
+        for name in ('volume-a', 'volume-b', 'volume-c'):
+            queue.add(name)
+            time.sleep(0.01)
+        queue.tried('volume-a')
+        self.assertEqual(['volume-b', 'volume-c'], queue.due(2))
+        # Adding again keeps the entry and its attempts.
+        queue.add('volume-a')
+        self.assertEqual(1, self._queue()._entries['volume-a']['attempts'])
+
+    def test_concurrent_changes(self):
+        queue = self._queue()
+
+        def worker(index):
+            for n in range(50):
+                name = 'volume-%d-%d' % (index, n)
+                queue.add(name)
+                queue.tried(name)
+                if n % 2:
+                    queue.remove(name)
+        threads = [threading.Thread(target=worker, args=(i,))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(30)
+        self.assertEqual(200, len(queue))
+        self.assertEqual(sorted(queue.due(1000)),
+                         sorted(self._queue().due(1000)))
+
+    def test_unreadable_file_is_ignored(self):
+        with open(self.path, 'w') as fd:
+            fd.write('{not json')
+        self.assertEqual(0, len(self._queue()))
+
+
+class DeferredReaperTest(CommonTestCase):
+
+    def setUp(self):
+        super(DeferredReaperTest, self).setUp()
+        self.override(ixsystems_deferred_delete=True)
+        self.common.deferred_deletes = common.DeferredDeleteQueue()
+        for name in ('volume-gone', 'volume-busy', 'volume-free'):
+            self.common.deferred_deletes.add(name)
+
+        def select(command, request_urn, body):
+            if 'volume-gone' in request_urn:
+                return FreeNASResponse(FreeNASServer.STATUS_ERROR,
+                                       '404:not found', code=404)
+            return FreeNASResponse(FreeNASServer.STATUS_OK, b'{}')
+        self.common.handle.invoke_command.side_effect = select
+
+        def delete(name):
+            if name == 'volume-busy':
+                raise exception.VolumeIsBusy(volume_name=name)
+        self.common._delete_volume = mock.Mock(side_effect=delete)
+
+    def test_reap(self):
+        self.common._reap_deferred_deletes()
+        self.assertEqual(['volume-busy'],
+                         self.common.deferred_deletes.due(10))
+        self.assertEqual(
+            1, self.common.deferred_deletes._entries['volume-busy']
+            ['attempts'])
+        self.assertEqual(2, self.common._delete_volume.call_count)
+
+    def test_batch_limit(self):
+        self.override(ixsystems_reaper_batch=1)
+        self.common._reap_deferred_deletes()
+        self.assertEqual(2, len(self.common.deferred_deletes))
+
+
+class BulkBatcherTest(unittest.TestCase):
+
+    def _batcher(self, window, max_batch):
+        self.sends = []
+
+        def send(key, params):
+            self.sends.append((key, list(params)))
+            if 'fail' in params:
+                raise FreeNASApiError('Unexpected error', 'bulk failed')
+            return ['%s:%s' % (key, param) for param in params]
+        return common.BulkBatcher(send, window, max_batch)
+
+    def _call_concurrently(self, batcher, calls):
+        results = {}
+
+        def call(key, param):
+            try:
+                results[param] = batcher.call(key, param)
+            except FreeNASApiError as e:
+                results[param] = e
+        threads = [threading.Thread(target=call, args=args)
+                   for args in calls]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        return results
+
+    def test_single_call(self):
+        batcher = self._batcher(0, 10)
+        self.assertEqual('k:a', batcher.call('k', 'a'))
+        self.assertEqual([('k', ['a'])], self.sends)
+
+    def test_concurrent_calls_share_a_batch(self):
+        batcher = self._batcher(1, 10)
+        params = ['p%d' % n for n in range(5)]
+        results = self._call_concurrently(batcher,
+                                          [('k', p) for p in params])
+        self.assertEqual(1, len(self.sends))
+        self.assertEqual(sorted(params), sorted(self.sends[0][1]))
+        for param in params:
+            self.assertEqual('k:' + param, results[param])
+
+    def test_keys_are_batched_apart(self):
+        batcher = self._batcher(0.5, 10)
+        results = self._call_concurrently(
+            batcher, [('a', 'a1'), ('b', 'b1'), ('a', 'a2'), ('b', 'b2')])
+        self.assertEqual(['a', 'b'], sorted(key for key, _ in self.sends))
+        for param in ('a1', 'a2', 'b1', 'b2'):
+            self.assertEqual(param[0] + ':' + param, results[param])
+
+    def test_full_batch_is_sent_at_once(self):
+        batcher = self._batcher(30, 2)
+        start = time.monotonic()
+        results = self._call_concurrently(
+            batcher, [('k', 'p%d' % n) for n in range(4)])
+        self.assertLess(time.monotonic() - start, 10)
+        self.assertEqual([2, 2], [len(params) for _, params in self.sends])
+        self.assertEqual(4, len(results))
+
+    def test_window_ends_a_batch(self):
+        batcher = self._batcher(0.2, 10)
+        start = time.monotonic()
+        self.assertEqual('k:a', batcher.call('k', 'a'))
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+        self.assertEqual('k:b', batcher.call('k', 'b'))
+        self.assertEqual(2, len(self.sends))
+
+    def test_error_reaches_every_caller(self):
+        batcher = self._batcher(1, 3)
+        results = self._call_concurrently(
+            batcher, [('k', 'a'), ('k', 'fail'), ('k', 'b')])
+        self.assertEqual(1, len(self.sends))
+        for param in ('a', 'fail', 'b'):
+            self.assertIsInstance(results[param], FreeNASApiError)
+
+
+class SendBulkTest(CommonTestCase):
+
+    KEY = (FreeNASServer.REST_API_VOLUME, 'default')
+
+    def _bodies(self, *names):
+        return [json.dumps({'name': name}).encode('utf8') for name in names]
+
+    def test_single_body_is_sent_alone(self):
+        ok = FreeNASResponse(FreeNASServer.STATUS_OK, b'{}')
+        self.common.handle.jobs.invoke.return_value = ok
+        bodies = self._bodies('tank/cinder/volume-a')
+        self.assertEqual([ok], self.common._send_bulk(self.KEY, bodies))
+        self.common.handle.jobs.invoke.assert_called_once_with(
+            FreeNASServer.CREATE_COMMAND, FreeNASServer.REST_API_VOLUME,
+            bodies[0], 'default', retry=True)
+
+    def test_per_item_results(self):
+        self.common.handle.jobs.invoke.return_value = FreeNASResponse(
+            FreeNASServer.STATUS_OK, json.dumps([
+                {'result': {'id': 'tank/cinder/volume-a'}, 'error': None},
+                {'result': None, 'error': 'volume-b already exists'},
+            ]).encode('utf8'))
+        results = self.common._send_bulk(
+            self.KEY, self._bodies('tank/cinder/volume-a',
+                                   'tank/cinder/volume-b'))
+        args = self.common.handle.jobs.invoke.call_args[0]
+        self.assertEqual(FreeNASServer.REST_API_BULK, args[1])
+        self.assertEqual(
+            {'method': 'pool.dataset.create',
+             'params': [[{'name': 'tank/cinder/volume-a'}],
+                        [{'name': 'tank/cinder/volume-b'}]],
+             'description': 'Cinder pool.dataset.create x2'},
+            json.loads(args[2]))
+        self.assertEqual(FreeNASServer.STATUS_OK, results[0]['status'])
+        self.assertEqual({'id': 'tank/cinder/volume-a'},
+                         json.loads(results[0]['response']))
+        self.assertEqual(FreeNASServer.STATUS_ERROR, results[1]['status'])
+        self.assertEqual(422, results[1]['code'])
+        self.assertIn('already exists', results[1]['response'])
+
+    def test_failed_job_fails_every_call(self):
+        failed = FreeNASResponse(FreeNASServer.STATUS_ERROR,
+                                 '422:bulk job failed', code=422)
+        self.common.handle.jobs.invoke.return_value = failed
+        self.assertEqual([failed, failed], self.common._send_bulk(
+            self.KEY, self._bodies('tank/cinder/volume-a',
+                                   'tank/cinder/volume-b')))
+
+    def test_create_uses_batcher_when_enabled(self):
+        self.common.batcher = mock.Mock()
+        self.common._invoke_create(FreeNASServer.REST_API_VOLUME, b'{}')
+        self.assertFalse(self.common.batcher.call.called)
+        self.override(ixsystems_bulk_window=0.1)
+        self.common._invoke_create(FreeNASServer.REST_API_VOLUME, b'{}')
+        self.common.batcher.call.assert_called_once_with(self.KEY, b'{}')
+        self.common._invoke_create('/pool/snapshot', b'{}')
+        self.assertEqual(1, self.common.batcher.call.call_count)
+
+
+class RollbackTest(CommonTestCase):
+
+    DATASET = 'tank/cinder/volume-a'
+
+    def setUp(self):
+        super(RollbackTest, self).setUp()
+        self.common.handle.query.return_value = FreeNASResponse(
+            FreeNASServer.STATUS_OK, json.dumps([
+                {'name': '%s@%s' % (self.DATASET, name),
+                 'properties': {'createtxg': {'value': txg}}}
+                for name, txg in (('snap-2', '30'), ('snap-0', '10'),
+                                  ('snap-1', '20'))]).encode('utf8'))
+        self.common.handle.invoke_command.return_value = FreeNASResponse(
+            FreeNASServer.STATUS_OK, b'null')
+
+    def test_newer_snapshots(self):
+        self.assertEqual([self.DATASET + '@snap-1', self.DATASET + '@snap-2'],
+                         self.common._get_newer_snapshots('snap-0',
+                                                          'volume-a'))
+        self.assertEqual([], self.common._get_newer_snapshots('snap-2',
+                                                              'volume-a'))
+
+    def test_rollback_to_latest(self):
+        self.common._rollback_snapshot('snap-2', 'volume-a')
+        self.common.handle.invoke_command.assert_called_once_with(
+            FreeNASServer.CREATE_COMMAND,
+            FreeNASServer.REST_API_SNAPSHOT + '/rollback', mock.ANY)
+        body = self.common.handle.invoke_command.call_args[0][2]
+        self.assertEqual({'id': self.DATASET + '@snap-2', 'options': {}},
+                         json.loads(body))
+
+    def test_newer_snapshot_is_not_destroyed(self):
+        self.assertRaises(NotImplementedError,
+                          self.common._rollback_snapshot, 'snap-1',
+                          'volume-a')
+        self.assertFalse(self.common.handle.invoke_command.called)
+
+    def test_snapshot_not_found(self):
+        self.assertRaises(FreeNASApiError, self.common._rollback_snapshot,
+                          'snap-9', 'volume-a')
+        self.assertFalse(self.common.handle.invoke_command.called)
+
+    def test_failed_rollback(self):
+        self.common.handle.invoke_command.return_value = FreeNASResponse(
+            FreeNASServer.STATUS_ERROR, '422:dataset is busy', code=422)
+        self.assertRaises(FreeNASApiError, self.common._rollback_snapshot,
+                          'snap-2', 'volume-a')
+
+
+class LUNAllocatorTest(unittest.TestCase):
+
+    def test_lowest_free_lun(self):
+        luns = common.LUNAllocator()
+        luns.load(1, [0, 2])
+        self.assertEqual(1, luns.allocate(1))
+        self.assertEqual(3, luns.allocate(1))
+        luns.release(1, 0)
+        self.assertEqual(0, luns.allocate(1))
+        self.assertEqual(0, luns.allocate(2))
+        self.assertEqual(4, luns.count(1))
+
+    def test_full_target(self):
+        luns = common.LUNAllocator()
+        luns.MAX_LUNS = 2
+        luns.load(1, [0, 1])
+        self.assertIsNone(luns.allocate(1))
+
+    def test_forget(self):
+        luns = common.LUNAllocator()
+        luns.load(1, [0])
+        luns.load(2, [0])
+        luns.forget(1)
+        self.assertFalse(luns.is_loaded(1))
+        self.assertTrue(luns.is_loaded(2))
+        luns.forget()
+        self.assertFalse(luns.is_loaded(2))
+
+
+class SharedLUNTest(CommonTestCase):
+
+    NAME = 'target-01234567'
+
+    def setUp(self):
+        super(SharedLUNTest, self).setUp()
+        self.override(ixsystems_export_mode='shared',
+                      ixsystems_shared_targets=2)
+        self.first = zlib.crc32(self.NAME.encode('utf8')) % 2
+        # Target ids 10 and 11, the LUN ids mapped on each.
+        self.lunids = {10: [], 11: []}
+        self.common.get_iscsitarget_id = mock.Mock(
+            side_effect=lambda name: 10 + int(name[-1]))
+
+        def query(request_urn, filters, options):
+            (field, op, value), = filters
+            if field == 'target':
+                items = [{'lunid': lunid} for lunid in self.lunids[value]]
+            else:
+                items = self.mappings
+            return FreeNASResponse(FreeNASServer.STATUS_OK,
+                                   json.dumps(items).encode('utf8'))
+        self.common.handle.query.side_effect = query
+        self.common._target_to_extent = mock.Mock(return_value=99)
+
+    def test_lowest_free_lun(self):
+        self.lunids[10 + self.first] = [0, 1, 3]
+        self.assertEqual((10 + self.first, 2),
+                         self.common._map_shared_lun(self.NAME, 5))
+        self.common._target_to_extent.assert_called_once_with(
+            10 + self.first, 5, self.NAME, 2)
+        self.assertEqual({'target': 0, 'extent': 5, 'targetextent': 99,
+                          'lun': 2, 'lun_target': 10 + self.first},
+                         self.common.inventory.get(self.NAME,
+                                                   ('lun', 'lun_target')))
+
+    def test_full_target_moves_to_the_next(self):
+        self.common.luns.MAX_LUNS = 2
+        self.lunids[10 + self.first] = [0, 1]
+        self.lunids[11 - self.first] = [0]
+        self.assertEqual((11 - self.first, 1),
+                         self.common._map_shared_lun(self.NAME, 5))
+
+    def test_all_targets_full(self):
+        self.common.luns.MAX_LUNS = 1
+        self.lunids = {10: [0], 11: [0]}
+        self.assertRaises(FreeNASApiError, self.common._map_shared_lun,
+                          self.NAME, 5)
+        self.assertFalse(self.common._target_to_extent.called)
+
+    def test_failed_mapping_reloads_the_target(self):
+        target_id = 10 + self.first
+        self.common._target_to_extent.side_effect = [
+            FreeNASApiError('Unexpected error', 'LUN ID 0 is in use'), 99]
+        self.assertRaises(FreeNASApiError, self.common._map_shared_lun,
+                          self.NAME, 5)
+        self.assertFalse(self.common.luns.is_loaded(target_id))
+        # Taken by another process meanwhile.
+        self.lunids[target_id] = [0]
+        self.assertEqual((target_id, 1),
+                         self.common._map_shared_lun(self.NAME, 5))
+
+    def test_export_looked_up_on_inventory_miss(self):
+        self.common.get_extent_id = mock.Mock(return_value=5)
+        self.mappings = [{'id': 99, 'lunid': 3, 'target': 11}]
+        self.common.handle.invoke_command.return_value = FreeNASResponse(
+            FreeNASServer.STATUS_OK,
+            json.dumps({'name': 'openstack-shared-1'}).encode('utf8'))
+        iqn = self.configuration.ixsystems_iqn_prefix + 'openstack-shared-1'
+        for _ in range(2):
+            self.assertEqual({'iqn': iqn, 'lun': 3},
+                             self.common._get_export(self.NAME))
+        self.assertEqual(1, self.common.handle.query.call_count)
+        self.assertEqual(1, self.common.handle.invoke_command.call_count)
+
+    def test_export_not_mapped(self):
+        self.common.get_extent_id = mock.Mock(return_value=5)
+        self.mappings = []
+        self.assertRaises(FreeNASApiError, self.common._get_export,
+                          self.NAME)
+
+
+if __name__ == '__main__':
+    unittest.main()
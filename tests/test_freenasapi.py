@@ -0,0 +1,411 @@
+# Copyright (c) 2016 iXsystems
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Tests of the REST transport against a local HTTP server."""
+
+import collections
+import http.server
+import simplejson as json
+import threading
+import time
+import unittest
+
+from cinder.volume.drivers.ixsystems import freenasapi
+from cinder.volume.drivers.ixsystems.freenasapi import FreeNASCallLimiter
+from cinder.volume.drivers.ixsystems.freenasapi import FreeNASServer
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    """Answers /ok/<n> with n and /fail/<n> with a 422 naming n.
+
+       /busy/<k>/<n> answers 503 to its first k requests, then acts as
+       /ok/<n>, or as a 404 for a DELETE. /slow/<n> acts as /ok/<n>
+       after 0.3 seconds. /core/ping answers pong and /core/get_jobs an
+       empty list. Requests are counted by path below /api/v2.0.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    requests = collections.Counter()
+    requests_lock = threading.Lock()
+
+    def _reply(self, status, body):
+        body = json.dumps(body).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        payload = self.rfile.read(length) if length else b''
+        path = self.path.split('/api/v2.0', 1)[-1]
+        with self.requests_lock:
+            self.requests[path] += 1
+            count = self.requests[path]
+        if path == '/core/ping':
+            self._reply(200, 'pong')
+            return
+        if path.startswith('/core/get_jobs'):
+            self._reply(200, [])
+            return
+        parts = path.split('/')
+        kind, n = parts[-2:]
+        if len(parts) > 3 and parts[-3] == 'busy':
+            if count <= int(kind):
+                self._reply(503, {'message': 'busy'})
+                return
+            if self.command == 'DELETE':
+                self._reply(404, {'message': 'not found'})
+                return
+            kind = 'ok'
+        if parts[-2] == 'slow':
+            time.sleep(0.3)
+            kind = 'ok'
+        if kind == 'ok':
+            self._reply(200, {'n': int(n), 'method': self.command,
+                              'payload': payload.decode('utf8')})
+        else:
+            self._reply(422, {'message': 'failed %s' % n})
+
+    do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+    def log_message(self, *args):
+        pass
+
+
+class LocalServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        _Handler.requests.clear()
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                     _Handler)
+        self.httpd.daemon_threads = True
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.httpd.server_close)
+        self.addCleanup(self.httpd.shutdown)
+        self.host = '127.0.0.1:%d' % self.httpd.server_address[1]
+        self.server = self._server()
+
+    def _server(self, **kwargs):
+        kwargs.setdefault('pool_size', 4)
+        return FreeNASServer(self.host, 80, username='root',
+                             password='secret', apikey='',
+                             api_version='v2.0', **kwargs)
+
+
+class InvokeCommandStressTest(LocalServerTestCase):
+    """Concurrent calls never see each other's status, body or code."""
+
+    THREADS = 16
+    CALLS = 50
+
+    def _worker(self, index, errors):
+        commands = (FreeNASServer.SELECT_COMMAND,
+                    FreeNASServer.CREATE_COMMAND,
+                    FreeNASServer.UPDATE_COMMAND,
+                    FreeNASServer.DELETE_COMMAND)
+        for i in range(self.CALLS):
+            n = index * self.CALLS + i
+            command = commands[n % len(commands)]
+            try:
+                if n % 3 == 0:
+                    ret = self.server.invoke_command(command,
+                                                     '/fail/%d' % n, None)
+                    self.assertEqual(FreeNASServer.STATUS_ERROR,
+                                     ret['status'])
+                    self.assertEqual(422, ret['code'])
+                    self.assertEqual('422:failed %d' % n, ret['response'])
+                else:
+                    payload = None
+                    if command != FreeNASServer.SELECT_COMMAND:
+                        payload = json.dumps({'n': n}).encode('utf8')
+                    ret = self.server.invoke_command(command,
+                                                     '/ok/%d' % n, payload)
+                    self.assertEqual(FreeNASServer.STATUS_OK, ret['status'])
+                    self.assertEqual(-1, ret['code'])
+                    body = json.loads(ret['response'])
+                    self.assertEqual(n, body['n'])
+                    if payload:
+                        self.assertEqual({'n': n},
+                                         json.loads(body['payload']))
+                self.assertIsNotNone(ret.request_id)
+                self.assertGreaterEqual(ret.latency, 0)
+            except Exception as e:
+                errors.append(e)
+
+    def test_interleaved_success_and_failure(self):
+        errors = []
+        threads = [threading.Thread(target=self._worker, args=(i, errors))
+                   for i in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(60)
+            self.assertFalse(thread.is_alive())
+        self.assertEqual([], errors)
+
+    def test_request_ids_are_unique(self):
+        ids = set()
+        for n in range(20):
+            ids.add(self.server.invoke_command(
+                FreeNASServer.SELECT_COMMAND, '/ok/%d' % n, None).request_id)
+        self.assertEqual(20, len(ids))
+
+
+class RetryTest(LocalServerTestCase):
+
+    def setUp(self):
+        super(RetryTest, self).setUp()
+        self.server = self._server(retries=3, retry_backoff=0.01)
+
+    def test_reads_are_retried(self):
+        ret = self.server.invoke_command(FreeNASServer.SELECT_COMMAND,
+                                         '/busy/2/1', None)
+        self.assertEqual(FreeNASServer.STATUS_OK, ret['status'])
+        self.assertEqual(3, ret['attempts'])
+        self.assertEqual(3, _Handler.requests['/busy/2/1'])
+
+    def test_creates_are_retried_on_request(self):
+        ret = self.server.invoke_command(FreeNASServer.CREATE_COMMAND,
+                                         '/busy/1/2', b'{}')
+        self.assertEqual(503, ret['code'])
+        self.assertEqual(1, ret['attempts'])
+        ret = self.server.invoke_command(FreeNASServer.CREATE_COMMAND,
+                                         '/busy/1/3', b'{}', retry=True)
+        self.assertEqual(FreeNASServer.STATUS_OK, ret['status'])
+        self.assertEqual(2, ret['attempts'])
+
+    def test_retried_delete_finding_nothing_succeeds(self):
+        ret = self.server.invoke_command(FreeNASServer.DELETE_COMMAND,
+                                         '/busy/1/4', None)
+        self.assertEqual(FreeNASServer.STATUS_OK, ret['status'])
+        self.assertEqual(2, ret['attempts'])
+
+    def test_gives_up_after_retries(self):
+        ret = self.server.invoke_command(FreeNASServer.SELECT_COMMAND,
+                                         '/busy/9/5', None)
+        self.assertEqual(503, ret['code'])
+        self.assertEqual(4, ret['attempts'])
+
+
+class CircuitBreakerTest(LocalServerTestCase):
+
+    def setUp(self):
+        super(CircuitBreakerTest, self).setUp()
+        self.server = self._server(breaker_threshold=2,
+                                   breaker_probe_interval=0.2)
+
+    def test_opens_and_closes(self):
+        for n in range(2):
+            self.server.invoke_command(FreeNASServer.SELECT_COMMAND,
+                                       '/busy/9/%d' % n, None)
+        self.assertFalse(self.server.is_available())
+        ret = self.server.invoke_command(FreeNASServer.SELECT_COMMAND,
+                                         '/ok/3', None)
+        self.assertEqual(503, ret['code'])
+        self.assertIn('Circuit breaker open', ret['response'])
+        self.assertEqual(0, _Handler.requests['/ok/3'])
+        # The probe of /core/ping after the interval closes it again.
+        _Handler.requests.clear()
+        time.sleep(0.3)
+        self.assertTrue(self.server.is_available())
+        self.assertEqual(1, _Handler.requests['/core/ping'])
+        ret = self.server.invoke_command(FreeNASServer.SELECT_COMMAND,
+                                         '/ok/3', None)
+        self.assertEqual(FreeNASServer.STATUS_OK, ret['status'])
+
+    def test_errors_of_a_reachable_server_keep_it_closed(self):
+        for n in range(4):
+            self.server.invoke_command(FreeNASServer.SELECT_COMMAND,
+                                       '/fail/%d' % n, None)
+        self.assertTrue(self.server.is_available())
+
+
+class ErrorListenerTest(LocalServerTestCase):
+
+    def test_listener_lock_does_not_deadlock_calls(self):
+        # A listener taking a lock held by a caller waiting for the only
+        # read slot must not run while its call holds that slot.
+        server = self._server(read_limit=1)
+        lock = threading.Lock()
+        locked = threading.Event()
+        server.add_error_listener(lambda request_d, response: lock.acquire()
+                                  or lock.release())
+
+        def locked_read():
+            with lock:
+                locked.set()
+                time.sleep(0.2)
+                server.invoke_command(FreeNASServer.SELECT_COMMAND,
+                                      '/ok/1', None)
+
+        def failing_read():
+            locked.wait(5)
+            server.invoke_command(FreeNASServer.SELECT_COMMAND, '/fail/2',
+                                  None)
+        threads = [threading.Thread(target=locked_read),
+                   threading.Thread(target=failing_read)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+
+
+class CallLimiterTest(unittest.TestCase):
+
+    def _waiter(self, limiter, priority, order):
+        with freenasapi.call_priority(priority):
+            with limiter.slot(FreeNASCallLimiter.READ):
+                order.append(priority)
+
+    def test_higher_priority_goes_first(self):
+        limiter = FreeNASCallLimiter(1, 1)
+        order = []
+        limiter.acquire(FreeNASCallLimiter.READ)
+        threads = []
+        for priority in (freenasapi.PRIORITY_LOW, freenasapi.PRIORITY_NORMAL,
+                         freenasapi.PRIORITY_HIGH):
+            thread = threading.Thread(target=self._waiter,
+                                      args=(limiter, priority, order))
+            thread.start()
+            threads.append(thread)
+            # Queued in this order.
+            while (limiter.get_stats()['read']['waiting'] <
+                   len(threads)):
+                time.sleep(0.01)
+        # Writes have their own budget.
+        with limiter.slot(FreeNASCallLimiter.WRITE):
+            pass
+        limiter.release(FreeNASCallLimiter.READ, 0)
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual([freenasapi.PRIORITY_HIGH,
+                          freenasapi.PRIORITY_NORMAL,
+                          freenasapi.PRIORITY_LOW], order)
+        self.assertEqual(3, limiter.get_stats()['read']['waited'])
+
+    def test_limit_adapts_to_latency(self):
+        limiter = FreeNASCallLimiter(8, 4, target_latency=1.0)
+        read = FreeNASCallLimiter.READ
+        limiter.acquire(read)
+        limiter.release(read, 2.0)
+        self.assertEqual(4, limiter.get_stats()['read']['limit'])
+        # Halved at most once per target latency.
+        limiter.acquire(read)
+        limiter.release(read, 2.0)
+        self.assertEqual(4, limiter.get_stats()['read']['limit'])
+        # Grows by one call per limit fast calls.
+        for _ in range(5):
+            limiter.acquire(read)
+            limiter.release(read, 0.1)
+        self.assertEqual(5, limiter.get_stats()['read']['limit'])
+        self.assertEqual(4, limiter.get_stats()['write']['limit'])
+
+    def test_fixed_without_target_latency(self):
+        limiter = FreeNASCallLimiter(8, 4)
+        limiter.acquire(FreeNASCallLimiter.READ)
+        limiter.release(FreeNASCallLimiter.READ, 60)
+        self.assertEqual(8, limiter.get_stats()['read']['limit'])
+
+    def test_restart_clock(self):
+        latencies = []
+        limiter = FreeNASCallLimiter(8, 4)
+        limiter.release = lambda kind, latency: latencies.append(latency)
+        limiter.restart_clock()
+        with limiter.slot(FreeNASCallLimiter.READ):
+            time.sleep(0.2)
+            limiter.restart_clock()
+        self.assertLess(latencies[0], 0.1)
+
+
+class PoolWaitTest(LocalServerTestCase):
+
+    def test_pool_wait_is_not_latency(self):
+        # Four slow reads admitted at once queue for a single connection,
+        # the last one waits for three others.
+        server = self._server(pool_size=1, read_limit=4,
+                              target_latency=0.5)
+        threads = [threading.Thread(
+            target=server.invoke_command,
+            args=(FreeNASServer.SELECT_COMMAND, '/slow/%d' % n, None))
+            for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual(4, sum(_Handler.requests['/slow/%d' % n]
+                                for n in range(4)))
+        stats = server.limiter.get_stats()['read']
+        self.assertEqual(4, stats['limit'])
+        self.assertEqual(0, stats['decreases'])
+
+
+class SingleFlightTest(LocalServerTestCase):
+
+
+    def _read(self, path):
+        return self.server.invoke_command(FreeNASServer.SELECT_COMMAND,
+                                          path, None)
+
+    def test_concurrent_identical_reads_share_one_call(self):
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(self._read('/slow/1')))
+            for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(1, _Handler.requests['/slow/1'])
+        self.assertEqual(8, len(results))
+        self.assertEqual(7, self.server.coalesced_reads)
+        self.assertEqual(1, json.loads(results[0]['response'])['n'])
+
+    def test_sequential_reads_without_window(self):
+        self._read('/ok/1')
+        self._read('/ok/1')
+        self.assertEqual(2, _Handler.requests['/ok/1'])
+
+    def test_read_window(self):
+        self.server = self._server(read_window=60)
+        self._read('/ok/1')
+        self._read('/ok/1')
+        self.assertEqual(1, _Handler.requests['/ok/1'])
+        # A mutating call ends the window.
+        self.server.invoke_command(FreeNASServer.CREATE_COMMAND, '/ok/2',
+                                   b'{}')
+        self._read('/ok/1')
+        self.assertEqual(2, _Handler.requests['/ok/1'])
+        # Errors are never reused.
+        self._read('/fail/3')
+        self._read('/fail/3')
+        self.assertEqual(2, _Handler.requests['/fail/3'])
+
+    def test_job_polls_are_not_reused(self):
+        self.server = self._server(read_window=60)
+        for _ in range(3):
+            self.assertIsNone(self.server.jobs.get_job(7))
+        self.assertEqual(3, sum(count for path, count in
+                                _Handler.requests.items()
+                                if path.startswith('/core/get_jobs')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,192 @@
+# Copyright (c) 2016 iXsystems
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Tests of the websocket transport against a local stub server."""
+
+import simplejson as json
+import threading
+import time
+import unittest
+
+from cinder.volume.drivers.ixsystems.freenasapi import FreeNASServer
+from cinder.volume.drivers.ixsystems.freenasws import FreeNASWebSocketServer
+
+from stub_websocket import StubError
+from stub_websocket import StubWebSocketServer
+
+
+class WebSocketTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = StubWebSocketServer()
+        self.addCleanup(self.stub.stop)
+        self.server = FreeNASWebSocketServer(
+            self.stub.host, 80, username='root', password='secret',
+            apikey='', transport_type='ws', retries=2, retry_backoff=0.01,
+            read_limit=32, write_limit=32)
+        self.addCleanup(self.server._reset_pool)
+
+    def _version(self):
+        return self.server.invoke_command(FreeNASServer.SELECT_COMMAND,
+                                          '/system/version', None)
+
+
+class MultiplexTest(WebSocketTestCase):
+
+    CALLS = 20
+
+    def test_concurrent_calls_share_one_connection(self):
+        arrived = threading.Barrier(self.CALLS)
+        order = []
+
+        def gate(conn, args):
+            # Hold every call until all arrived, answer the last first.
+            arrived.wait(10)
+            time.sleep(0.01 * (self.CALLS - args['n']))
+            order.append(args['n'])
+            return args['n']
+        self.stub.handlers['test.gate'] = gate
+
+        results = {}
+
+        def call(n):
+            results[n] = self.server.invoke_command(
+                FreeNASServer.CREATE_COMMAND, '/test/gate',
+                json.dumps({'n': n}).encode('utf8'))
+        threads = [threading.Thread(target=call, args=(n,))
+                   for n in range(self.CALLS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(30)
+        self.assertNotEqual(sorted(order), order)
+        for n in range(self.CALLS):
+            self.assertEqual(FreeNASServer.STATUS_OK, results[n]['status'])
+            self.assertEqual(n, json.loads(results[n]['response']))
+        self.assertEqual(1, self.stub.accepted)
+        self.assertEqual(1, self.stub.calls.count('auth.login'))
+
+    def test_error_mapping(self):
+        def missing(conn, obj_id):
+            raise StubError('ENOENT', 'Target %s does not exist' % obj_id)
+        self.stub.handlers['iscsi.target.get_instance'] = missing
+        ret = self.server.invoke_command(FreeNASServer.SELECT_COMMAND,
+                                         '/iscsi/target/id/7', None)
+        self.assertEqual(404, ret['code'])
+        self.assertEqual('404:Target 7 does not exist', ret['response'])
+
+
+class ReconnectTest(WebSocketTestCase):
+
+    def test_reconnects_after_connection_loss(self):
+        self.assertEqual(FreeNASServer.STATUS_OK, self._version()['status'])
+        self.stub.drop_connections()
+        ret = self._version()
+        self.assertEqual(FreeNASServer.STATUS_OK, ret['status'])
+        self.assertEqual('TrueNAS-SCALE-25.04.0', json.loads(ret['response']))
+        self.assertEqual(2, self.stub.accepted)
+        self.assertEqual(2, self.stub.calls.count('auth.login'))
+
+    def test_call_in_flight_fails_on_connection_loss(self):
+        received = threading.Event()
+
+        def hang(conn, args):
+            received.set()
+            time.sleep(30)
+        self.stub.handlers['test.hang'] = hang
+        threading.Timer(0, lambda: received.wait(5) and
+                        self.stub.drop_connections()).start()
+        start = time.monotonic()
+        ret = self.server.invoke_command(FreeNASServer.CREATE_COMMAND,
+                                         '/test/hang', b'{}')
+        self.assertLess(time.monotonic() - start, 10)
+        self.assertEqual(FreeNASServer.STATUS_ERROR, ret['status'])
+        self.assertEqual(-1, ret['code'])
+
+    def test_malformed_messages_keep_the_connection(self):
+        self.assertEqual(FreeNASServer.STATUS_OK, self._version()['status'])
+        self.stub.broadcast('not json')
+        self.stub.broadcast('[1, 2]')
+        self.stub.broadcast('{"id": {}}')
+        ret = self._version()
+        self.assertEqual(FreeNASServer.STATUS_OK, ret['status'])
+        self.assertEqual(1, self.stub.accepted)
+
+
+class JobEventTest(WebSocketTestCase):
+
+    def test_job_finishes_on_event(self):
+        polls = []
+
+        def get_jobs(conn, filters, options):
+            polls.append(filters)
+            return [{'id': 42, 'state': 'RUNNING'}]
+
+        def delete(conn, obj_id):
+            def events():
+                time.sleep(0.2)
+                self.stub.send_job_update(42, state='RUNNING', progress=50)
+                time.sleep(0.2)
+                self.stub.send_job_update(42, id=42, state='SUCCESS',
+                                          result=True)
+            threading.Thread(target=events).start()
+            return 42
+        self.stub.handlers['core.get_jobs'] = get_jobs
+        self.stub.handlers['pool.dataset.delete'] = delete
+
+        start = time.monotonic()
+        ret = self.server.jobs.invoke(FreeNASServer.DELETE_COMMAND,
+                                      '/pool/dataset/id/tank%2Fvol', None,
+                                      'delete')
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(FreeNASServer.STATUS_OK, ret['status'])
+        self.assertTrue(json.loads(ret['response']))
+        # The job was seen running once, then finished by its event.
+        self.assertEqual(1, len(polls))
+
+    def test_failed_job(self):
+        def delete(conn, obj_id):
+            threading.Timer(0.1, self.stub.send_job_update, (43,),
+                            {'state': 'FAILED',
+                             'error': 'dataset is busy'}).start()
+            return 43
+        self.stub.handlers['core.get_jobs'] = (
+            lambda conn, filters, options: [])
+        self.stub.handlers['pool.dataset.delete'] = delete
+        ret = self.server.jobs.invoke(FreeNASServer.DELETE_COMMAND,
+                                      '/pool/dataset/id/tank%2Fvol', None,
+                                      'delete')
+        self.assertEqual(422, ret['code'])
+        self.assertIn('dataset is busy', ret['response'])
+
+
+class ReadWindowTest(WebSocketTestCase):
+
+    def test_job_polls_are_not_reused(self):
+        server = FreeNASWebSocketServer(
+            self.stub.host, 80, username='root', password='secret',
+            apikey='', transport_type='ws', read_window=60)
+        self.addCleanup(server._reset_pool)
+        self.stub.handlers['core.get_jobs'] = (
+            lambda conn, filters, options: [{'id': 7, 'state': 'RUNNING'}])
+        for _ in range(3):
+            self.assertEqual('RUNNING', server.jobs.get_job(7)['state'])
+            server.invoke_command(FreeNASServer.SELECT_COMMAND,
+                                  '/system/version', None)
+        self.assertEqual(3, self.stub.calls.count('core.get_jobs'))
+        self.assertEqual(1, self.stub.calls.count('system.version'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,231 @@
+# Copyright (c) 2016 iXsystems
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Tests of the iSCSI driver entry points with a mocked array."""
+
+import simplejson as json
+import unittest
+from unittest import mock
+
+from cinder import exception
+from cinder.volume import configuration
+from cinder.volume import driver
+from cinder.volume.drivers.ixsystems.freenasapi import FreeNASApiError
+from cinder.volume.drivers.ixsystems.freenasapi import FreeNASResponse
+from cinder.volume.drivers.ixsystems.freenasapi import FreeNASServer
+from cinder.volume.drivers.ixsystems import iscsi
+from oslo_config import cfg
+
+VOLUME_NAME = 'volume-0123456789abcdef0123456789abcdef'
+CONNECTOR = {'host': 'compute-1', 'initiator': 'iqn.1993-08.org.debian:01:1'}
+
+
+class DriverTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.configuration = configuration.Configuration(
+            driver.volume_opts, config_group='ixsystems-test')
+        self.driver = iscsi.FreeNASISCSIDriver(
+            configuration=self.configuration)
+        self.common = self.driver.common
+        self.common.handle = mock.Mock()
+        self.common._get_capabilities = mock.Mock(return_value={
+            'features': {'ctl_tunables': True},
+            'max_luns': 1, 'max_ports': 1})
+        self.volume = mock.MagicMock()
+        self.volume.__getitem__.side_effect = {
+            'id': '0123456789abcdef0123456789abcdef',
+            'name': VOLUME_NAME, 'size': 1,
+            'volume_type_id': None}.__getitem__
+
+    def override(self, **kwargs):
+        for name, value in kwargs.items():
+            cfg.CONF.set_override(name, value, group='ixsystems-test')
+            self.addCleanup(cfg.CONF.clear_override, name,
+                            group='ixsystems-test')
+
+
+class InitializeConnectionTest(DriverTestCase):
+
+    def test_failed_export_lookup_releases_the_admission(self):
+        self.common._get_export = mock.Mock(
+            side_effect=FreeNASApiError('No LUN is mapped'))
+        for _ in range(3):
+            self.assertRaises(FreeNASApiError,
+                              self.driver.initialize_connection,
+                              self.volume, CONNECTOR)
+        self.assertEqual(0, self.common.attachments.count())
+
+    def test_failed_portal_selection_releases_the_admission(self):
+        self.common._get_export = mock.Mock(
+            return_value={'iqn': 'iqn.2005-10.org.freenas.ctl:x', 'lun': 0})
+        self.common._get_portals = mock.Mock(
+            side_effect=FreeNASApiError('portal query failed'))
+        self.assertRaises(FreeNASApiError, self.driver.initialize_connection,
+                          self.volume, dict(CONNECTOR, multipath=True))
+        self.assertEqual(0, self.common.attachments.count())
+
+
+class RetypeTest(DriverTestCase):
+
+    def test_provisioning_type_change_needs_a_migration(self):
+        backend_name = self.configuration.ixsystems_volume_backend_name
+        host = {'capabilities': {'volume_backend_name': backend_name}}
+        diff = {'extra_specs': {'provisioning:type': ('thick', 'thin')}}
+        self.assertFalse(self.driver.retype(None, self.volume,
+                                            {'id': 'type-2', 'name': 'thin'},
+                                            diff, host))
+
+    def test_blocksize_change_needs_a_migration(self):
+        self.common._update_extent = mock.Mock()
+        backend_name = self.configuration.ixsystems_volume_backend_name
+        host = {'capabilities': {'volume_backend_name': backend_name}}
+        diff = {'extra_specs': {'ixsystems:blocksize': ('512', '4096'),
+                                'ixsystems:rpm': ('SSD', '7200')}}
+        self.assertFalse(self.driver.retype(None, self.volume,
+                                            {'id': 'type-2', 'name': '4k'},
+                                            diff, host))
+        self.assertFalse(self.common._update_extent.called)
+
+    def test_extent_change_in_place(self):
+        self.common._update_zvol = mock.Mock()
+        self.common._update_extent = mock.Mock()
+        self.driver._get_volume_type_specs = mock.Mock(
+            return_value={'ixsystems:blocksize': '4096',
+                          'ixsystems:rpm': '7200', 'ixsystems:xen': 'True'})
+        backend_name = self.configuration.ixsystems_volume_backend_name
+        host = {'capabilities': {'volume_backend_name': backend_name}}
+        diff = {'extra_specs': {'ixsystems:rpm': ('SSD', '7200'),
+                                'ixsystems:xen': (None, 'True')}}
+        self.assertTrue(self.driver.retype(None, self.volume,
+                                           {'id': 'type-2', 'name': 'hdd'},
+                                           diff, host))
+        self.common._update_extent.assert_called_once_with(
+            mock.ANY, {'rpm': '7200', 'xen': True}, missing_ok=False)
+
+    def test_extent_change_of_a_lazy_volume_not_exported(self):
+        self.override(ixsystems_lazy_export=True)
+        self.common.get_extent_id = mock.Mock(return_value=0)
+        self.common._update_zvol = mock.Mock()
+        self.driver._get_volume_type_specs = mock.Mock(
+            return_value={'ixsystems:rpm': '7200'})
+        backend_name = self.configuration.ixsystems_volume_backend_name
+        host = {'capabilities': {'volume_backend_name': backend_name}}
+        diff = {'extra_specs': {'ixsystems:rpm': ('SSD', '7200')}}
+        self.assertTrue(self.driver.retype(None, self.volume,
+                                           {'id': 'type-2', 'name': 'hdd'},
+                                           diff, host))
+        self.common.handle.invoke_command.assert_not_called()
+
+
+class GroupFromSourceTest(DriverTestCase):
+
+    def test_lazy_shared_volumes_are_not_exported(self):
+        self.override(ixsystems_lazy_export=True,
+                      ixsystems_export_mode='shared')
+        self.driver._check_cg_type = mock.Mock()
+        self.driver.create_volume_from_snapshot = mock.Mock()
+        self.common._get_export = mock.Mock(
+            side_effect=FreeNASApiError('No LUN is mapped'))
+        volume = mock.MagicMock(id='volume-1')
+        snapshot = {'name': 'snapshot-1', 'volume_name': VOLUME_NAME,
+                    'volume_size': 1}
+        model_update, volumes_model_update = (
+            self.driver.create_group_from_src(
+                None, mock.Mock(), [volume], group_snapshot=mock.Mock(),
+                snapshots=[snapshot]))
+        self.assertEqual([{'id': 'volume-1', 'status': 'available'}],
+                         volumes_model_update)
+
+
+class DeleteVolumeTest(DriverTestCase):
+
+    def setUp(self):
+        super(DeleteVolumeTest, self).setUp()
+        self.common._delete_iscsitarget = mock.Mock()
+        self.common._delete_volume = mock.Mock(
+            side_effect=exception.VolumeIsBusy(volume_name=VOLUME_NAME))
+
+    def test_busy_volume_is_deferred(self):
+        self.override(ixsystems_deferred_delete=True)
+        self.driver.delete_volume(self.volume)
+        self.assertEqual(['volume-0123456789abcdef0123456789abcdef'],
+                         self.common.deferred_deletes.due(10))
+
+    def test_busy_volume_without_deferral(self):
+        self.assertRaises(exception.VolumeIsBusy, self.driver.delete_volume,
+                          self.volume)
+        self.assertEqual(0, len(self.common.deferred_deletes))
+
+
+class RevertToSnapshotTest(DriverTestCase):
+
+    DATASET = 'tank/cinder/' + VOLUME_NAME
+
+    def setUp(self):
+        super(RevertToSnapshotTest, self).setUp()
+        self.override(ixsystems_dataset_path='tank/cinder')
+        self.snapshot = {'name': 'snapshot-1', 'volume_size': 1,
+                         'provider_location': None}
+        self.common.handle.invoke_command.return_value = FreeNASResponse(
+            FreeNASServer.STATUS_OK, b'null')
+
+    def _snapshots(self, *names):
+        self.common.handle.query.return_value = FreeNASResponse(
+            FreeNASServer.STATUS_OK, json.dumps([
+                {'name': '%s@%s' % (self.DATASET, name),
+                 'properties': {'createtxg': {'value': str(txg)}}}
+                for txg, name in enumerate(names)]).encode('utf8'))
+
+    def test_no_temporary_snapshot(self):
+        self.assertFalse(self.driver.snapshot_revert_use_temp_snapshot())
+
+    def test_revert_to_latest_snapshot(self):
+        self._snapshots('snap-0', 'snap-1')
+        self.driver.revert_to_snapshot(None, self.volume, self.snapshot)
+        command, request_urn, body = (
+            self.common.handle.invoke_command.call_args[0])
+        self.assertEqual(FreeNASServer.REST_API_SNAPSHOT + '/rollback',
+                         request_urn)
+        self.assertEqual(self.DATASET + '@snap-1',
+                         json.loads(body)['id'])
+
+    def test_newer_snapshot_falls_back(self):
+        self._snapshots('snap-1', 'snap-2')
+        self.assertRaises(NotImplementedError,
+                          self.driver.revert_to_snapshot, None, self.volume,
+                          self.snapshot)
+        self.assertFalse(self.common.handle.invoke_command.called)
+
+    def test_grown_volume_is_extended_after_the_rollback(self):
+        self._snapshots('snap-0', 'snap-1')
+        calls = mock.Mock()
+        calls.attach_mock(self.common.handle.invoke_command, 'rollback')
+        self.common._extend_volume = calls.extend
+        self.volume.__getitem__.side_effect = {
+            'name': VOLUME_NAME, 'size': 2}.__getitem__
+        self.driver.revert_to_snapshot(None, self.volume, self.snapshot)
+        self.assertEqual(['rollback', 'extend'],
+                         [name for name, _, _ in calls.mock_calls])
+        calls.extend.assert_called_once_with(VOLUME_NAME, 2)
+
+    def test_same_size_volume_is_not_extended(self):
+        self._snapshots('snap-0', 'snap-1')
+        self.common._extend_volume = mock.Mock()
+        self.driver.revert_to_snapshot(None, self.volume, self.snapshot)
+        self.assertFalse(self.common._extend_volume.called)
+
+
+if __name__ == '__main__':
+    unittest.main()
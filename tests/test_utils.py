@@ -0,0 +1,51 @@
+# Copyright (c) 2016 iXsystems
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Tests of the volume type extra spec parsers."""
+
+import unittest
+
+from cinder.volume.drivers.ixsystems import utils as ix_utils
+
+
+class ExtraSpecTest(unittest.TestCase):
+
+    def test_ixsystems_specs(self):
+        self.assertEqual({'volblocksize': '16K', 'sparse': 'True'},
+                         ix_utils.get_ixsystems_specs({
+                             'ixsystems:volblocksize': ' 16K ',
+                             'ixsystems:sparse': True,
+                             'provisioning:type': 'thin',
+                             'volume_backend_name': 'ixsystems'}))
+        self.assertEqual({}, ix_utils.get_ixsystems_specs(None))
+
+    def test_parse_spec_bool(self):
+        for value in ('True', 'yes', 'ON', '1', '<is> True', True):
+            self.assertTrue(ix_utils.parse_spec_bool(value))
+        for value in ('False', 'no', 'off', '0', '<is> False', False):
+            self.assertFalse(ix_utils.parse_spec_bool(value))
+        for value in ('', 'maybe', '<is>', '2'):
+            self.assertRaises(ValueError, ix_utils.parse_spec_bool, value)
+
+    def test_parse_block_size(self):
+        for value, size in (('512', 512), ('16K', 16384), ('16k', 16384),
+                            ('16KB', 16384), (' 128K ', 131072),
+                            ('1M', 1048576), (4096, 4096)):
+            self.assertEqual(size, ix_utils.parse_block_size(value))
+        for value in ('', 'K', '16G', '1.5K', '-512', 'sixteen'):
+            self.assertRaises(ValueError, ix_utils.parse_block_size, value)
+
+
+if __name__ == '__main__':
+    unittest.main()